@@ -0,0 +1,912 @@
+# -*- coding: utf-8 -*-
+"""Нагрузочные замеры бота: python bench.py <замер> [параметры]"""
+import asyncio
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import sys
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+import telebot
+
+import bot
+
+# =============================
+# СНИМОК ДАННЫХ
+# =============================
+
+def make_users(count):
+    """Синтетические пользователи в формате bot.users"""
+    now = time.time()
+    return {
+        1000000 + i: {
+            'captcha': True,
+            'last_msg': now - i,
+            'username': f"user{i}",
+            'first_name': f"Имя {i}",
+            'messages_sent': i % 50,
+            'joined': now - i * 10
+        }
+        for i in range(count)
+    }
+
+def bench_snapshot(count=1000000):
+    """Время загрузки снимка: старый bot_data.json против бинарного формата"""
+    data = {
+        'users': make_users(count),
+        'user_messages': {},
+        'operator_stats': {},
+        'answer_templates': {},
+        'system_settings': dict(bot.system_settings),
+        'messages_queue': [],
+        'waiting_answers': {},
+        'journal_seq': 0
+    }
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, 'bot_data.json')
+        snapshot_path = os.path.join(tmp, 'bot_data.snapshot')
+        
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        with open(snapshot_path, 'wb') as f:
+            f.write(bot.encode_snapshot(data))
+        
+        started = time.time()
+        loaded = bot.read_json_snapshot(json_path)
+        json_time = time.time() - started
+        
+        started = time.time()
+        snapshot = bot.read_snapshot(snapshot_path)
+        snapshot_time = time.time() - started
+        
+        assert loaded['users'].keys() == snapshot['users'].keys() == data['users'].keys()
+        
+        print(f"Пользователей: {count}")
+        print(f"bot_data.json:     {os.path.getsize(json_path) / 2**20:8.1f} МБ, загрузка {json_time:.2f} сек")
+        print(f"bot_data.snapshot: {os.path.getsize(snapshot_path) / 2**20:8.1f} МБ, загрузка {snapshot_time:.2f} сек")
+        
+        # Сжатие журнала: под замками только копия данных, кодирование - без них
+        saved_users, bot.users = bot.users, data['users']
+        try:
+            started = time.time()
+            with bot.state_lock:
+                copied = bot.snapshot_sections()
+            copy_time = time.time() - started
+            started = time.time()
+            bot.encode_snapshot(copied)
+            encode_time = time.time() - started
+        finally:
+            bot.users = saved_users
+        print(f"Сжатие журнала: замки держатся {copy_time:.2f} сек (копия), кодирование без замков {encode_time:.2f} сек")
+
+# =============================
+# ОЧЕРЕДЬ СООБЩЕНИЙ
+# =============================
+
+def make_messages(count, users_count):
+    """Синтетические сообщения очереди от users_count пользователей"""
+    now = time.time()
+    return [
+        {'id': i + 1, 'user_id': 1000000 + i % users_count, 'text': f"сообщение {i}", 'type': 'text', 'time': now + i}
+        for i in range(count)
+    ]
+
+def legacy_queue_round(queue, claims, operators_count):
+    """Один круг старого алгоритма: взять по сообщению, ответить, освободить"""
+    for operator_id in range(operators_count):
+        for msg in queue[:20]:
+            if not any(claim.get('user_id') == msg['user_id'] for claim in claims.values()):
+                claims[operator_id] = {'user_id': msg['user_id'], 'message': msg}
+                break
+    for operator_id in list(claims):
+        user_id = claims.pop(operator_id)['user_id']
+        if queue and queue[0]['user_id'] == user_id:
+            queue.pop(0)
+        else:
+            queue[:] = [msg for msg in queue if msg['user_id'] != user_id]
+
+def bench_queue(count=100000, operators_count=50, users_count=20000):
+    """Постановка, взятие, ответ и отклонение: MessageQueue против списка"""
+    messages = make_messages(count, users_count)
+    
+    started = time.time()
+    queue = bot.MessageQueue()
+    for msg in messages:
+        queue.push(msg)
+    enqueue_time = time.time() - started
+    
+    started = time.time()
+    rounds = 0
+    while queue:
+        claimed = []
+        for operator_id in range(operators_count):
+            msg = queue.claim(operator_id)
+            if msg:
+                claimed.append((msg['user_id'], operator_id))
+        for user_id, operator_id in claimed:
+            if rounds % 10 == 0:
+                queue.remove_user(user_id)
+            else:
+                queue.complete(user_id)
+            queue.release(user_id, operator_id)
+        rounds += 1
+    drain_time = time.time() - started
+    
+    print(f"Сообщений: {count}, пользователей: {users_count}, операторов: {operators_count}")
+    print(f"MessageQueue: постановка {enqueue_time * 1e6 / count:.2f} мкс/сообщ., "
+          f"разбор {drain_time * 1e6 / count:.2f} мкс/сообщ. ({rounds} кругов)")
+    
+    # Старый список: замеряем несколько кругов и экстраполируем
+    queue = list(messages)
+    claims = {}
+    started = time.time()
+    sample_rounds = 20
+    for _ in range(sample_rounds):
+        legacy_queue_round(queue, claims, operators_count)
+    legacy_time = time.time() - started
+    handled = count - len(queue)
+    print(f"Список:       разбор {legacy_time * 1e6 / max(handled, 1):.2f} мкс/сообщ. "
+          f"(замер на {sample_rounds} кругах, {handled} сообщений)")
+
+def simulate_fairness(mode, operators_count=3, chatty_messages=300, quiet_users=60):
+    """Прогон для замера fairness: один болтливый пользователь и много тихих, сколько тактов ждут тихие"""
+    queue = bot.MessageQueue()
+    queue.mode = mode
+    msg_id = 0
+    
+    # Болтливый пользователь пишет первым и много
+    for _ in range(chatty_messages):
+        msg_id += 1
+        queue.push({'id': msg_id, 'user_id': 1, 'text': '', 'type': 'text', 'time': 0})
+    # Тихие пользователи пишут по одному сообщению
+    for user_id in range(2, quiet_users + 2):
+        msg_id += 1
+        queue.push({'id': msg_id, 'user_id': user_id, 'text': '', 'type': 'text', 'time': 0})
+    
+    waits = {}
+    tick = 0
+    handled = 0
+    while queue:
+        tick += 1
+        # Каждый оператор за такт отвечает на одно сообщение
+        claimed = [(queue.claim(op), op) for op in range(operators_count)]
+        for msg, op in claimed:
+            if msg:
+                waits.setdefault(msg['user_id'], tick)
+                queue.complete(msg['user_id'])
+                queue.release(msg['user_id'], op)
+                handled += 1
+    
+    quiet = [waits[user_id] for user_id in range(2, quiet_users + 2)]
+    return {
+        'ticks': tick,
+        'throughput': handled / tick,
+        'quiet_avg': sum(quiet) / len(quiet),
+        'quiet_max': max(quiet)
+    }
+
+def check_round_robin(operations=20000, users_count=30, operators_count=4, seed=1):
+    """Проверка round_robin на случайных операциях: пока пользователь ждет, никого не обслуживают дважды"""
+    rng = random.Random(seed)
+    queue = bot.MessageQueue()
+    queue.mode = 'round_robin'
+    busy = {}  # operator_id: user_id
+    served = {}  # Ждущий user_id: кого обслужили, пока он ждет
+    msg_id = 0
+    for _ in range(operations):
+        op = rng.random()
+        if op < 0.5:
+            msg_id += 1
+            user_id = rng.randint(1, users_count)
+            if user_id not in queue.by_user and user_id not in queue.claimed:
+                served[user_id] = set()
+            queue.push({'id': msg_id, 'user_id': user_id, 'text': '', 'type': 'text', 'time': 0})
+        elif op < 0.8:
+            free = [operator_id for operator_id in range(operators_count) if operator_id not in busy]
+            if not free:
+                continue
+            msg = queue.claim(rng.choice(free))
+            if not msg:
+                continue
+            user_id = msg['user_id']
+            for waiting, others in served.items():
+                if waiting != user_id:
+                    assert user_id not in others, f"{user_id} обслужен дважды, пока ждет {waiting}"
+                    others.add(user_id)
+            served.pop(user_id, None)
+            busy[queue.claimed[user_id]] = user_id
+        elif busy:
+            operator_id = rng.choice(list(busy))
+            user_id = busy.pop(operator_id)
+            if op < 0.95:
+                queue.complete(user_id)
+            queue.release(user_id, operator_id)
+            if user_id in queue.by_user:
+                served[user_id] = set()
+        # Ждут ровно пользователи с сообщениями, которых никто не взял
+        assert set(queue.ready) == set(queue.by_user) - set(queue.claimed) == set(served)
+        assert len(queue) == sum(len(msgs) for msgs in queue.by_user.values())
+    return msg_id
+
+def check_fifo(operations=20000, users_count=30, operators_count=4, seed=1):
+    """Проверка fifo на случайных операциях: взятие всегда отдает самое старое сообщение свободных пользователей"""
+    rng = random.Random(seed)
+    queue = bot.MessageQueue()
+    busy = {}  # operator_id: user_id
+    msg_id = 0
+    for _ in range(operations):
+        op = rng.random()
+        if op < 0.5:
+            msg_id += 1
+            queue.push({'id': msg_id, 'user_id': rng.randint(1, users_count), 'text': '', 'type': 'text', 'time': 0})
+        elif op < 0.8:
+            free = [operator_id for operator_id in range(operators_count) if operator_id not in busy]
+            if not free:
+                continue
+            oldest = min((msgs[0]['id'] for user_id, msgs in queue.by_user.items() if user_id not in queue.claimed),
+                         default=None)
+            operator_id = rng.choice(free)
+            msg = queue.claim(operator_id)
+            assert (msg and msg['id']) == oldest, (msg and msg['id'], oldest)
+            if msg:
+                busy[operator_id] = msg['user_id']
+        elif busy:
+            operator_id = rng.choice(list(busy))
+            user_id = busy.pop(operator_id)
+            if op < 0.95:
+                queue.complete(user_id)
+            queue.release(user_id, operator_id)
+    return msg_id
+
+def bench_fairness(operators_count=3, chatty_messages=300, quiet_users=60):
+    """Замер: FIFO против round_robin при одном болтливом пользователе, плюс проверки порядка обоих режимов"""
+    pushed = check_fifo()
+    print(f"fifo: проверка порядка на {pushed} случайных сообщениях пройдена")
+    pushed = check_round_robin()
+    print(f"round_robin: проверка порядка на {pushed} случайных сообщениях пройдена")
+    print(f"Операторов: {operators_count}, болтливый: {chatty_messages} сообщений, тихих: {quiet_users}")
+    results = {}
+    for mode in ('fifo', 'round_robin'):
+        result = simulate_fairness(mode, operators_count, chatty_messages, quiet_users)
+        results[mode] = result
+        print(f"{mode:12} тактов: {result['ticks']:4}, пропускная способность: {result['throughput']:.2f} сообщ./такт, "
+              f"ожидание тихих: среднее {result['quiet_avg']:.1f}, макс. {result['quiet_max']}")
+    
+    # По кругу тихие не ждут болтливого, а общая пропускная способность не падает
+    assert results['round_robin']['quiet_max'] <= results['fifo']['quiet_max']
+    assert results['round_robin']['throughput'] >= results['fifo']['throughput'] * 0.9
+
+# =============================
+# РЕЖИМ ЗАПУСКА
+# =============================
+
+def make_updates(count, users_count, raw=False):
+    """Синтетические текстовые обновления от зарегистрированных пользователей (raw - JSON от Bot API)"""
+    now = int(time.time())
+    updates = [
+        {
+            'update_id': i + 1,
+            'message': {
+                'message_id': i + 1,
+                'date': now,
+                'chat': {'id': 1000000 + i % users_count, 'type': 'private'},
+                'from': {'id': 1000000 + i % users_count, 'is_bot': False, 'first_name': 'Имя'},
+                'text': f"сообщение номер {i}"
+            }
+        }
+        for i in range(count)
+    ]
+    return updates if raw else [telebot.types.Update.de_json(update) for update in updates]
+
+def prepare_runtime_state(users_count, operators_count):
+    """Пользователи в режиме написания, операторы и настройки без задержек"""
+    bot.users.clear()
+    bot.users.update(make_users(users_count))
+    for user in bot.users.values():
+        user['writing'] = True
+        user['last_msg'] = 0
+    bot.operators[:] = range(1, operators_count + 1)
+    bot.WAIT_TIME = 0
+    bot.system_settings['captcha_enabled'] = False
+    bot.system_settings['work_hours_enabled'] = False
+    bot.system_settings['notify_operators'] = True
+    bot.messages_queue.clear()
+
+def queue_in_order():
+    """Сообщения каждого пользователя стоят в очереди в порядке отправки"""
+    for msgs in bot.messages_queue.by_user.values():
+        numbers = [int(msg['text'].rsplit(' ', 1)[1]) for msg in msgs]
+        if numbers != sorted(numbers):
+            return False
+    return True
+
+def bench_runtime(count=200, operators_count=10, latency_ms=20, users_count=50):
+    """Обновлений в секунду при задержке API: пул TeleBot, диспетчер по чатам и режим async
+    
+    Везде WORKERS потоков обработки и DETACHED_WORKERS одновременных фоновых отправок;
+    режим async отличается только тем, что отправки ждут ответа на asyncio, а не в потоках.
+    """
+    latency = latency_ms / 1000
+    api_methods = ['send_message', 'send_photo', 'send_video', 'send_document', 'send_voice']
+    done = threading.Event()
+    confirmed = [0]
+    lock = threading.Lock()
+    
+    def confirm(chat_id):
+        # Обновление обработано, когда доставлены подтверждение пользователю и уведомления операторам
+        with lock:
+            confirmed[0] += 1
+            if confirmed[0] == count * (operators_count + 1):
+                done.set()
+    
+    def fake_sync(*args, **kwargs):
+        time.sleep(latency)
+        confirm(args[0])
+    
+    async def fake_async(*args, **kwargs):
+        await asyncio.sleep(latency)
+        confirm(args[0])
+    
+    for method in api_methods:
+        setattr(bot.bot, method, fake_sync)
+    # Замеряем обработку, а не лимиты Telegram
+    bot.tg = bot.Outbox(float('inf'), float('inf'), 1, 0)
+    
+    def run(mode, dispatch):
+        prepare_runtime_state(users_count, operators_count)
+        updates = make_updates(count, users_count)
+        confirmed[0] = 0
+        done.clear()
+        started = time.time()
+        dispatch(updates)
+        done.wait()
+        results[mode] = (time.time() - started, queue_in_order())
+    
+    def telebot_pool(updates):
+        # Как bot.polling(): пачка обновлений уходит в пул TeleBot
+        bot.bot.process_new_updates(updates)
+    
+    def ordered(updates):
+        for update in updates:
+            bot.dispatcher.submit(update)
+    
+    async def run_async():
+        from telebot.async_telebot import AsyncTeleBot
+        bot.async_bot = AsyncTeleBot('0:bench')
+        for method in api_methods:
+            setattr(bot.async_bot, method, fake_async)
+        bot.async_loop = asyncio.get_running_loop()
+        # Столько же одновременных запросов, сколько потоков фоновых отправок в режиме polling
+        bot.transport.async_slots = asyncio.Semaphore(bot.DETACHED_WORKERS)
+        await bot.async_loop.run_in_executor(None, run, 'async', ordered)
+        bot.transport.async_slots = None
+        bot.async_loop = None
+    
+    cwd = os.getcwd()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            # Столько же потоков, сколько у диспетчера, - иначе сравнивается только число потоков
+            bot.bot.worker_pool.close()
+            bot.bot.worker_pool = telebot.util.ThreadPool(bot.bot, num_threads=bot.WORKERS)
+            run('telebot', telebot_pool)
+            bot.bot.worker_pool.close()
+            
+            bot.dispatcher.start()
+            run('polling', ordered)
+            asyncio.run(run_async())
+            bot.writer.flush()
+        finally:
+            os.chdir(cwd)
+    
+    print(f"Обновлений: {count} от {users_count} пользователей, операторов: {operators_count}, "
+          f"задержка API: {latency_ms} мс, во всех режимах потоков обработки: {bot.WORKERS}, "
+          f"одновременных фоновых отправок: {bot.DETACHED_WORKERS}")
+    for mode, (elapsed, in_order) in results.items():
+        print(f"{mode:8} {elapsed:7.2f} сек, {count / elapsed:8.1f} обновл./сек, "
+              f"порядок в чатах {'соблюден' if in_order else 'НАРУШЕН'}")
+    assert results['polling'][1] and results['async'][1]
+
+def bench_fanout(messages=20, operators_count=30, latency_ms=50):
+    """Задержка подтверждения пользователю: уведомления операторам в фоне против по очереди"""
+    latency = latency_ms / 1000
+    delivered = []
+    lock = threading.Lock()
+    
+    def fake_send(chat_id, *args, **kwargs):
+        time.sleep(latency)
+        with lock:
+            delivered.append((chat_id, time.time()))
+    
+    for method in ('send_message', 'send_photo', 'send_video', 'send_document', 'send_voice'):
+        setattr(bot.bot, method, fake_send)
+    bot.tg = bot.Outbox(float('inf'), float('inf'), 1, 0)
+    
+    def sequential(user_id, text, user_info):
+        # Прежняя рассылка: операторы по одному в потоке обработчика
+        for operator_id in bot.operators:
+            bot.tg.send_message(operator_id, text, parse_mode="Markdown", reply_markup=bot.answer_buttons(user_id))
+    
+    cwd = os.getcwd()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for mode, notify in (('по очереди', sequential), ('в фоне', bot.notify_operators)):
+                prepare_runtime_state(messages, operators_count)
+                bot.notify_operators, original = notify, bot.notify_operators
+                delivered.clear()
+                handler_time = 0
+                started = time.time()
+                for update in make_updates(messages, messages):
+                    handler_started = time.time()
+                    bot.process_user_message(update.message)
+                    handler_time += time.time() - handler_started
+                while len(delivered) < messages * (operators_count + 1):
+                    time.sleep(0.01)
+                results[mode] = (handler_time / messages, max(t for _, t in delivered) - started)
+                bot.notify_operators = original
+            bot.writer.flush()
+        finally:
+            os.chdir(cwd)
+    
+    print(f"Сообщений: {messages}, операторов: {operators_count}, задержка API: {latency_ms} мс")
+    for mode, (confirm_time, total_time) in results.items():
+        print(f"{mode:10} подтверждение пользователю {confirm_time * 1000:7.0f} мс, "
+              f"все уведомления доставлены за {total_time:.2f} сек")
+
+class FlatOutbox(bot.Outbox):
+    """Outbox без приоритетов: все вызовы в одной очереди по порядку"""
+    
+    def enqueue(self, chat_id, priority, grant):
+        super().enqueue(chat_id, bot.PRIORITY_NORMAL, grant)
+
+def bench_priority(replies=20, operators_count=5, arrivals_per_sec=3, latency_ms=20):
+    """Ожидание ответа оператора во время рассылки и потока уведомлений: с приоритетами и без"""
+    latency = latency_ms / 1000
+    
+    def fake_send(chat_id, *args, **kwargs):
+        time.sleep(latency)
+    
+    for method in ('send_message', 'send_photo', 'send_video', 'send_document', 'send_voice'):
+        setattr(bot.bot, method, fake_send)
+    bot.operators[:] = range(1, operators_count + 1)
+    
+    results = {}
+    for mode, outbox in (('с приоритетами', bot.Outbox), ('одна очередь', FlatOutbox)):
+        bot.tg = outbox(bot.OUTBOX_GLOBAL_RATE, bot.OUTBOX_CHAT_RATE, bot.OUTBOX_CHAT_BURST, 0)
+        stop = threading.Event()
+        broadcast_sent = [0]
+        
+        def broadcast():
+            # Как run_broadcast: порции по BROADCAST_BATCH через send_concurrently
+            user_id = 2000000
+            while not stop.is_set():
+                bot.send_concurrently([
+                    ('send_message', (user_id + i, 'рассылка'), {'priority': bot.PRIORITY_BULK})
+                    for i in range(bot.BROADCAST_BATCH)
+                ])
+                user_id += bot.BROADCAST_BATCH
+                broadcast_sent[0] += bot.BROADCAST_BATCH
+        
+        def arrivals():
+            # Новые сообщения пользователей: уведомления всем операторам в фоне
+            while not stop.wait(1 / arrivals_per_sec):
+                bot.send_detached([('send_message', (operator_id, 'новое сообщение'), {})
+                                   for operator_id in bot.operators], "Ошибка")
+        
+        waits = []
+        
+        def reply(user_id):
+            started = time.time()
+            bot.tg.send_message(user_id, 'ответ', priority=bot.PRIORITY_HIGH)
+            waits.append(time.time() - started - latency)
+        
+        background = [threading.Thread(target=broadcast), threading.Thread(target=arrivals)]
+        for thread in background:
+            thread.start()
+        time.sleep(1)  # Очередь отправок успевает заполниться
+        started = time.time()
+        reply_threads = []
+        for i in range(replies):
+            thread = threading.Thread(target=reply, args=(3000000 + i,))
+            thread.start()
+            reply_threads.append(thread)
+            time.sleep(0.25)
+        for thread in reply_threads:
+            thread.join()
+        elapsed = time.time() - started
+        stop.set()
+        for thread in background:
+            thread.join()
+        results[mode] = (sum(waits) / len(waits), max(waits), broadcast_sent[0] / (elapsed + 1))
+    
+    print(f"Ответов: {replies}, операторов: {operators_count}, новых сообщений: {arrivals_per_sec}/сек, "
+          f"лимит: {bot.OUTBOX_GLOBAL_RATE:.0f}/сек, потоков рассылки: {bot.FANOUT_WORKERS}, "
+          f"уведомлений: {bot.DETACHED_WORKERS}")
+    for mode, (average, worst, rate) in results.items():
+        print(f"{mode:15} ожидание ответа: среднее {average * 1000:6.0f} мс, макс. {worst * 1000:6.0f} мс; "
+              f"рассылка {rate:5.1f} сообщ./сек")
+
+def post_update(conn, payload, secret):
+    """Отправить обновление в вебхук так, как это делает Telegram"""
+    conn.request('POST', bot.WEBHOOK_PATH, body=payload, headers={
+        'Content-Type': 'application/json',
+        'X-Telegram-Bot-Api-Secret-Token': secret
+    })
+    response = conn.getresponse()
+    response.read()
+    return response.status
+
+def bench_webhook(count=2000, senders=8, latency_ms=5):
+    """Локальный отправитель обновлений: прием вебхуком, проверка секрета и переполнения"""
+    latency = latency_ms / 1000
+    
+    def fake_send(*args, **kwargs):
+        time.sleep(latency)
+    
+    for method in ('send_message', 'send_photo', 'send_video', 'send_document', 'send_voice'):
+        setattr(bot.bot, method, fake_send)
+    bot.tg = bot.Outbox(float('inf'), float('inf'), 1, 0)
+    bot.WEBHOOK_SECRET = 'bench-secret'
+    
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            prepare_runtime_state(count, 3)
+            payloads = [json.dumps({
+                'update_id': i + 1,
+                'message': {
+                    'message_id': i + 1,
+                    'date': int(time.time()),
+                    'chat': {'id': 1000000 + i, 'type': 'private'},
+                    'from': {'id': 1000000 + i, 'is_bot': False, 'first_name': 'Имя'},
+                    'text': f"сообщение номер {i}"
+                }
+            }).encode() for i in range(count)]
+            
+            server = bot.make_webhook_server('127.0.0.1', 0)
+            port = server.server_address[1]
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            bot.dispatcher.start()
+            
+            # Чужой запрос без секрета отклоняется
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            assert post_update(conn, payloads[0], 'wrong') == 403
+            
+            latencies = []
+            statuses = []
+            lock = threading.Lock()
+            
+            def sender(chunk):
+                conn = http.client.HTTPConnection('127.0.0.1', port)
+                for payload in chunk:
+                    while True:
+                        started = time.time()
+                        status = post_update(conn, payload, bot.WEBHOOK_SECRET)
+                        with lock:
+                            latencies.append(time.time() - started)
+                            statuses.append(status)
+                        if status != 503:
+                            break
+                        # Как Telegram: повторить доставку позже
+                        time.sleep(0.05)
+            
+            started = time.time()
+            threads = [threading.Thread(target=sender, args=(payloads[i::senders],)) for i in range(senders)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            received = time.time() - started
+            bot.dispatcher.join()
+            handled = time.time() - started
+            
+            latencies.sort()
+            print(f"Обновлений: {count}, отправителей: {senders}, задержка API: {latency_ms} мс, "
+                  f"очередь: {bot.WEBHOOK_QUEUE_SIZE}")
+            print(f"Прием: {count / received:.0f} обновл./сек, ответ вебхука p50 {latencies[len(latencies) // 2] * 1000:.1f} мс, "
+                  f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} мс")
+            print(f"Обработано за {handled:.2f} сек; ответы: 200 - {statuses.count(200)}, 503 (повторены) - {statuses.count(503)}")
+            assert statuses.count(200) == count and bot.dispatcher.processed >= count
+            server.shutdown()
+            bot.writer.flush()
+        finally:
+            os.chdir(cwd)
+
+# =============================
+# ПРОЦЕССЫ (РЕЖИМ SHARDED)
+# =============================
+
+class ReadyInbox:
+    """Очередь обновлений процесса, сообщающая о готовности при первом чтении"""
+    
+    def __init__(self, inbox, results, index):
+        self.inbox = inbox
+        self.results = results
+        self.index = index
+        self.reported = False
+    
+    def get(self):
+        if not self.reported:
+            self.reported = True
+            self.results.put(('ready', self.index, 0, 0))
+        return self.inbox.get()
+
+def shard_worker(index, shards, inbox, results, operators_count, latency_ms):
+    """Процесс-обработчик с имитацией Telegram: задержка API без сети"""
+    latency = latency_ms / 1000
+    
+    def fake_send(chat_id, *args, **kwargs):
+        time.sleep(latency)
+    
+    sys.stdout = open(os.devnull, 'w')
+    for method in ['send_message', 'send_photo', 'send_video', 'send_document', 'send_voice']:
+        setattr(bot.bot, method, fake_send)
+    # Замеряем обработку, а не лимиты Telegram
+    bot.OUTBOX_GLOBAL_RATE = bot.OUTBOX_CHAT_RATE = float('inf')
+    bot.OUTBOX_CHAT_BURST, bot.OUTBOX_RETRIES = 1, 0
+    bot.operators[:] = range(1, operators_count + 1)
+    bot.WAIT_TIME = 0
+    
+    bot.run_shard(index, shards, ReadyInbox(inbox, results, index))
+    results.put(('done', index, bot.dispatcher.processed, time.time()))
+
+def prepare_shared_state(users_count, queue_size):
+    """Общая база SQLite: пользователи в режиме написания и настройки без задержек"""
+    storage = bot.SqliteStorage(bot.SQLITE_FILE)
+    storage.load()
+    prepare_runtime_state(users_count, 0)
+    bot.system_settings['max_queue_size'] = queue_size
+    for user_id in bot.users:
+        storage.save_user(user_id)
+    for key in ('captcha_enabled', 'work_hours_enabled', 'notify_operators', 'max_queue_size'):
+        storage.save_setting(key)
+    storage.write_pending()
+    storage.conn.close()
+
+def run_sharded(shards, updates, users_count, operators_count, latency_ms):
+    """Прогнать обновления через shards процессов: секунд на обработку и обработано обновлений"""
+    prepare_shared_state(users_count, len(updates))
+    results = multiprocessing.get_context('spawn').Queue()
+    processes, inboxes = bot.start_shards(
+        shards, shard_worker, (results, operators_count, latency_ms))
+    for _ in range(shards):
+        results.get()
+    
+    started = time.time()
+    for raw in updates:
+        inboxes[bot.shard_of(bot.update_chat(raw), shards)].put(raw)
+    bot.stop_shards(processes, inboxes)
+    done = [results.get() for _ in range(shards)]
+    return max(finished for _, _, _, finished in done) - started, sum(processed for _, _, processed, _ in done)
+
+def bench_shards(count=2000, max_shards=4, operators_count=5, latency_ms=5, users_count=500):
+    """Обновлений в секунду при 1, 2, 4... процессах с общей очередью в SQLite"""
+    updates = make_updates(count, users_count, raw=True)
+    bot.operators[:] = range(1, operators_count + 1)
+    
+    cwd = os.getcwd()
+    results = {}
+    shards = 1
+    while shards <= max_shards:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                # Процессы заново читают config.ini из текущего каталога
+                with open('config.ini', 'w', encoding='utf-8') as f:
+                    f.write(f"[BotConfig]\nbot_token = 0:bench\n\n[Storage]\nsqlite_file = {bot.SQLITE_FILE}\n")
+                elapsed, processed = run_sharded(shards, updates, users_count, operators_count, latency_ms)
+                conn = sqlite3.connect(bot.SQLITE_FILE)
+                queued, unique = conn.execute("SELECT COUNT(*), COUNT(DISTINCT id) FROM queue").fetchone()
+                conn.close()
+            finally:
+                os.chdir(cwd)
+        results[shards] = (elapsed, processed, queued, unique)
+        shards *= 2
+    
+    print(f"Обновлений: {count} от {users_count} пользователей, операторов: {operators_count}, "
+          f"задержка API: {latency_ms} мс, ядер: {os.cpu_count()}")
+    base = count / results[1][0]
+    for shards, (elapsed, processed, queued, unique) in results.items():
+        rate = count / elapsed
+        print(f"процессов {shards:2} {elapsed:7.2f} сек, {rate:8.1f} обновл./сек (x{rate / base:.2f}), "
+              f"в общей очереди {queued}, номера {'уникальны' if unique == queued else 'ПОВТОРЯЮТСЯ'}")
+        assert processed == count and queued == unique == count
+
+# =============================
+# ИТОГИ ИСТОРИИ
+# =============================
+
+def check_totals(users_count):
+    """Итоги истории совпадают с пересчетом по самой истории"""
+    counts = bot.storage.count_history()
+    assert bot.storage.message_totals() == (sum(total for total, _ in counts.values()),
+                                            sum(answered for _, answered in counts.values()))
+    assert tuple(bot.storage.history_size()) == (len(counts), sum(total for total, _ in counts.values()))
+    for user_id in range(1, users_count + 1):
+        total, answered = counts.get(user_id, (0, 0))
+        assert bot.storage.unanswered_count(user_id) == total - answered, user_id
+
+def random_history_ops(rng, operations, users_count, storages):
+    """Случайные изменения истории: сообщения, ответы, лимит, фоновая очистка и полная очистка
+    
+    Каждую операцию выполняет случайное из storages - как процессы режима sharded с общей базой:
+    у каждого процесса свои итоги в памяти, сверяются итоги первого.
+    """
+    process_totals = [bot.history_totals] + [bot.HistoryTotals() for _ in storages[1:]]
+    for _ in range(operations):
+        index = rng.randrange(len(storages))
+        storage = storages[index]
+        bot.history_totals = process_totals[index]
+        user_id = rng.randint(1, users_count)
+        op = rng.random()
+        if op < 0.6:
+            storage.add_message(user_id, {'text': 'x', 'time': time.time(), 'answered': rng.random() < 0.1})
+        elif op < 0.8:
+            storage.mark_answered(user_id)
+        elif op < 0.85:
+            storage.mark_answered(user_id, all_messages=True)
+        elif op < 0.95:
+            bot.system_settings['history_max_messages'] = rng.choice([0, 0, 3, 10])
+            storage.sweep_history(rng.randint(1, 20))
+        elif op < 0.952:
+            storage.clear_history()
+        bot.history_totals = process_totals[0]
+        check_totals(users_count)
+
+def open_storages(backend):
+    """Хранилища для прогона: json и sqlite - одно, sharded - два процесса на одной базе"""
+    if backend == 'json':
+        storages = [bot.JsonStorage()]
+    elif backend == 'sqlite':
+        storages = [bot.SqliteStorage(bot.SQLITE_FILE)]
+    else:
+        storages = [bot.SqliteStorage(bot.SQLITE_FILE, autocommit=True) for _ in range(2)]
+    for storage in storages:
+        # После загрузки итоги пересчитываются через bot.storage
+        bot.storage = storage
+        storage.load()
+    return storages
+
+def bench_totals(operations=3000, users_count=50):
+    """Итоги истории во всех хранилищах: сверка с пересчетом после каждой операции и после перезагрузки"""
+    cwd = os.getcwd()
+    saved_storage = bot.storage
+    saved_limit = bot.system_settings['history_max_messages']
+    try:
+        for backend in ('json', 'sqlite', 'sharded'):
+            with tempfile.TemporaryDirectory() as tmp:
+                os.chdir(tmp)
+                try:
+                    rng = random.Random(1)
+                    storages = open_storages(backend)
+                    # Сверяет координатор - первый процесс
+                    bot.storage = storages[0]
+                    started = time.perf_counter()
+                    random_history_ops(rng, operations, users_count, storages)
+                    elapsed = time.perf_counter() - started
+                    
+                    before = bot.storage.message_totals(), tuple(bot.storage.history_size())
+                    for storage in storages:
+                        storage.write_pending()
+                        if backend != 'json':
+                            storage.conn.close()
+                    bot.storage = open_storages(backend)[0]
+                    assert (bot.storage.message_totals(), tuple(bot.storage.history_size())) == before
+                    check_totals(users_count)
+                    if backend != 'json':
+                        bot.storage.conn.close()
+                finally:
+                    os.chdir(cwd)
+            total, answered = before[0]
+            print(f"{backend:7}: {operations} операций, {users_count} пользователей - итоги совпадают с пересчетом "
+                  f"(сообщений {total}, отвеченных {answered}), {elapsed * 1e3 / operations:.2f} мс/операцию со сверкой")
+    finally:
+        bot.storage = saved_storage
+        bot.system_settings['history_max_messages'] = saved_limit
+
+# =============================
+# РЕЙТИНГ ОПЕРАТОРОВ
+# =============================
+
+def brute_rank(scores, operator_id):
+    """Место перебором: 1 + число операторов с большим счетом"""
+    score = scores.get(operator_id, 0)
+    return 1 + sum(1 for other in scores.values() if other > score)
+
+def check_ranks(operators_count):
+    """Места во всех рейтингах совпадают с перебором по operator_stats"""
+    days = bot.moscow_days(7)
+    boards = {
+        'all': {op: stats['answered'] for op, stats in bot.operator_stats.items()},
+        'day': {op: stats['daily'].get(days[0], 0) for op, stats in bot.operator_stats.items()},
+        'week': {op: sum(stats['daily'].get(day, 0) for day in days) for op, stats in bot.operator_stats.items()}
+    }
+    for window, scores in boards.items():
+        for operator_id in range(1, operators_count + 1):
+            assert bot.get_operator_rank(operator_id, window) == brute_rank(scores, operator_id), (window, operator_id)
+        top = [score for _, score in bot.leaderboard_top(window, 3)]
+        assert top == sorted((score for score in scores.values() if score), reverse=True)[:3], window
+
+def legacy_rank(operator_id):
+    """Прежний поиск места: сортировка всех операторов на каждый запрос"""
+    ranked = sorted(bot.operator_stats.items(), key=lambda item: item[1].get('answered', 0), reverse=True)
+    for place, (op_id, _) in enumerate(ranked, 1):
+        if op_id == operator_id:
+            return place
+    return len(ranked) + 1
+
+def bench_leaderboard(operators_count=300, answers=5000, rollovers=5):
+    """Рейтинг операторов: места против перебора, со сменой дня и перезагрузкой"""
+    rng = random.Random(1)
+    start = date(2026, 1, 1)
+    shift = 0
+    real_days = bot.moscow_days
+    # Дни по московскому времени сдвигаем вручную, чтобы пройти смену дня за один прогон
+    bot.moscow_days = lambda count: [(start + timedelta(days=shift - i)).isoformat() for i in range(count)]
+    bot.operator_stats.clear()
+    bot.rebuild_indexes()
+    elapsed = 0.0
+    try:
+        for i in range(1, answers + 1):
+            operator_id = rng.randint(1, operators_count)
+            started = time.perf_counter()
+            bot.record_answer(operator_id)
+            elapsed += time.perf_counter() - started
+            if i % (answers // rollovers) == 0:
+                check_ranks(operators_count)
+                shift += 1
+                # День сменился в обход часов - сбрасываем запомненный конец дня
+                bot.leaderboard_day_ends = 0
+                check_ranks(operators_count)
+        # После загрузки рейтинги строятся заново из operator_stats
+        bot.rebuild_indexes()
+        check_ranks(operators_count)
+    finally:
+        bot.moscow_days = real_days
+    
+    # Время поиска места - с настоящей датой по часовому поясу; пересчет рейтингов на новый день - раз в сутки
+    bot.leaderboard_day_ends = 0
+    bot.refresh_window_boards()
+    started = time.perf_counter()
+    for operator_id in range(1, operators_count + 1):
+        bot.get_operator_rank(operator_id, 'week')
+    rank_time = time.perf_counter() - started
+    started = time.perf_counter()
+    for operator_id in range(1, operators_count + 1):
+        legacy_rank(operator_id)
+    sort_time = time.perf_counter() - started
+    
+    print(f"Операторов: {operators_count}, ответов: {answers}, смен дня: {rollovers}")
+    print(f"Места во всех рейтингах совпадают с перебором; ответ {elapsed * 1e6 / answers:.1f} мкс")
+    print(f"Место оператора: рейтинг {rank_time * 1e6 / operators_count:.1f} мкс, "
+          f"сортировка {sort_time * 1e6 / operators_count:.1f} мкс")
+
+BENCHMARKS = {
+    'snapshot': bench_snapshot,
+    'queue': bench_queue,
+    'fairness': bench_fairness,
+    'runtime': bench_runtime,
+    'fanout': bench_fanout,
+    'priority': bench_priority,
+    'webhook': bench_webhook,
+    'shards': bench_shards,
+    'totals': bench_totals,
+    'leaderboard': bench_leaderboard,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"Использование: python bench.py <{'|'.join(BENCHMARKS)}> [параметры]")
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*map(int, sys.argv[2:]))
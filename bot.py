@@ -1,14 +1,33 @@
 # -*- coding: utf-8 -*-
 import telebot
-from telebot import types
+from telebot import types, apihelper
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 import configparser
 import random
 import time
 import sys
 import os
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 import pytz
 import json
+import bisect
+import heapq
+import hmac
+import secrets
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from collections import deque, OrderedDict
+import pickle
+import copy
+import sqlite3
+import multiprocessing
+import signal
+import functools
 
 # Настройка кодировки
 sys.stdout.reconfigure(encoding='utf-8')
@@ -22,18 +41,381 @@ operators = [int(x) for x in operators.split(',') if x.strip()]
 WAIT_TIME = int(config.get('BotConfig', 'time_wait_for_send_message', fallback=60))
 ADMIN_ID = int(config.get('BotConfig', 'admin_id', fallback='0'))
 CONFIG_FILE = 'config.ini'
-DATA_FILE = 'bot_data.json'
+DATA_FILE = 'bot_data.json'  # Старый формат снимка, читается только для миграции
+SNAPSHOT_FILE = 'bot_data.snapshot'
+SNAPSHOT_MAGIC = b'BOTSNAP'
+SNAPSHOT_VERSION = 1
+JOURNAL_FILE = 'bot_data.journal'
+JOURNAL_COMPACT_RATIO = 0.5  # Журнал сворачивается в снимок, когда дорастет до этой доли снимка
+JOURNAL_COMPACT_MIN_BYTES = 1 << 20  # ...но не раньше, чем в нем наберется столько байт
+STORAGE_BACKEND = config.get('Storage', 'backend', fallback='json')  # json или sqlite
+SQLITE_FILE = config.get('Storage', 'sqlite_file', fallback='bot_data.sqlite3')
+WRITE_DELAY = float(config.get('Storage', 'write_delay', fallback='0.5'))  # Окно объединения записей, сек
+HISTORY_SWEEP_INTERVAL = 60  # Период фоновой очистки истории, сек
+HISTORY_SWEEP_BATCH = 500  # Пользователей (или сообщений SQLite) за один проход
+CLAIM_REAPER_INTERVAL = 30  # Период проверки просроченных закреплений, сек
+LATENCY_BOUNDS = (5, 15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 21600, 86400)  # Интервалы гистограмм задержек, сек
+LOAD_FIELDS = ('arrivals', 'claims', 'replies', 'rejects')  # Счетчики рядов нагрузки
+LOAD_RESOLUTIONS = {'m': (60, 1440), 'h': (3600, 720), 'd': (86400, 366)}  # Ряд: (интервал, сек; сколько интервалов хранить)
+MOSCOW_OFFSET = 3 * 3600  # Дневные интервалы начинаются в полночь по Москве (UTC+3 круглый год)
+RUNTIME_MODE = config.get('Runtime', 'mode', fallback='polling')  # polling, async (опрос и отправки на asyncio), webhook или sharded
+WORKERS = int(config.get('Runtime', 'workers', fallback='8'))  # Потоков обработки обновлений
+FANOUT_WORKERS = int(config.get('Runtime', 'fanout_workers', fallback='8'))  # Одновременных отправок вне async-режима
+DETACHED_WORKERS = FANOUT_WORKERS  # Потоков для фоновых уведомлений (send_detached) вне async-режима
+SHARDS = int(config.get('Runtime', 'shards', fallback='0')) or os.cpu_count() or 1  # Процессов в режиме sharded
+SHARD_SYNC_INTERVAL = 0.2  # Как часто координатор забирает новые сообщения из общей очереди, сек
+SHARD_REFRESH_INTERVAL = 5  # Как часто процессы перечитывают настройки и шаблоны, сек
+SHARD_USERS_REFRESH = 60  # Как часто координатор перечитывает всех пользователей, сек
+SHUTDOWN_TIMEOUT = float(config.get('Runtime', 'shutdown_timeout', fallback='30'))  # Дообработка при остановке, сек
+WEBHOOK_HOST = config.get('Webhook', 'host', fallback='127.0.0.1')  # Снаружи - через обратный прокси
+WEBHOOK_PORT = int(config.get('Webhook', 'port', fallback='8443'))
+WEBHOOK_PATH = config.get('Webhook', 'path', fallback='/telegram')
+WEBHOOK_URL = config.get('Webhook', 'url', fallback='')  # Публичный адрес для setWebhook (пусто - не регистрировать)
+WEBHOOK_SECRET = config.get('Webhook', 'secret_token', fallback='')  # Пусто - создается при регистрации вебхука
+WEBHOOK_QUEUE_SIZE = int(config.get('Webhook', 'queue_size', fallback='1000'))  # Необработанных обновлений до ответа 503
+WEBHOOK_MAX_BODY = 1024 * 1024  # Предел размера одного обновления, байт
+METRICS_ENABLED = config.getboolean('Metrics', 'enabled', fallback=False)  # HTTP /metrics для Prometheus
+METRICS_HOST = config.get('Metrics', 'host', fallback='127.0.0.1')
+METRICS_PORT = int(config.get('Metrics', 'port', fallback='9108'))  # В режиме sharded процесс N слушает port + N
+METRICS_BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # Интервалы гистограмм метрик, сек
+MEDIA_CACHE_SIZE = 10000  # Файлов в кэше file_unique_id -> file_id
+MEDIA_ALBUM_DELAY = 1.0  # Сколько ждать остальные части альбома, сек
+BROADCAST_BATCH = int(config.get('Broadcast', 'batch', fallback='8'))  # Получателей в одной порции рассылки
+BROADCAST_PROGRESS_INTERVAL = float(config.get('Broadcast', 'progress_interval', fallback='3'))  # Обновление прогресса, сек
+BROADCAST_KEEP_FINISHED = 20  # Сколько завершенных рассылок хранить
+TRANSPORT_POOL_SIZE = int(config.get('Transport', 'pool_size', fallback='16'))  # Соединений с API в пуле
+TRANSPORT_CONNECT_TIMEOUT = float(config.get('Transport', 'connect_timeout', fallback='5'))  # Сек
+TRANSPORT_READ_TIMEOUT = float(config.get('Transport', 'read_timeout', fallback='20'))  # Сек (getUpdates - дольше)
+TRANSPORT_RETRIES = int(config.get('Transport', 'retries', fallback='3'))  # Повторов при сетевых сбоях
+TRANSPORT_BACKOFF = float(config.get('Transport', 'backoff', fallback='0.5'))  # Базовая пауза перед повтором, сек
+TRANSPORT_BACKOFF_MAX = float(config.get('Transport', 'backoff_max', fallback='8'))  # Наибольшая пауза, сек
+OUTBOX_GLOBAL_RATE = float(config.get('Outbox', 'global_rate', fallback='30'))  # Сообщений в секунду на весь бот
+OUTBOX_CHAT_RATE = float(config.get('Outbox', 'chat_rate', fallback='1'))  # Сообщений в секунду в один чат
+OUTBOX_CHAT_BURST = int(config.get('Outbox', 'chat_burst', fallback='3'))  # Сообщений подряд в один чат без паузы
+OUTBOX_RETRIES = int(config.get('Outbox', 'retries', fallback='3'))  # Повторов после ответа 429
+
+# Приоритеты исходящих сообщений (меньше - раньше)
+PRIORITY_HIGH = 0  # Ответы операторов пользователям
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2  # Рассылки
 
 # Инициализация бота
 bot = telebot.TeleBot(BOT_TOKEN)
+shard_index = None  # Номер процесса в режиме sharded (0 - координатор операторов), None - один процесс
+stopping = threading.Event()  # Получен сигнал остановки: новые обновления не принимаем
+interruptible = threading.Event()  # Главный поток ждет getUpdates или вебхук - его можно прервать сразу
+async_bot = None  # AsyncTeleBot, если бот запущен через run_bot_async()
+async_loop = None
+
+# =============================
+# ОЧЕРЕДЬ СООБЩЕНИЙ
+# =============================
+
+class MessageQueue:
+    """Очередь сообщений с индексом по пользователям и учетом взятых в работу"""
+    
+    def __init__(self, messages=()):
+        self.items = deque()  # Все сообщения в порядке поступления
+        self.dead = set()  # ID удаленных сообщений, еще лежащих в self.items
+        self.by_user = {}  # user_id: deque сообщений пользователя
+        self.ready = OrderedDict()  # Пользователи с сообщениями, которых никто не взял (порядок round_robin)
+        self.heads = []  # Куча (ID первого сообщения, user_id) для fifo; устаревшие записи пропускаются
+        self.claimed = {}  # user_id: operator_id
+        self.mode = 'fifo'  # fifo - по старшинству сообщений, round_robin - пользователи по кругу
+        self.size = 0
+        for msg in messages:
+            self.push(msg)
+    
+    def __len__(self):
+        return self.size
+    
+    def __iter__(self):
+        return (msg for msg in self.items if msg['id'] not in self.dead)
+    
+    def push(self, msg):
+        """Добавить сообщение в конец очереди"""
+        user_id = msg['user_id']
+        self.items.append(msg)
+        if user_id not in self.by_user:
+            self.by_user[user_id] = deque([msg])
+            if user_id not in self.claimed:
+                self.mark_ready(user_id)
+        else:
+            self.by_user[user_id].append(msg)
+        self.size += 1
+    
+    def mark_ready(self, user_id):
+        """Поставить пользователя в ожидание (или обновить его первое сообщение в куче fifo)"""
+        self.ready[user_id] = None
+        heapq.heappush(self.heads, (self.by_user[user_id][0]['id'], user_id))
+        if len(self.heads) > 2 * len(self.ready) + 64:
+            self.heads = [(self.by_user[ready_id][0]['id'], ready_id) for ready_id in self.ready]
+            heapq.heapify(self.heads)
+    
+    def pop_oldest(self):
+        """Удалить самое старое сообщение"""
+        self.skip_dead()
+        if not self.items:
+            return None
+        msg = self.items.popleft()
+        self.drop_user_head(msg['user_id'])
+        return msg
+    
+    def complete(self, user_id):
+        """Удалить самое старое сообщение пользователя"""
+        if user_id not in self.by_user:
+            return None
+        msg = self.by_user[user_id][0]
+        self.drop_user_head(user_id)
+        self.dead.add(msg['id'])
+        self.compact()
+        return msg
+    
+    def remove_user(self, user_id):
+        """Удалить все сообщения пользователя, вернуть их ID"""
+        msgs = self.by_user.pop(user_id, ())
+        self.ready.pop(user_id, None)
+        ids = [msg['id'] for msg in msgs]
+        self.dead.update(ids)
+        self.size -= len(ids)
+        self.compact()
+        return ids
+    
+    def drop_user_head(self, user_id):
+        msgs = self.by_user[user_id]
+        msgs.popleft()
+        self.size -= 1
+        if not msgs:
+            del self.by_user[user_id]
+            self.ready.pop(user_id, None)
+        elif user_id in self.ready:
+            self.mark_ready(user_id)
+    
+    def skip_dead(self):
+        while self.items and self.items[0]['id'] in self.dead:
+            self.dead.discard(self.items.popleft()['id'])
+    
+    def compact(self):
+        """Выбросить удаленные сообщения, когда их больше живых"""
+        if len(self.dead) > self.size + 64:
+            self.items = deque(msg for msg in self.items if msg['id'] not in self.dead)
+            self.dead.clear()
+    
+    def oldest(self):
+        """Самое старое сообщение в очереди"""
+        self.skip_dead()
+        return self.items[0] if self.items else None
+    
+    def claim(self, operator_id):
+        """Взять в работу следующего свободного пользователя, вернуть его старейшее сообщение"""
+        if not self.ready:
+            return None
+        if self.mode == 'round_robin':
+            user_id, _ = self.ready.popitem(last=False)
+        else:
+            # Пользователь с самым старым сообщением; записи ушедших и сменивших первое сообщение пропускаем
+            while True:
+                head_id, user_id = heapq.heappop(self.heads)
+                if user_id in self.ready and self.by_user[user_id][0]['id'] == head_id:
+                    break
+            del self.ready[user_id]
+        self.claimed[user_id] = operator_id
+        return self.by_user[user_id][0]
+    
+    def claim_user(self, user_id, operator_id):
+        """Закрепить конкретного пользователя за оператором"""
+        self.ready.pop(user_id, None)
+        self.claimed[user_id] = operator_id
+    
+    def release(self, user_id, operator_id):
+        """Вернуть пользователя в очередь, если его держит этот оператор"""
+        if self.claimed.get(user_id) != operator_id:
+            return
+        del self.claimed[user_id]
+        if user_id in self.by_user:
+            # fifo: место по первому сообщению, round_robin: в конец круга
+            self.mark_ready(user_id)
+    
+    def clear(self):
+        """Очистить очередь, не трогая закрепления операторов"""
+        self.items.clear()
+        self.dead.clear()
+        self.by_user.clear()
+        self.ready.clear()
+        self.heads.clear()
+        self.size = 0
+
+# =============================
+# ИНДЕКСЫ АКТИВНОСТИ И ИТОГИ
+# =============================
+
+class TimeBuckets:
+    """Число событий за последние window сек по интервалам в bucket сек, без обхода пользователей
+    
+    Счет с точностью до одного интервала: самый старый интервал окна учитывается целиком.
+    """
+    
+    def __init__(self, bucket, window):
+        self.bucket = bucket
+        self.window = window
+        self.lock = threading.Lock()
+        self.counts = {}  # Номер интервала: событий в нем
+    
+    def oldest(self, now):
+        """Номер самого старого интервала, еще входящего в окно"""
+        return int((now - self.window) // self.bucket)
+    
+    def add(self, t, delta=1):
+        key = int(t // self.bucket)
+        with self.lock:
+            # Событие уже за окном (или его интервал удален) - считать нечего
+            if key < self.oldest(time.time()):
+                return
+            count = self.counts.get(key, 0) + delta
+            if count:
+                self.counts[key] = count
+            else:
+                self.counts.pop(key, None)
+    
+    def move(self, old, new):
+        """Перенести событие из момента old в new (например, время последнего сообщения)"""
+        self.add(old, -1)
+        self.add(new)
+    
+    def count(self):
+        oldest = self.oldest(time.time())
+        with self.lock:
+            for key in [key for key in self.counts if key < oldest]:
+                del self.counts[key]
+            return sum(self.counts.values())
+    
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+class Leaderboard:
+    """Рейтинг операторов: отсортированный список (-ответов, operator_id)
+    
+    Место ищется бисекцией за O(log n), топ - срез списка. Обновление счета - O(n): удаление и вставка
+    в список сдвигают его хвост, но при десятках и сотнях операторов это доли микросекунды.
+    """
+    
+    def __init__(self):
+        self.entries = []
+        self.scores = {}  # operator_id: ответов
+    
+    def set(self, operator_id, score):
+        old = self.scores.get(operator_id)
+        if old is not None:
+            del self.entries[bisect.bisect_left(self.entries, (-old, operator_id))]
+        self.scores[operator_id] = score
+        bisect.insort(self.entries, (-score, operator_id))
+    
+    def add(self, operator_id, delta=1):
+        self.set(operator_id, self.scores.get(operator_id, 0) + delta)
+    
+    def rank(self, operator_id):
+        """Место оператора: 1 + число операторов с большим счетом (равные делят место)"""
+        score = self.scores.get(operator_id, 0)
+        return bisect.bisect_left(self.entries, (-score, float('-inf'))) + 1
+    
+    def top(self, count):
+        """Первые count операторов: [(operator_id, ответов)]"""
+        return [(operator_id, -score) for score, operator_id in self.entries[:count]]
+    
+    def clear(self):
+        self.entries.clear()
+        self.scores.clear()
+
+class HistoryTotals:
+    """Итоги истории сообщений: хранилища поправляют их при каждом изменении истории"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total = 0
+        self.answered = 0
+        self.by_user = {}  # user_id: [сообщений, из них неотвеченных]
+    
+    def add(self, user_id, answered=False):
+        with self.lock:
+            counts = self.by_user.setdefault(user_id, [0, 0])
+            counts[0] += 1
+            self.total += 1
+            if answered:
+                self.answered += 1
+            else:
+                counts[1] += 1
+    
+    def answer(self, user_id, count):
+        """count неотвеченных сообщений пользователя стали отвеченными"""
+        if not count:
+            return
+        with self.lock:
+            self.by_user[user_id][1] -= count
+            self.answered += count
+    
+    def remove(self, user_id, count, answered):
+        """Удалено count сообщений пользователя, из них answered отвеченных"""
+        with self.lock:
+            counts = self.by_user[user_id]
+            counts[0] -= count
+            counts[1] -= count - answered
+            self.total -= count
+            self.answered -= answered
+            if not counts[0]:
+                del self.by_user[user_id]
+    
+    def rebuild(self, counts):
+        """Пересчитать по {user_id: (сообщений, отвеченных)}"""
+        with self.lock:
+            self.by_user = {user_id: [total, total - answered] for user_id, (total, answered) in counts.items() if total}
+            self.total = sum(total for total, _ in counts.values())
+            self.answered = sum(answered for _, answered in counts.values())
+    
+    def clear(self):
+        self.rebuild({})
+    
+    def unanswered(self, user_id):
+        with self.lock:
+            return self.by_user.get(user_id, (0, 0))[1]
+    
+    def totals(self):
+        """Всего сообщений и из них отвеченных"""
+        with self.lock:
+            return self.total, self.answered
+    
+    def size(self):
+        """Пользователей с историей и сообщений в ней"""
+        with self.lock:
+            return len(self.by_user), self.total
+
+class ShutdownRequested(BaseException):
+    """Прерывает ожидание обновлений в главном потоке по сигналу остановки"""
 
 # Хранилище данных
 users = {}  # user_id: {'captcha': bool, 'last_msg': time, 'username': str}
 waiting_answers = {}  # operator_id: {'user_id': int, 'waiting': bool}
-messages_queue = []  # [{'user_id': int, 'text': str, 'type': str, 'time': float}]
+messages_queue = MessageQueue()  # [{'id': int, 'user_id': int, 'text': str, 'type': str, 'time': float}]
+queue_seq = 0  # Последний выданный ID сообщения в очереди
 user_messages = {}  # user_id: [{'text': str, 'time': float, 'answered': bool}]
-operator_stats = {}  # operator_id: {'answered': int, 'response_time': float}
+operator_stats = {}  # operator_id: {'answered': int, 'wait': гистограмма, 'reply': гистограмма}
 answer_templates = {}  # Шаблоны ответов
+media_files = {}  # file_unique_id: [тип, file_id] - уже известные Telegram файлы
+broadcast_jobs = {}  # job_id: {'text', 'admin_id', 'status', 'cursor', 'sent', 'failed', 'total', ...}
+online_index = TimeBuckets(60, 3600)  # Пользователи, писавшие за последний час (по last_msg)
+joined_index = TimeBuckets(60, 86400)  # Пользователи, пришедшие за сутки (по joined)
+answers_total = 0  # Сумма 'answered' по всем операторам
+history_totals = HistoryTotals()  # Сообщений в истории: всего, отвеченных, неотвеченных у каждого
+# Рейтинги: 'all' - за все время, 'day' - за сегодня, 'week' - за 7 дней (по московскому времени)
+leaderboards = {'all': Leaderboard(), 'day': Leaderboard(), 'week': Leaderboard()}
+leaderboard_day = None  # День, на который посчитаны рейтинги 'day' и 'week'
+leaderboard_day_ends = 0  # Когда этот день закончится (time.time()) - до тех пор дату не пересчитываем
+# Гистограммы задержек по всем операторам: 'wait' - от очереди до взятия, 'reply' - от взятия до ответа
+latency_totals = {kind: {'counts': [0] * (len(LATENCY_BOUNDS) + 1), 'sum': 0.0} for kind in ('wait', 'reply')}
+# Ряды нагрузки: 'm:<начало>', 'h:<начало>', 'd:<начало>' -> итог интервала (см. new_load_bucket)
+load_series = {}
+load_minute = None  # Начало текущей, еще не записанной минуты
+load_current = [0] * 7  # Итог текущей минуты
 system_settings = {  # Настройки системы
     'auto_greet': True,
     'notify_operators': True,
@@ -41,9 +423,317 @@ system_settings = {  # Настройки системы
     'captcha_enabled': True,
     'work_hours_start': 9,
     'work_hours_end': 21,
-    'work_hours_enabled': False
+    'work_hours_enabled': False,
+    'history_max_messages': 0,  # Сообщений в истории одного пользователя (0 - без лимита)
+    'history_max_days': 0,  # Срок хранения истории в днях (0 - без лимита)
+    'queue_mode': 'fifo',  # fifo или round_robin (обслуживать пользователей по кругу)
+    'claim_lease_minutes': 15  # Сколько сообщение закреплено за оператором (0 - бессрочно)
 }
 
+# Журнал изменений (между снимками bot_data.json)
+journal_lock = threading.RLock()
+journal_io_lock = threading.Lock()  # Берется до journal_lock, держится на время записи файла
+journal_file = None  # Открытый на дозапись файл журнала
+journal_buffer = []  # Записи, еще не сброшенные на диск
+journal_seq = 0  # Номер последней записи журнала
+journal_pending = 0  # Записей с момента последнего снимка
+journal_bytes = 0  # Байт журнала с момента последнего снимка
+snapshot_bytes = 0  # Размер последнего снимка
+journal_compacting = False
+
+# Общий замок состояния: очередь, закрепления, история и статистика операторов.
+# Порядок захвата: state_lock -> journal_io_lock -> journal_lock
+state_lock = threading.RLock()
+
+# =============================
+# HTTP-ТРАНСПОРТ BOT API
+# =============================
+
+class ApiTransport:
+    """Запросы к Bot API через общий пул keep-alive соединений с повторами и замером задержек"""
+    
+    # Повтор этих методов не создаст дубликатов в чате
+    IDEMPOTENT = {
+        'getMe', 'getUpdates', 'getChat', 'getFile', 'getChatMember', 'getWebhookInfo',
+        'setWebhook', 'deleteWebhook', 'editMessageText', 'editMessageReplyMarkup',
+        'answerCallbackQuery', 'deleteMessage'
+    }
+    
+    def __init__(self, pool_size, connect_timeout, read_timeout, retries, backoff, backoff_max):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.lock = threading.Lock()
+        self.stats = {}  # Метод API: {'calls', 'errors', 'retries', 'total', 'max'}
+        self.async_slots = None  # Семафор async-режима: не больше pool_size запросов сразу, как у пула потоков
+    
+    def delay(self, attempt):
+        """Экспоненциальная пауза со случайным разбросом, чтобы повторы не шли волной"""
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+    
+    @staticmethod
+    def not_sent(error):
+        """Соединение не установлено - запрос точно не дошел до Telegram"""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(error, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+    
+    def account(self, api_method, elapsed, retries, failed, status):
+        """Учесть вызов; status - код ответа HTTP или 'network', если ответа нет"""
+        labels = (('method', api_method),)
+        metrics.observe('bot_api_request_duration_seconds', elapsed, labels)
+        if status == 'network' or status >= 400:
+            metrics.inc('bot_api_errors_total', labels + (('code', str(status)),))
+        with self.lock:
+            stats = self.stats.setdefault(api_method, {'calls': 0, 'errors': 0, 'retries': 0, 'total': 0.0, 'max': 0.0})
+            stats['calls'] += 1
+            stats['errors'] += failed
+            stats['retries'] += retries
+            stats['total'] += elapsed
+            stats['max'] = max(stats['max'], elapsed)
+    
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        """Замена apihelper.CUSTOM_REQUEST_SENDER"""
+        api_method = url.rsplit('/', 1)[-1]
+        read_timeout = self.read_timeout
+        if api_method == 'getUpdates' and timeout:
+            # Длинный опрос держит соединение дольше обычного запроса
+            read_timeout = max(read_timeout, timeout[1])
+        idempotent = api_method in self.IDEMPOTENT and not files
+        
+        started = time.time()
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(
+                    method, url, params=params, files=files,
+                    timeout=(self.connect_timeout, read_timeout), proxies=proxies
+                )
+                if response.status_code < 500 or not idempotent or attempt >= self.retries:
+                    self.account(api_method, time.time() - started, attempt, response.status_code >= 500,
+                                 response.status_code)
+                    return response
+            except requests.exceptions.RequestException as e:
+                # Неидемпотентный запрос повторяем, только если он точно не был отправлен
+                retryable = idempotent or (self.not_sent(e) and not files)
+                if not retryable or attempt >= self.retries:
+                    self.account(api_method, time.time() - started, attempt, True, 'network')
+                    raise
+            time.sleep(self.delay(attempt))
+            attempt += 1
+    
+    async def arequest(self, method, call):
+        """То же, что request(), для вызова AsyncTeleBot: call() - корутина одного запроса к методу telebot"""
+        from aiohttp import ClientConnectorError
+        
+        if self.async_slots is None:
+            self.async_slots = asyncio.Semaphore(self.pool_size)
+        api_method = api_method_name(method)
+        idempotent = api_method in self.IDEMPOTENT
+        started = time.time()
+        attempt = 0
+        while True:
+            try:
+                async with self.async_slots:
+                    result = await call()
+                self.account(api_method, time.time() - started, attempt, False, 200)
+                return result
+            except Exception as e:
+                status = getattr(e, 'error_code', None)
+                if isinstance(status, int) and status < 500:
+                    # Ответ Telegram (в том числе 429 - его повторяет Outbox) - не сбой сети
+                    self.account(api_method, time.time() - started, attempt, True, status)
+                    raise
+                if status is None:
+                    # AsyncTeleBot оборачивает ошибки aiohttp; без соединения запрос точно не отправлен
+                    status = 'network'
+                    retryable = idempotent or isinstance(e.__cause__, ClientConnectorError)
+                else:
+                    retryable = idempotent
+                if not retryable or attempt >= self.retries:
+                    self.account(api_method, time.time() - started, attempt, True, status)
+                    raise
+            await asyncio.sleep(self.delay(attempt))
+            attempt += 1
+    
+    def slowest(self, count=3):
+        """Методы API с наибольшей средней задержкой: [(метод, среднее, вызовов)]"""
+        with self.lock:
+            averages = [(name, stats['total'] / stats['calls'], stats['calls']) for name, stats in self.stats.items()]
+        return sorted(averages, key=lambda item: item[1], reverse=True)[:count]
+
+transport = ApiTransport(TRANSPORT_POOL_SIZE, TRANSPORT_CONNECT_TIMEOUT, TRANSPORT_READ_TIMEOUT,
+                         TRANSPORT_RETRIES, TRANSPORT_BACKOFF, TRANSPORT_BACKOFF_MAX)
+apihelper.CUSTOM_REQUEST_SENDER = transport.request
+
+# =============================
+# ИСХОДЯЩИЕ СООБЩЕНИЯ
+# =============================
+
+class Outbox:
+    """Единая точка отправки в Telegram: общий лимит, темп на чат, повтор после 429 и приоритеты
+    
+    Вызов tg.send_message(..., priority=PRIORITY_HIGH) ждет своей очереди и выполняется
+    в потоке вызывающего; отдельный поток только выдает разрешения по лимитам.
+    """
+    
+    def __init__(self, global_rate, chat_rate, chat_burst, retries):
+        self.global_interval = 1 / global_rate
+        self.chat_interval = 1 / chat_rate
+        self.chat_tau = (chat_burst - 1) * self.chat_interval  # Допустимое опережение темпа чата
+        self.retries = retries
+        self.cond = threading.Condition()
+        self.tickets = []  # (приоритет, номер, chat_id, grant) по возрастанию
+        self.seq = 0
+        self.global_tat = 0  # Когда общий лимит пропустит следующее сообщение
+        self.chat_tat = {}  # chat_id: теоретическое время следующего сообщения в чат
+        self.thread = None
+        self.stats = {'sent': 0, 'throttled': 0, 'failed': 0, 'max_wait': 0.0}
+    
+    @staticmethod
+    def chat_of(method, args, kwargs):
+        """Чат, в который идет вызов (None - только общий лимит)"""
+        if method == 'answer_callback_query':
+            return None
+        return kwargs.get('chat_id', args[0] if args else None)
+    
+    @staticmethod
+    def retry_after(error):
+        """Пауза из ответа 429 или None для остальных ошибок"""
+        if getattr(error, 'error_code', None) != 429:
+            return None
+        return error.result_json.get('parameters', {}).get('retry_after', 1)
+    
+    def ready_at(self, chat_id):
+        if chat_id is None:
+            return 0
+        return self.chat_tat.get(chat_id, 0) - self.chat_tau
+    
+    def run(self):
+        """Выдавать разрешения на отправку в порядке приоритета, соблюдая лимиты"""
+        with self.cond:
+            while True:
+                if not self.tickets:
+                    self.cond.wait()
+                    continue
+                now = time.monotonic()
+                if self.global_tat > now:
+                    self.cond.wait(self.global_tat - now)
+                    continue
+                
+                # Первый по приоритету вызов, чей чат уже можно беспокоить
+                earliest = None
+                for index, ticket in enumerate(self.tickets):
+                    ready_at = self.ready_at(ticket[2])
+                    if ready_at <= now:
+                        break
+                    earliest = ready_at if earliest is None else min(earliest, ready_at)
+                else:
+                    self.cond.wait(earliest - now)
+                    continue
+                
+                _, _, chat_id, grant = self.tickets.pop(index)
+                self.global_tat = max(self.global_tat, now) + self.global_interval
+                if chat_id is not None:
+                    self.chat_tat[chat_id] = max(self.chat_tat.get(chat_id, 0), now) + self.chat_interval
+                    if len(self.chat_tat) > 10000:
+                        self.chat_tat = {chat: tat for chat, tat in self.chat_tat.items() if tat > now}
+                grant()
+    
+    def enqueue(self, chat_id, priority, grant):
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="outbox", daemon=True)
+                self.thread.start()
+            self.seq += 1
+            bisect.insort(self.tickets, (priority, self.seq, chat_id, grant))
+            self.cond.notify()
+    
+    def throttle(self, chat_id, retry_after):
+        """Telegram ответил 429 - не беспокоить чат (или весь бот) retry_after секунд"""
+        with self.cond:
+            self.stats['throttled'] += 1
+            resume = time.monotonic() + retry_after
+            if chat_id is None:
+                self.global_tat = max(self.global_tat, resume)
+            else:
+                self.chat_tat[chat_id] = max(self.chat_tat.get(chat_id, 0), resume + self.chat_tau)
+            self.cond.notify()
+    
+    def account(self, waited, error=None):
+        with self.cond:
+            self.stats['failed' if error else 'sent'] += 1
+            self.stats['max_wait'] = max(self.stats['max_wait'], waited)
+    
+    def call(self, method, *args, priority=PRIORITY_NORMAL, **kwargs):
+        """Выполнить метод API, дождавшись разрешения; 429 повторяется после паузы"""
+        chat_id = self.chat_of(method, args, kwargs)
+        for attempt in range(self.retries + 1):
+            started = time.monotonic()
+            event = threading.Event()
+            self.enqueue(chat_id, priority, event.set)
+            event.wait()
+            waited = time.monotonic() - started
+            try:
+                result = getattr(bot, method)(*args, **kwargs)
+            except Exception as e:
+                retry_after = self.retry_after(e)
+                if retry_after is None or attempt == self.retries:
+                    self.account(waited, e)
+                    raise
+                self.throttle(chat_id, retry_after)
+                continue
+            self.account(waited)
+            return result
+    
+    async def acall(self, method, *args, priority=PRIORITY_NORMAL, **kwargs):
+        """То же, что call(), для AsyncTeleBot в цикле async-режима"""
+        chat_id = self.chat_of(method, args, kwargs)
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            started = time.monotonic()
+            granted = loop.create_future()
+            self.enqueue(chat_id, priority, lambda: loop.call_soon_threadsafe(granted.set_result, None))
+            await granted
+            waited = time.monotonic() - started
+            try:
+                # Запросы AsyncTeleBot идут мимо requests - повторы, лимит соединений и учет дает transport
+                result = await transport.arequest(method, lambda: getattr(async_bot, method)(*args, **kwargs))
+            except Exception as e:
+                retry_after = self.retry_after(e)
+                if retry_after is None or attempt == self.retries:
+                    self.account(waited, e)
+                    raise
+                self.throttle(chat_id, retry_after)
+                continue
+            self.account(waited)
+            return result
+    
+    def waiting(self):
+        with self.cond:
+            return len(self.tickets)
+    
+    def __getattr__(self, method):
+        return lambda *args, **kwargs: self.call(method, *args, **kwargs)
+
+def api_method_name(method):
+    """Имя метода Bot API по имени метода telebot: send_message -> sendMessage"""
+    first, *rest = method.split('_')
+    return first + ''.join(part.capitalize() for part in rest)
+
+tg = Outbox(OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, OUTBOX_RETRIES)
+fanout_pool = ThreadPoolExecutor(FANOUT_WORKERS, thread_name_prefix="fanout")
+# Уведомления операторам не должны ждать в одной очереди за порциями рассылок
+detached_pool = ThreadPoolExecutor(DETACHED_WORKERS, thread_name_prefix="detached")
+
 # =============================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # =============================
@@ -52,44 +742,281 @@ def is_admin(user_id):
     """Проверить, является ли пользователь администратором"""
     return user_id == ADMIN_ID
 
+def int_key(key):
+    """Ключ из JSON-снимка в виде числа, если это ID"""
+    return int(key) if isinstance(key, str) and key.lstrip('-').isdigit() else key
+
+def data_sections():
+    """Разделы данных, которые попадают в снимок и журнал"""
+    return {
+        'users': users,
+        'user_messages': user_messages,
+        'operator_stats': operator_stats,
+        'answer_templates': answer_templates,
+        'system_settings': system_settings,
+        'broadcast_jobs': broadcast_jobs,
+        'media_files': media_files,
+        'load_series': load_series
+    }
+
+def apply_journal_record(record, queue):
+    """Применить запись журнала к данным в памяти"""
+    op = record['op']
+    
+    if op == 'set':
+        data_sections()[record['section']][record['key']] = record['value']
+    elif op == 'del':
+        data_sections()[record['section']].pop(record['key'], None)
+    elif op == 'clear':
+        data_sections()[record['section']].clear()
+    elif op == 'msg':
+        user_messages.setdefault(record['user_id'], []).append(record['msg'])
+    elif op == 'answer':
+        for msg in user_messages.get(record['user_id'], []):
+            if not msg['answered']:
+                msg['answered'] = True
+                if not record.get('all'):
+                    break
+    elif op == 'trim':
+        msgs = user_messages.get(record['user_id'], [])
+        del msgs[:record['count']]
+        if not msgs:
+            user_messages.pop(record['user_id'], None)
+    elif op == 'queue_add':
+        queue[record['msg']['id']] = record['msg']
+    elif op == 'queue_del':
+        for msg_id in record['ids']:
+            queue.pop(msg_id, None)
+    elif op == 'queue_clear':
+        queue.clear()
+    elif op == 'claim':
+        waiting_answers[record['operator_id']] = record['claim']
+    elif op == 'release':
+        waiting_answers.pop(record['operator_id'], None)
+
+def replay_journal(snapshot_seq):
+    """Догнать снимок записями журнала"""
+    global journal_seq, journal_pending, journal_bytes, messages_queue
+    
+    # Очередь на время проигрывания - словарь, чтобы удалять по ID за O(1)
+    queue = {msg['id']: msg for msg in messages_queue}
+    journal_seq = snapshot_seq
+    for path in (JOURNAL_FILE + '.old', JOURNAL_FILE):
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Оборванная последняя строка после сбоя
+                    continue
+                if record['seq'] <= snapshot_seq:
+                    continue
+                apply_journal_record(record, queue)
+                journal_seq = max(journal_seq, record['seq'])
+                journal_pending += 1
+                journal_bytes += len(line.encode('utf-8'))
+    messages_queue = MessageQueue(queue.values())
+
+def read_snapshot(path):
+    """Прочитать бинарный снимок данных"""
+    with open(path, 'rb') as f:
+        header = f.read(len(SNAPSHOT_MAGIC) + 1)
+        if header[:-1] != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} не является снимком данных бота")
+        if header[-1] != SNAPSHOT_VERSION:
+            raise ValueError(f"Неподдерживаемая версия снимка {header[-1]} в {path}")
+        return pickle.load(f)
+
+def snapshot_sections():
+    """Копия данных для снимка (под state_lock): после нее снимок кодируется без замков
+    
+    Крупные разделы копируются на глубину записей - их значения плоские, мелкие - целиком.
+    """
+    data = {name: copy.deepcopy(section) for name, section in data_sections().items()
+            if name not in ('users', 'user_messages', 'media_files')}
+    data['users'] = {user_id: dict(user) for user_id, user in users.items()}
+    data['user_messages'] = {user_id: [dict(msg) for msg in msgs] for user_id, msgs in user_messages.items()}
+    # Записи media_files только заменяются целиком
+    data['media_files'] = dict(media_files)
+    data['messages_queue'] = [dict(msg) for msg in messages_queue]
+    data['waiting_answers'] = copy.deepcopy(waiting_answers)
+    return data
+
+def encode_snapshot(data):
+    """Бинарный снимок: сигнатура, версия формата и pickle с ключами исходных типов"""
+    return SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]) + pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+def read_json_snapshot(path):
+    """Прочитать снимок старого формата bot_data.json, вернув числовые ID"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    # JSON превращает ключи-ID в строки - возвращаем им тип int
+    for section in ('users', 'user_messages', 'operator_stats', 'waiting_answers'):
+        data[section] = {int_key(key): value for key, value in data.get(section, {}).items()}
+    return data
+
 def load_data():
     """Загрузить данные из файла"""
     global users, user_messages, operator_stats, answer_templates, system_settings
+    global messages_queue, waiting_answers, queue_seq, broadcast_jobs, media_files, load_series, snapshot_bytes
     
     try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                users = data.get('users', {})
-                user_messages = data.get('user_messages', {})
-                operator_stats = data.get('operator_stats', {})
-                answer_templates = data.get('answer_templates', {})
-                # Обновляем настройки системы, сохраняя значения по умолчанию для отсутствующих ключей
-                loaded_settings = data.get('system_settings', {})
-                for key in system_settings:
-                    if key in loaded_settings:
-                        system_settings[key] = loaded_settings[key]
-                print(f"✅ Данные загружены: {len(users)} пользователей")
+        started = time.time()
+        snapshot_seq = 0
+        data = None
+        if os.path.exists(SNAPSHOT_FILE):
+            data = read_snapshot(SNAPSHOT_FILE)
+            snapshot_bytes = os.path.getsize(SNAPSHOT_FILE)
+        elif os.path.exists(DATA_FILE):
+            data = read_json_snapshot(DATA_FILE)
+            print(f"🔄 Миграция {DATA_FILE}: при следующем сохранении данные будут записаны в {SNAPSHOT_FILE}")
+        
+        if data is not None:
+            users = data.get('users', {})
+            user_messages = data.get('user_messages', {})
+            operator_stats = data.get('operator_stats', {})
+            answer_templates = data.get('answer_templates', {})
+            broadcast_jobs = {int_key(key): job for key, job in data.get('broadcast_jobs', {}).items()}
+            media_files = data.get('media_files', {})
+            load_series = data.get('load_series', {})
+            # Обновляем настройки системы, сохраняя значения по умолчанию для отсутствующих ключей
+            loaded_settings = data.get('system_settings', {})
+            for key in system_settings:
+                if key in loaded_settings:
+                    system_settings[key] = loaded_settings[key]
+            messages_queue = MessageQueue(data.get('messages_queue', []))
+            waiting_answers = data.get('waiting_answers', {})
+            snapshot_seq = data.get('journal_seq', 0)
+        
+        replay_journal(snapshot_seq)
+        restore_queue_state()
+        queue_seq = max((msg['id'] for msg in messages_queue), default=0)
+        print(f"✅ Данные загружены: {len(users)} пользователей, из журнала: {journal_pending}")
+        print(f"📬 Очередь восстановлена: {len(messages_queue)} сообщений, "
+              f"{len(waiting_answers)} ответов в работе за {time.time() - started:.2f} сек")
     except Exception as e:
         print(f"❌ Ошибка загрузки данных: {e}")
 
+def journal_write(op, **fields):
+    """Добавить одно изменение в журнал (на диск его сбросит writer)"""
+    global journal_seq, journal_pending, journal_bytes
+    
+    with journal_lock:
+        journal_seq += 1
+        fields['op'] = op
+        fields['seq'] = journal_seq
+        line = json.dumps(fields, ensure_ascii=False) + '\n'
+        journal_buffer.append(line)
+        journal_pending += 1
+        journal_bytes += len(line.encode('utf-8'))
+        # Порог растет со снимком: сжатие стоит O(данных), но и случается реже - на запись выходит O(1)
+        need_compact = (journal_bytes >= max(JOURNAL_COMPACT_MIN_BYTES, snapshot_bytes * JOURNAL_COMPACT_RATIO)
+                        and not journal_compacting)
+    
+    writer.mark_dirty()
+    
+    # Журнал разросся - сворачиваем его в снимок в фоне
+    if need_compact:
+        threading.Thread(target=save_data, daemon=True).start()
+
+def journal_flush():
+    """Записать накопленные записи журнала одним блоком"""
+    global journal_file
+    
+    with journal_io_lock:
+        with journal_lock:
+            lines = journal_buffer[:]
+            journal_buffer.clear()
+        if not lines:
+            return 0
+        if journal_file is None:
+            journal_file = open(JOURNAL_FILE, 'a', encoding='utf-8')
+        journal_file.write(''.join(lines))
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+        return len(lines)
+
+def journal_set(section, key):
+    """Записать в журнал текущее значение ключа раздела"""
+    journal_write('set', section=section, key=key, value=data_sections()[section][key])
+
+def journal_delete(section, key):
+    """Записать в журнал удаление ключа раздела"""
+    journal_write('del', section=section, key=key)
+
+def journal_clear(section):
+    """Записать в журнал очистку раздела"""
+    journal_write('clear', section=section)
+
+def rotate_journal():
+    """Отложить текущий журнал до записи снимка"""
+    global journal_file
+    
+    if journal_file is not None:
+        journal_file.close()
+        journal_file = None
+    if not os.path.exists(JOURNAL_FILE):
+        return
+    if os.path.exists(JOURNAL_FILE + '.old'):
+        # Прошлое сжатие не завершилось - сохраняем его записи
+        with open(JOURNAL_FILE, 'r', encoding='utf-8') as src, \
+                open(JOURNAL_FILE + '.old', 'a', encoding='utf-8') as dst:
+            dst.write(src.read())
+        os.remove(JOURNAL_FILE)
+    else:
+        os.replace(JOURNAL_FILE, JOURNAL_FILE + '.old')
+
 def save_data():
-    """Сохранить данные в файл"""
+    """Сохранить снимок данных и сжать журнал"""
+    global journal_pending, journal_bytes, journal_compacting, journal_file, snapshot_bytes
+    
+    started = time.time()
+    with state_lock, journal_io_lock, journal_lock:
+        if journal_compacting:
+            return True
+        journal_compacting = True
+        try:
+            # Под замками только копия данных - кодирование и запись идут без них
+            data = snapshot_sections()
+            data['journal_seq'] = journal_seq
+            # Несброшенные записи дописываем в журнал, который уходит в .old
+            if journal_buffer:
+                if journal_file is None:
+                    journal_file = open(JOURNAL_FILE, 'a', encoding='utf-8')
+                journal_file.write(''.join(journal_buffer))
+                journal_buffer.clear()
+            rotate_journal()
+            journal_pending = 0
+            journal_bytes = 0
+        except Exception as e:
+            journal_compacting = False
+            print(f"❌ Ошибка сохранения данных: {e}")
+            return False
+    
     try:
-        data = {
-            'users': users,
-            'user_messages': user_messages,
-            'operator_stats': operator_stats,
-            'answer_templates': answer_templates,
-            'system_settings': system_settings
-        }
+        payload = encode_snapshot(data)
+        # Атомарная замена снимка: временный файл + fsync + rename
+        tmp_file = SNAPSHOT_FILE + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, SNAPSHOT_FILE)
         
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # Записи старого журнала уже вошли в снимок
+        if os.path.exists(JOURNAL_FILE + '.old'):
+            os.remove(JOURNAL_FILE + '.old')
+        metrics.observe('bot_save_data_duration_seconds', time.time() - started)
+        metrics.set('bot_save_data_bytes', len(payload))
+        snapshot_bytes = len(payload)
         return True
     except Exception as e:
         print(f"❌ Ошибка сохранения данных: {e}")
         return False
+    finally:
+        journal_compacting = False
 
 def save_config():
     """Сохранить конфигурацию"""
@@ -123,53 +1050,373 @@ def format_user_info(user_id, username="", first_name=""):
     info += f"\n🕒 Время: {get_moscow_time()}"
     return info
 
-def save_message_to_queue(user_id, text, msg_type="text"):
-    """Сохранить сообщение в очередь"""
-    # Проверка на максимальный размер очереди
-    if len(messages_queue) >= system_settings['max_queue_size']:
-        # Удаляем самое старое сообщение
-        if messages_queue:
-            messages_queue.pop(0)
-    
-    messages_queue.append({
-        'user_id': user_id,
-        'text': text,
-        'type': msg_type,
-        'time': time.time()
-    })
-    
-    # Сохраняем в историю пользователя
-    if user_id not in user_messages:
-        user_messages[user_id] = []
-    user_messages[user_id].append({
-        'text': text,
-        'time': time.time(),
-        'answered': False
-    })
+def save_message_to_queue(user_id, text, msg_type="text", media=None):
+    """Сохранить сообщение в очередь (media - file_unique_id вложений)"""
+    global queue_seq
+    
+    with state_lock:
+        queued = {
+            'id': None,
+            'user_id': user_id,
+            'text': text,
+            'type': msg_type,
+            'time': time.time()
+        }
+        if media:
+            queued['media'] = media
+        
+        if shard_index is None:
+            # Проверка на максимальный размер очереди
+            if len(messages_queue) >= system_settings['max_queue_size']:
+                # Удаляем самое старое сообщение
+                evicted = messages_queue.pop_oldest()
+                if evicted:
+                    storage.queue_remove([evicted['id']])
+            
+            queue_seq += 1
+            queued['id'] = queue_seq
+            messages_queue.push(queued)
+            load_event('arrivals')
+        # В режиме sharded ID выдает общая база, а в очередь сообщение заберет координатор
+        storage.queue_add(queued)
+        
+        # Сохраняем в историю пользователя
+        msg = {
+            'text': text,
+            'time': time.time(),
+            'answered': False
+        }
+        storage.add_message(user_id, msg)
+
+def queue_length():
+    """Сообщений в очереди (в режиме sharded - по общей базе)"""
+    if shard_index is None:
+        return len(messages_queue)
+    return storage.queue_size()
 
 def get_next_message_for_operator(operator_id):
     """Получить следующее сообщение для оператора"""
-    if not messages_queue:
+    # Самое старое сообщение пользователя, которому еще не отвечает другой оператор
+    with state_lock:
+        msg = messages_queue.claim(operator_id)
+        if msg:
+            set_claim(operator_id, msg['user_id'], msg)
+    return msg
+
+def set_claim(operator_id, user_id, msg=None):
+    """Закрепить пользователя за оператором; False - пользователю уже отвечает другой оператор"""
+    with state_lock:
+        owner = messages_queue.claimed.get(user_id)
+        if owner is not None and owner != operator_id:
+            return False
+        previous = waiting_answers.get(operator_id)
+        if previous and previous['user_id'] != user_id:
+            messages_queue.release(previous['user_id'], operator_id)
+        
+        now = time.time()
+        if not previous or previous['user_id'] != user_id:
+            # Сколько ждало в очереди самое старое сообщение пользователя
+            queued = messages_queue.by_user.get(user_id)
+            enqueued = msg['time'] if msg else queued[0]['time'] if queued else None
+            if enqueued:
+                record_latency(operator_id, 'wait', now - enqueued)
+            load_event('claims')
+        lease = system_settings.get('claim_lease_minutes', 0)
+        waiting_answers[operator_id] = {
+            'user_id': user_id,
+            'waiting': True,
+            'claimed_at': now,
+            'expires': now + lease * 60 if lease else 0
+        }
+        if msg:
+            waiting_answers[operator_id]['message'] = msg
+        messages_queue.claim_user(user_id, operator_id)
+        storage.save_claim(operator_id)
+    return True
+
+def release_claim(operator_id):
+    """Снять закрепление оператора и вернуть пользователя в очередь"""
+    with state_lock:
+        claim = waiting_answers.pop(operator_id, None)
+        if claim:
+            messages_queue.release(claim['user_id'], operator_id)
+            storage.delete_claim(operator_id)
+    return claim
+
+def new_histogram():
+    """Гистограмма задержек: счетчики по интервалам LATENCY_BOUNDS (последний - дольше) и сумма"""
+    return {'counts': [0] * (len(LATENCY_BOUNDS) + 1), 'sum': 0.0}
+
+def histogram_add(hist, seconds, count=1):
+    hist['counts'][bisect.bisect_left(LATENCY_BOUNDS, seconds)] += count
+    hist['sum'] += seconds * count
+
+def histogram_merge(hist, other):
+    for index, count in enumerate(other['counts']):
+        hist['counts'][index] += count
+    hist['sum'] += other['sum']
+
+def histogram_percentile(hist, p):
+    """Оценка p-го процентиля, сек (линейно внутри интервала); None - нет данных"""
+    total = sum(hist['counts'])
+    if not total:
         return None
-    
-    # Получаем самое старое необработанное сообщение
-    for msg in messages_queue[:20]:  # Берем только последние 20
-        # Проверяем, не отвечает ли уже другой оператор
-        user_id = msg['user_id']
-        if not any(op.get('user_id') == user_id for op in waiting_answers.values()):
-            waiting_answers[operator_id] = {
-                'user_id': user_id,
-                'waiting': True,
-                'message': msg
-            }
-            return msg
-    return None
+    rank = p / 100 * total
+    seen = 0
+    for index, count in enumerate(hist['counts']):
+        if count and seen + count >= rank:
+            lower = LATENCY_BOUNDS[index - 1] if index else 0
+            if index == len(LATENCY_BOUNDS):
+                return lower
+            return lower + (LATENCY_BOUNDS[index] - lower) * (rank - seen) / count
+        seen += count
+
+def format_duration(seconds):
+    if seconds < 60:
+        return f"{seconds:.0f} сек"
+    if seconds < 3600:
+        return f"{seconds / 60:.1f} мин"
+    return f"{seconds / 3600:.1f} ч"
+
+def format_percentiles(hist):
+    """p50 / p95 / p99 гистограммы для вывода"""
+    if not sum(hist['counts']):
+        return "нет данных"
+    return " · ".join(f"p{p} {format_duration(histogram_percentile(hist, p))}" for p in (50, 95, 99))
+
+def operator_entry(operator_id):
+    """Статистика оператора (с гистограммами задержек, даже у записей прошлых версий)"""
+    stats = operator_stats.setdefault(operator_id, {'answered': 0})
+    stats.pop('response_time', None)
+    for kind in ('wait', 'reply'):
+        if kind not in stats:
+            stats[kind] = new_histogram()
+    return stats
+
+def record_latency(operator_id, kind, seconds):
+    """Учесть задержку kind ('wait' или 'reply') в гистограмме оператора и общей"""
+    with state_lock:
+        histogram_add(operator_entry(operator_id)[kind], seconds)
+        histogram_add(latency_totals[kind], seconds)
+        storage.save_operator(operator_id)
+
+def moscow_days(count):
+    """Последние count дней по московскому времени, начиная с сегодняшнего ('ГГГГ-ММ-ДД')"""
+    today = datetime.now(pytz.timezone('Europe/Moscow')).date()
+    return [(today - timedelta(days=i)).isoformat() for i in range(count)]
+
+def refresh_window_boards():
+    """Пересчитать дневной и недельный рейтинги, если наступил новый день"""
+    global leaderboard_day, leaderboard_day_ends
+    
+    # Дата по часовому поясу стоит дороже самого поиска места - считаем ее раз в сутки
+    now = time.time()
+    if now < leaderboard_day_ends:
+        return leaderboard_day
+    days = moscow_days(7)
+    if leaderboard_day != days[0]:
+        with state_lock:
+            leaderboards['day'].clear()
+            leaderboards['week'].clear()
+            # Дневные счетчики операторов - не история сообщений, их не больше 7 на оператора
+            for operator_id, stats in operator_stats.items():
+                daily = stats.get('daily', {})
+                if daily.get(days[0]):
+                    leaderboards['day'].set(operator_id, daily[days[0]])
+                week = sum(daily.get(day, 0) for day in days)
+                if week:
+                    leaderboards['week'].set(operator_id, week)
+            leaderboard_day = days[0]
+    leaderboard_day_ends = (now + MOSCOW_OFFSET) // 86400 * 86400 + 86400 - MOSCOW_OFFSET
+    return leaderboard_day
+
+def record_answer(operator_id):
+    """Засчитать ответ оператору и вернуть его общее число ответов"""
+    global answers_total
+    
+    with state_lock:
+        stats = operator_entry(operator_id)
+        claim = waiting_answers.get(operator_id)
+        if claim and claim.get('claimed_at'):
+            histogram_add(stats['reply'], time.time() - claim['claimed_at'])
+            histogram_add(latency_totals['reply'], time.time() - claim['claimed_at'])
+        stats['answered'] += 1
+        answers_total += 1
+        
+        today = refresh_window_boards()
+        daily = stats.setdefault('daily', {})
+        daily[today] = daily.get(today, 0) + 1
+        if len(daily) > 7:
+            week = set(moscow_days(7))
+            for day in [day for day in daily if day not in week]:
+                del daily[day]
+        leaderboards['all'].set(operator_id, stats['answered'])
+        leaderboards['day'].add(operator_id)
+        leaderboards['week'].add(operator_id)
+        load_event('replies')
+        
+        storage.save_operator(operator_id)
+        return stats['answered']
+
+def finish_answer(operator_id, user_id):
+    """Засчитать ответ пользователю и снять закрепление; вернуть число ответов оператора
+    
+    None - пока ответ отправлялся, срок закрепления истек: ответ не засчитывается. Ответ уже у пользователя,
+    поэтому его сообщение снимается с очереди, если его еще не взял другой оператор.
+    """
+    with state_lock:
+        claim = waiting_answers.get(operator_id)
+        if not claim or claim['user_id'] != user_id:
+            if user_id not in messages_queue.claimed:
+                storage.mark_answered(user_id)
+                answered = messages_queue.complete(user_id)
+                if answered:
+                    storage.queue_remove([answered['id']])
+            return None
+        storage.mark_answered(user_id)
+        total_answered = record_answer(operator_id)
+        answered = messages_queue.complete(user_id)
+        if answered:
+            storage.queue_remove([answered['id']])
+        release_claim(operator_id)
+    return total_answered
+
+def notify_late_answer(operator_id, user_id):
+    with state_lock:
+        owner = messages_queue.claimed.get(user_id)
+    if owner is None:
+        status = "Сообщение снято с очереди, но ответ не засчитан."
+    else:
+        status = f"Пользователю уже отвечает оператор {owner}, ответ не засчитан."
+    tg.send_message(
+        operator_id,
+        f"⌛ *Ответ доставлен, но время на него истекло*\n\n{status}",
+        parse_mode="Markdown",
+        reply_markup=operator_menu()
+    )
+
+def claim_expired(claim):
+    """Срок ответа по закреплению вышел, даже если сборщик еще не вернул его в очередь"""
+    return bool(claim.get('expires')) and claim['expires'] < time.time()
+
+def reap_expired_claims():
+    """Вернуть в очередь сообщения, на которые оператор не ответил вовремя"""
+    now = time.time()
+    with state_lock:
+        expired = [(op, claim['user_id']) for op, claim in waiting_answers.items()
+                   if claim.get('expires') and claim['expires'] < now]
+        for operator_id, _ in expired:
+            release_claim(operator_id)
+    
+    for operator_id, user_id in expired:
+        try:
+            tg.send_message(
+                operator_id,
+                f"⌛ *Время на ответ истекло*\n\n"
+                f"Сообщение пользователя {user_id} возвращено в очередь.",
+                parse_mode="Markdown",
+                reply_markup=operator_menu()
+            )
+        except Exception as e:
+            print(f"Ошибка уведомления оператора {operator_id}: {e}")
+    return expired
+
+def restore_queue_state():
+    """Восстановить режим очереди и закрепления после загрузки"""
+    messages_queue.mode = system_settings.get('queue_mode', 'fifo')
+    for operator_id, claim in waiting_answers.items():
+        messages_queue.claim_user(claim['user_id'], operator_id)
+    rebuild_indexes()
+
+def rebuild_indexes():
+    """Построить индексы активности и итоги заново по загруженным данным"""
+    global answers_total, leaderboard_day, leaderboard_day_ends
+    
+    online_index.reset()
+    joined_index.reset()
+    for user in users.values():
+        online_index.add(user.get('last_msg', 0))
+        joined_index.add(user.get('joined', 0))
+    answers_total = sum(stats.get('answered', 0) for stats in operator_stats.values())
+    leaderboards['all'].clear()
+    for operator_id, stats in operator_stats.items():
+        leaderboards['all'].set(operator_id, stats.get('answered', 0))
+    leaderboard_day = None
+    leaderboard_day_ends = 0
+    for kind in ('wait', 'reply'):
+        latency_totals[kind] = new_histogram()
+        for stats in operator_stats.values():
+            if kind in stats:
+                histogram_merge(latency_totals[kind], stats[kind])
+    history_totals.rebuild(storage.count_history())
+
+def register_user(from_user):
+    """Завести карточку нового пользователя"""
+    # users перебирают рассылки и снимок - добавлять и менять карточки только под замком
+    with state_lock:
+        users[from_user.id] = {
+            'captcha': False, 
+            'last_msg': 0,
+            'username': from_user.username or "",
+            'first_name': from_user.first_name or "",
+            'messages_sent': 0,
+            'joined': time.time()
+        }
+        joined_index.add(users[from_user.id]['joined'])
+
+def touch_user(user_id, now):
+    """Засчитать сообщение пользователя и запомнить время последнего"""
+    with state_lock:
+        users[user_id]['messages_sent'] += 1
+        online_index.move(users[user_id].get('last_msg', 0), now)
+        users[user_id]['last_msg'] = now
 
 def get_user_unanswered_count(user_id):
     """Получить количество неотвеченных сообщений пользователя"""
-    if user_id not in user_messages:
-        return 0
-    return sum(1 for msg in user_messages[user_id] if not msg['answered'])
+    return storage.unanswered_count(user_id)
+
+def history_cutoff():
+    """Время, раньше которого история не хранится (0 - без лимита)"""
+    days = system_settings.get('history_max_days', 0)
+    return time.time() - days * 86400 if days else 0
+
+def submit_call(method, args, kwargs, pool=None):
+    """Начать вызов API и вернуть его future
+    
+    В async-режиме вызов идет через AsyncTeleBot, иначе - в пуле pool (по умолчанию fanout_pool).
+    """
+    if async_loop is None:
+        return (pool or fanout_pool).submit(tg.call, method, *args, **kwargs)
+    return asyncio.run_coroutine_threadsafe(tg.acall(method, *args, **kwargs), async_loop)
+
+def send_concurrently(calls):
+    """Выполнить вызовы API [(метод, args, kwargs)] параллельно и вернуть результаты или исключения"""
+    futures = [submit_call(method, args, kwargs) for method, args, kwargs in calls]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(e)
+    return results
+
+detached_lock = threading.Lock()
+detached_sends = set()  # Еще не завершенные отправки send_detached - их дожидается остановка
+
+def send_detached(calls, error_text):
+    """Отправить вызовы параллельно, не дожидаясь их; ошибка одного вызова не мешает остальным"""
+    def report(future, chat_id):
+        with detached_lock:
+            detached_sends.discard(future)
+        error = future.exception()
+        if error:
+            print(f"{error_text} {chat_id}: {error}")
+    
+    for method, args, kwargs in calls:
+        future = submit_call(method, args, kwargs, detached_pool)
+        with detached_lock:
+            detached_sends.add(future)
+        future.add_done_callback(lambda f, chat_id=args[0]: report(f, chat_id))
 
 def is_work_time():
     """Проверить рабочее время"""
@@ -186,6 +1433,740 @@ def is_work_time():
     except:
         return True
 
+# =============================
+# РЯДЫ НАГРУЗКИ
+# =============================
+# События копятся в итоге текущей минуты. Когда минута проходит, итог с замером очереди
+# добавляется в поминутный, часовой и дневной ряды, а интервалы старше срока хранения удаляются,
+# поэтому на диске не больше 1440 + 720 + 366 коротких записей.
+
+def new_load_bucket():
+    """Итог интервала: поступило, взято, отвечено, отклонено, макс. очередь, сумма замеров очереди, замеров"""
+    return [0] * 7
+
+def merge_load(bucket, other):
+    for index in range(len(LOAD_FIELDS)):
+        bucket[index] += other[index]
+    bucket[4] = max(bucket[4], other[4])
+    bucket[5] += other[5]
+    bucket[6] += other[6]
+
+def load_start(resolution, t):
+    """Начало интервала ряда resolution ('m', 'h' или 'd'), в который попадает момент t"""
+    size = LOAD_RESOLUTIONS[resolution][0]
+    return int((t + MOSCOW_OFFSET) // size * size - MOSCOW_OFFSET)
+
+def load_event(field, count=1):
+    """Учесть событие нагрузки: 'arrivals', 'claims', 'replies' или 'rejects'"""
+    with state_lock:
+        roll_load(time.time())
+        load_current[LOAD_FIELDS.index(field)] += count
+        if field == 'arrivals':
+            load_current[4] = max(load_current[4], len(messages_queue))
+
+def roll_load(now):
+    """Закрыть текущую минуту, если она уже прошла"""
+    global load_minute
+    
+    with state_lock:
+        minute = load_start('m', now)
+        if load_minute == minute:
+            return
+        if load_minute is not None:
+            close_load_minute()
+            prune_load(now)
+        load_minute = minute
+
+def close_load_minute():
+    """Замерить очередь и добавить итог текущей минуты в поминутный, часовой и дневной ряды"""
+    global load_current
+    
+    with state_lock:
+        if load_minute is None:
+            return
+        depth = len(messages_queue)
+        load_current[4] = max(load_current[4], depth)
+        load_current[5] += depth
+        load_current[6] += 1
+        for resolution in LOAD_RESOLUTIONS:
+            key = f"{resolution}:{load_start(resolution, load_minute)}"
+            # Минута могла быть записана до перезапуска - итоги складываются
+            merge_load(load_series.setdefault(key, new_load_bucket()), load_current)
+            storage.save_load(key)
+        load_current = new_load_bucket()
+
+def prune_load(now):
+    """Удалить интервалы старше срока хранения своего ряда"""
+    with state_lock:
+        expired = [key for key in load_series
+                   if int(key[2:]) < now - LOAD_RESOLUTIONS[key[0]][0] * LOAD_RESOLUTIONS[key[0]][1]]
+        for key in expired:
+            del load_series[key]
+            storage.delete_load(key)
+
+def load_window(resolution, count):
+    """Последние count интервалов ряда, включая текущий: [(начало, итог)]"""
+    size = LOAD_RESOLUTIONS[resolution][0]
+    now = time.time()
+    current = load_start(resolution, now)
+    with state_lock:
+        roll_load(now)
+        window = []
+        for index in range(count - 1, -1, -1):
+            start = current - index * size
+            bucket = new_load_bucket()
+            stored = load_series.get(f"{resolution}:{start}")
+            if stored:
+                merge_load(bucket, stored)
+            window.append((start, bucket))
+        # Незакрытая минута входит в последний интервал
+        merge_load(window[-1][1], load_current)
+    return window
+
+# =============================
+# ХРАНИЛИЩЕ ДАННЫХ
+# =============================
+
+class JsonStorage:
+    """Хранилище в bot_data.json с журналом изменений"""
+    
+    def __init__(self):
+        self.sweep_keys = []  # Пользователи, ожидающие фоновой очистки истории
+    
+    def load(self):
+        load_data()
+    
+    def flush(self):
+        return save_data()
+    
+    def write_pending(self):
+        return journal_flush()
+    
+    def pending(self):
+        return journal_pending
+    
+    def save_user(self, user_id):
+        with state_lock:
+            journal_set('users', user_id)
+    
+    def save_operator(self, operator_id):
+        journal_set('operator_stats', operator_id)
+    
+    def clear_operator_stats(self):
+        with state_lock:
+            operator_stats.clear()
+            journal_clear('operator_stats')
+    
+    def save_setting(self, key):
+        journal_set('system_settings', key)
+    
+    def save_template(self, key):
+        journal_set('answer_templates', key)
+    
+    def delete_template(self, key):
+        journal_delete('answer_templates', key)
+    
+    def save_broadcast(self, job_id):
+        journal_set('broadcast_jobs', job_id)
+    
+    def save_media(self, unique_id):
+        journal_set('media_files', unique_id)
+    
+    def delete_media(self, unique_id):
+        journal_delete('media_files', unique_id)
+    
+    def delete_broadcast(self, job_id):
+        journal_delete('broadcast_jobs', job_id)
+    
+    def save_load(self, key):
+        journal_set('load_series', key)
+    
+    def delete_load(self, key):
+        journal_delete('load_series', key)
+    
+    def add_message(self, user_id, msg):
+        with state_lock:
+            if user_id not in user_messages:
+                user_messages[user_id] = []
+            user_messages[user_id].append(msg)
+            history_totals.add(user_id, msg['answered'])
+            journal_write('msg', user_id=user_id, msg=msg)
+            self.trim_user(user_id)
+    
+    def trim_user(self, user_id):
+        """Обрезать историю пользователя по лимиту и сроку хранения"""
+        with state_lock:
+            msgs = user_messages.get(user_id)
+            if not msgs:
+                return
+            
+            count = 0
+            max_messages = system_settings.get('history_max_messages', 0)
+            if max_messages and len(msgs) > max_messages:
+                count = len(msgs) - max_messages
+            # Сообщения идут по времени - устаревшие всегда в начале списка
+            cutoff = history_cutoff()
+            while count < len(msgs) and msgs[count]['time'] < cutoff:
+                count += 1
+            
+            if count:
+                history_totals.remove(user_id, count, sum(1 for msg in msgs[:count] if msg.get('answered', False)))
+                del msgs[:count]
+                if not msgs:
+                    user_messages.pop(user_id, None)
+                journal_write('trim', user_id=user_id, count=count)
+    
+    def sweep_history(self, batch):
+        """Очередная порция фоновой очистки истории"""
+        if not self.sweep_keys:
+            with state_lock:
+                self.sweep_keys = list(user_messages.keys())
+        chunk = self.sweep_keys[-batch:]
+        del self.sweep_keys[-batch:]
+        for user_id in chunk:
+            self.trim_user(user_id)
+    
+    def mark_answered(self, user_id, all_messages=False):
+        with state_lock:
+            if user_id not in user_messages:
+                return
+            count = 0
+            for msg in user_messages[user_id]:
+                if not msg['answered']:
+                    msg['answered'] = True
+                    count += 1
+                    if not all_messages:
+                        break
+            history_totals.answer(user_id, count)
+            journal_write('answer', user_id=user_id, all=all_messages)
+    
+    def get_history(self, user_id, limit):
+        with state_lock:
+            return user_messages.get(user_id, [])[-limit:]
+    
+    def unanswered_count(self, user_id):
+        return history_totals.unanswered(user_id)
+    
+    def message_totals(self):
+        """Всего сообщений и из них отвеченных"""
+        return history_totals.totals()
+    
+    def history_size(self):
+        """Пользователей с историей и сообщений в ней"""
+        return history_totals.size()
+    
+    def count_history(self):
+        """Сообщений и отвеченных у каждого пользователя - для пересчета итогов после загрузки"""
+        with state_lock:
+            return {user_id: (len(msgs), sum(1 for msg in msgs if msg.get('answered', False)))
+                    for user_id, msgs in user_messages.items()}
+    
+    def clear_history(self):
+        with state_lock:
+            user_messages.clear()
+            history_totals.clear()
+            journal_clear('user_messages')
+    
+    def queue_add(self, msg):
+        journal_write('queue_add', msg=msg)
+    
+    def queue_remove(self, ids):
+        journal_write('queue_del', ids=ids)
+    
+    def queue_clear(self):
+        journal_write('queue_clear')
+    
+    def save_claim(self, operator_id):
+        journal_write('claim', operator_id=operator_id, claim=waiting_answers[operator_id])
+    
+    def delete_claim(self, operator_id):
+        journal_write('release', operator_id=operator_id)
+
+class SqliteStorage:
+    """Хранилище в SQLite: история сообщений не держится в памяти"""
+    
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS users ("
+        " user_id INTEGER PRIMARY KEY, data TEXT NOT NULL,"
+        " joined REAL NOT NULL DEFAULT 0, last_msg REAL NOT NULL DEFAULT 0)",
+        "CREATE TABLE IF NOT EXISTS messages ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,"
+        " text TEXT NOT NULL, time REAL NOT NULL, answered INTEGER NOT NULL DEFAULT 0)",
+        "CREATE INDEX IF NOT EXISTS messages_user ON messages (user_id, answered)",
+        "CREATE INDEX IF NOT EXISTS messages_answered ON messages (answered)",
+        "CREATE INDEX IF NOT EXISTS messages_time ON messages (time)",
+        "CREATE TABLE IF NOT EXISTS operator_stats ("
+        " operator_id INTEGER PRIMARY KEY, answered INTEGER NOT NULL DEFAULT 0, data TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS settings ("
+        " section TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (section, key))",
+        "CREATE TABLE IF NOT EXISTS queue ("
+        " id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, text TEXT NOT NULL,"
+        " type TEXT NOT NULL, time REAL NOT NULL, media TEXT)",
+        "CREATE TABLE IF NOT EXISTS claims (operator_id INTEGER PRIMARY KEY, data TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS media_files (unique_id TEXT PRIMARY KEY, kind TEXT NOT NULL, file_id TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS queue_ids (id INTEGER PRIMARY KEY AUTOINCREMENT)"
+    )
+    
+    def __init__(self, path, autocommit=False):
+        self.path = path
+        self.conn = None
+        self.lock = threading.RLock()
+        self.uncommitted = 0  # Изменений в открытой транзакции
+        # Несколько процессов: держать транзакцию открытой - значит блокировать запись остальным
+        self.autocommit = autocommit
+        self.sweep_cursor = 0  # Последний user_id, проверенный на лимит сообщений фоновой очисткой
+    
+    def execute(self, sql, params=()):
+        with self.lock:
+            cursor = self.conn.execute(sql, params)
+            if self.autocommit:
+                self.conn.commit()
+                return cursor
+            self.uncommitted += 1
+        writer.mark_dirty()
+        return cursor
+    
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+    
+    def load(self):
+        global messages_queue, waiting_answers, queue_seq
+        
+        started = time.time()
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for sql in self.SCHEMA:
+            self.conn.execute(sql)
+        # Базы прошлых версий: очередь без ссылок на вложения
+        if 'media' not in {row[1] for row in self.conn.execute("PRAGMA table_info(queue)")}:
+            self.conn.execute("ALTER TABLE queue ADD COLUMN media TEXT")
+        # Счетчик ID очереди для режима sharded не должен отставать от уже выданных номеров
+        self.conn.execute(
+            "INSERT OR IGNORE INTO queue_ids (id) SELECT MAX(id) FROM queue"
+            " HAVING MAX(id) > (SELECT COALESCE(MAX(id), 0) FROM queue_ids)"
+        )
+        self.conn.commit()
+        
+        empty = not self.query("SELECT 1 FROM users LIMIT 1") and not self.query("SELECT 1 FROM settings LIMIT 1")
+        if empty and (os.path.exists(SNAPSHOT_FILE) or os.path.exists(DATA_FILE)):
+            self.import_json()
+        
+        users.clear()
+        self.load_users()
+        operator_stats.clear()
+        for operator_id, data in self.query("SELECT operator_id, data FROM operator_stats"):
+            operator_stats[operator_id] = json.loads(data)
+        self.load_settings()
+        for key, value in self.query("SELECT key, value FROM settings WHERE section = 'broadcast_jobs'"):
+            broadcast_jobs[int(key)] = json.loads(value)
+        load_series.clear()
+        for key, value in self.query("SELECT key, value FROM settings WHERE section = 'load_series'"):
+            load_series[key] = json.loads(value)
+        messages_queue = MessageQueue(self.queue_since(0))
+        media_files.clear()
+        self.load_media()
+        waiting_answers = {op: json.loads(data) for op, data in self.query("SELECT operator_id, data FROM claims")}
+        restore_queue_state()
+        queue_seq = max((msg['id'] for msg in messages_queue), default=0)
+        
+        print(f"✅ Данные загружены из {self.path}: {len(users)} пользователей")
+        print(f"📬 Очередь восстановлена: {len(messages_queue)} сообщений, "
+              f"{len(waiting_answers)} ответов в работе за {time.time() - started:.2f} сек")
+    
+    def load_users(self, user_ids=None):
+        """Перечитать пользователей из базы (всех или только user_ids)"""
+        if user_ids is None:
+            rows = self.query("SELECT user_id, data FROM users")
+        else:
+            marks = ','.join('?' * len(user_ids))
+            rows = self.query(f"SELECT user_id, data FROM users WHERE user_id IN ({marks})", tuple(user_ids))
+        with state_lock:
+            for user_id, data in rows:
+                user = json.loads(data)
+                if user_id in users:
+                    online_index.move(users[user_id].get('last_msg', 0), user.get('last_msg', 0))
+                else:
+                    online_index.add(user.get('last_msg', 0))
+                    joined_index.add(user.get('joined', 0))
+                users[user_id] = user
+    
+    def load_settings(self):
+        """Перечитать настройки и шаблоны ответов"""
+        templates = {}
+        for section, key, value in self.query("SELECT section, key, value FROM settings"):
+            if section == 'system_settings' and key in system_settings:
+                system_settings[key] = json.loads(value)
+            elif section == 'answer_templates':
+                templates[key] = json.loads(value)
+        answer_templates.clear()
+        answer_templates.update(templates)
+    
+    def load_media(self, unique_ids=None):
+        """Подгрузить кэш файлов (весь или только unique_ids)"""
+        if unique_ids is None:
+            rows = self.query("SELECT unique_id, kind, file_id FROM media_files ORDER BY rowid")
+        else:
+            marks = ','.join('?' * len(unique_ids))
+            rows = self.query(
+                f"SELECT unique_id, kind, file_id FROM media_files WHERE unique_id IN ({marks})", tuple(unique_ids))
+        for unique_id, kind, file_id in rows:
+            media_files[unique_id] = [kind, file_id]
+    
+    def queue_since(self, last_id):
+        """Сообщения очереди с ID больше last_id по возрастанию"""
+        queued = []
+        for msg_id, user_id, text, msg_type, t, media in self.query(
+                "SELECT id, user_id, text, type, time, media FROM queue WHERE id > ? ORDER BY id", (last_id,)):
+            queued.append({'id': msg_id, 'user_id': user_id, 'text': text, 'type': msg_type, 'time': t})
+            if media:
+                queued[-1]['media'] = json.loads(media)
+        return queued
+    
+    def queue_size(self):
+        return self.query("SELECT COUNT(*) FROM queue")[0][0]
+    
+    def import_json(self):
+        """Перенести данные из снимка и журнала в пустую базу"""
+        load_data()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO users (user_id, data, joined, last_msg) VALUES (?, ?, ?, ?)",
+                [(uid, json.dumps(u, ensure_ascii=False), u.get('joined', 0), u.get('last_msg', 0))
+                 for uid, u in users.items()]
+            )
+            self.conn.executemany(
+                "INSERT INTO messages (user_id, text, time, answered) VALUES (?, ?, ?, ?)",
+                [(uid, m['text'], m['time'], int(m.get('answered', False)))
+                 for uid, msgs in user_messages.items() for m in msgs]
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO operator_stats (operator_id, answered, data) VALUES (?, ?, ?)",
+                [(op, s.get('answered', 0), json.dumps(s, ensure_ascii=False))
+                 for op, s in operator_stats.items()]
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO settings (section, key, value) VALUES (?, ?, ?)",
+                [('system_settings', k, json.dumps(v)) for k, v in system_settings.items()] +
+                [('answer_templates', k, json.dumps(v, ensure_ascii=False)) for k, v in answer_templates.items()] +
+                [('broadcast_jobs', k, json.dumps(v, ensure_ascii=False)) for k, v in broadcast_jobs.items()] +
+                [('load_series', k, json.dumps(v)) for k, v in load_series.items()]
+            )
+            self.conn.executemany(
+                "INSERT INTO queue (id, user_id, text, type, time, media) VALUES (?, ?, ?, ?, ?, ?)",
+                [(m['id'], m['user_id'], m['text'], m['type'], m['time'],
+                  json.dumps(m['media']) if m.get('media') else None) for m in messages_queue]
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO media_files (unique_id, kind, file_id) VALUES (?, ?, ?)",
+                [(unique_id, kind, file_id) for unique_id, (kind, file_id) in media_files.items()]
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO claims (operator_id, data) VALUES (?, ?)",
+                [(op, json.dumps(claim, ensure_ascii=False)) for op, claim in waiting_answers.items()]
+            )
+            self.conn.commit()
+        user_messages.clear()
+        print(f"✅ Данные перенесены в {self.path}")
+    
+    def flush(self):
+        started = time.time()
+        try:
+            self.write_pending()
+            metrics.observe('bot_save_data_duration_seconds', time.time() - started)
+            metrics.set('bot_save_data_bytes', os.path.getsize(self.path))
+            return True
+        except Exception as e:
+            print(f"❌ Ошибка сохранения данных: {e}")
+            return False
+    
+    def write_pending(self):
+        """Закоммитить накопленные изменения одной транзакцией"""
+        with self.lock:
+            count = self.uncommitted
+            self.conn.commit()
+            self.uncommitted = 0
+        return count
+    
+    def pending(self):
+        return 0
+    
+    def save_user(self, user_id):
+        with state_lock:
+            user = users[user_id]
+            data = json.dumps(user, ensure_ascii=False)
+        self.execute(
+            "INSERT OR REPLACE INTO users (user_id, data, joined, last_msg) VALUES (?, ?, ?, ?)",
+            (user_id, data, user.get('joined', 0), user.get('last_msg', 0))
+        )
+    
+    def save_operator(self, operator_id):
+        stats = operator_stats[operator_id]
+        self.execute(
+            "INSERT OR REPLACE INTO operator_stats (operator_id, answered, data) VALUES (?, ?, ?)",
+            (operator_id, stats.get('answered', 0), json.dumps(stats, ensure_ascii=False))
+        )
+    
+    def clear_operator_stats(self):
+        operator_stats.clear()
+        self.execute("DELETE FROM operator_stats")
+    
+    def save_setting(self, key):
+        self.execute(
+            "INSERT OR REPLACE INTO settings (section, key, value) VALUES ('system_settings', ?, ?)",
+            (key, json.dumps(system_settings[key]))
+        )
+    
+    def save_template(self, key):
+        self.execute(
+            "INSERT OR REPLACE INTO settings (section, key, value) VALUES ('answer_templates', ?, ?)",
+            (key, json.dumps(answer_templates[key], ensure_ascii=False))
+        )
+    
+    def delete_template(self, key):
+        self.execute("DELETE FROM settings WHERE section = 'answer_templates' AND key = ?", (key,))
+    
+    def save_media(self, unique_id):
+        self.execute(
+            "INSERT OR REPLACE INTO media_files (unique_id, kind, file_id) VALUES (?, ?, ?)",
+            (unique_id, *media_files[unique_id])
+        )
+    
+    def delete_media(self, unique_id):
+        self.execute("DELETE FROM media_files WHERE unique_id = ?", (unique_id,))
+    
+    def save_broadcast(self, job_id):
+        self.execute(
+            "INSERT OR REPLACE INTO settings (section, key, value) VALUES ('broadcast_jobs', ?, ?)",
+            (job_id, json.dumps(broadcast_jobs[job_id], ensure_ascii=False))
+        )
+    
+    def delete_broadcast(self, job_id):
+        self.execute("DELETE FROM settings WHERE section = 'broadcast_jobs' AND key = ?", (job_id,))
+    
+    def save_load(self, key):
+        self.execute(
+            "INSERT OR REPLACE INTO settings (section, key, value) VALUES ('load_series', ?, ?)",
+            (key, json.dumps(load_series[key]))
+        )
+    
+    def delete_load(self, key):
+        self.execute("DELETE FROM settings WHERE section = 'load_series' AND key = ?", (key,))
+    
+    def add_message(self, user_id, msg):
+        with self.lock:
+            self.execute(
+                "INSERT INTO messages (user_id, text, time, answered) VALUES (?, ?, ?, ?)",
+                (user_id, msg['text'], msg['time'], int(msg['answered']))
+            )
+            if not self.autocommit:
+                history_totals.add(user_id, msg['answered'])
+        self.trim_user(user_id)
+    
+    def delete_history(self, where, params):
+        """Удалить сообщения истории по условию и вычесть их из итогов"""
+        with self.lock:
+            if self.autocommit:
+                # Режим sharded: итогов в памяти нет, счетчики считают запросы
+                self.execute(f"DELETE FROM messages WHERE {where}", params)
+                return
+            removed = self.conn.execute(
+                f"SELECT user_id, COUNT(*), SUM(answered) FROM messages WHERE {where} GROUP BY user_id", params
+            ).fetchall()
+            if removed:
+                self.execute(f"DELETE FROM messages WHERE {where}", params)
+                for user_id, count, answered in removed:
+                    history_totals.remove(user_id, count, answered)
+    
+    def trim_user(self, user_id):
+        """Обрезать историю пользователя по лимиту и сроку хранения"""
+        max_messages = system_settings.get('history_max_messages', 0)
+        if max_messages:
+            self.delete_history(
+                "user_id = ? AND id <= ("
+                " SELECT id FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (user_id, user_id, max_messages)
+            )
+        cutoff = history_cutoff()
+        if cutoff:
+            self.delete_history("user_id = ? AND time < ?", (user_id, cutoff))
+    
+    def sweep_history(self, batch):
+        """Очередная порция фоновой очистки истории: batch устаревших сообщений и batch пользователей"""
+        cutoff = history_cutoff()
+        if cutoff:
+            self.delete_history(
+                "id IN (SELECT id FROM messages WHERE time < ? ORDER BY time LIMIT ?)",
+                (cutoff, batch)
+            )
+        # Лимит сообщений, уменьшенный админом, касается и тех, кто больше не пишет
+        if system_settings.get('history_max_messages', 0):
+            user_ids = [row[0] for row in self.query(
+                "SELECT DISTINCT user_id FROM messages WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                (self.sweep_cursor, batch)
+            )]
+            self.sweep_cursor = user_ids[-1] if len(user_ids) == batch else 0
+            for user_id in user_ids:
+                self.trim_user(user_id)
+    
+    def mark_answered(self, user_id, all_messages=False):
+        with self.lock:
+            if all_messages:
+                cursor = self.execute("UPDATE messages SET answered = 1 WHERE user_id = ? AND answered = 0", (user_id,))
+            else:
+                cursor = self.execute(
+                    "UPDATE messages SET answered = 1 WHERE id = ("
+                    " SELECT id FROM messages WHERE user_id = ? AND answered = 0 ORDER BY id LIMIT 1)",
+                    (user_id,)
+                )
+            if not self.autocommit:
+                history_totals.answer(user_id, cursor.rowcount)
+    
+    def get_history(self, user_id, limit):
+        rows = self.query(
+            "SELECT text, time, answered FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+            (user_id, limit)
+        )
+        return [{'text': text, 'time': t, 'answered': bool(answered)} for text, t, answered in reversed(rows)]
+    
+    # Базу общей истории меняют и другие процессы (режим sharded) - тогда итоги в памяти не ведутся,
+    # счетчики берутся запросами
+    def unanswered_count(self, user_id):
+        if not self.autocommit:
+            return history_totals.unanswered(user_id)
+        return self.query(
+            "SELECT COUNT(*) FROM messages WHERE user_id = ? AND answered = 0", (user_id,)
+        )[0][0]
+    
+    def message_totals(self):
+        """Всего сообщений и из них отвеченных"""
+        if not self.autocommit:
+            return history_totals.totals()
+        total, answered = self.query("SELECT COUNT(*), COALESCE(SUM(answered), 0) FROM messages")[0]
+        return total, answered
+    
+    def history_size(self):
+        """Пользователей с историей и сообщений в ней"""
+        if not self.autocommit:
+            return history_totals.size()
+        return self.query("SELECT COUNT(DISTINCT user_id), COUNT(*) FROM messages")[0]
+    
+    def count_history(self):
+        """Сообщений и отвеченных у каждого пользователя - для пересчета итогов после загрузки"""
+        return {user_id: (total, answered) for user_id, total, answered in self.query(
+            "SELECT user_id, COUNT(*), SUM(answered) FROM messages GROUP BY user_id")}
+    
+    def clear_history(self):
+        with self.lock:
+            self.execute("DELETE FROM messages")
+            if not self.autocommit:
+                history_totals.clear()
+    
+    def queue_add(self, msg):
+        with self.lock:
+            if msg['id'] is None:
+                # Общая очередь процессов (режим sharded): номер берется из счетчика той же транзакцией,
+                # что и вставка, поэтому номера не повторяются и становятся видны по возрастанию
+                msg['id'] = self.conn.execute("INSERT INTO queue_ids DEFAULT VALUES").lastrowid
+                self.conn.execute("DELETE FROM queue_ids WHERE id < ?", (msg['id'],))
+            self.execute(
+                "INSERT INTO queue (id, user_id, text, type, time, media) VALUES (?, ?, ?, ?, ?, ?)",
+                (msg['id'], msg['user_id'], msg['text'], msg['type'], msg['time'],
+                 json.dumps(msg['media']) if msg.get('media') else None)
+            )
+    
+    def queue_remove(self, ids):
+        with self.lock:
+            self.conn.executemany("DELETE FROM queue WHERE id = ?", [(msg_id,) for msg_id in ids])
+            self.uncommitted += 1
+        writer.mark_dirty()
+    
+    def queue_clear(self):
+        self.execute("DELETE FROM queue")
+    
+    def save_claim(self, operator_id):
+        self.execute(
+            "INSERT OR REPLACE INTO claims (operator_id, data) VALUES (?, ?)",
+            (operator_id, json.dumps(waiting_answers[operator_id], ensure_ascii=False))
+        )
+    
+    def delete_claim(self, operator_id):
+        self.execute("DELETE FROM claims WHERE operator_id = ?", (operator_id,))
+
+class BackgroundWriter:
+    """Фоновая запись изменений: всплеск изменений сбрасывается одной записью"""
+    
+    def __init__(self, delay):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.dirty_since = None  # Время первого несохраненного изменения
+        self.stats = {
+            'flushes': 0,
+            'records': 0,
+            'errors': 0,
+            'last_latency': 0.0,
+            'max_latency': 0.0,
+            'total_latency': 0.0,
+            'last_duration': 0.0
+        }
+    
+    def mark_dirty(self):
+        with self.lock:
+            if self.dirty_since is None:
+                self.dirty_since = time.time()
+                self.event.set()
+    
+    def flush(self):
+        """Сбросить изменения, если они есть"""
+        with self.lock:
+            dirty_since = self.dirty_since
+            self.dirty_since = None
+            self.event.clear()
+        if dirty_since is None:
+            return True
+        
+        started = time.time()
+        try:
+            records = storage.write_pending()
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.mark_dirty()
+            print(f"❌ Ошибка фоновой записи: {e}")
+            return False
+        
+        finished = time.time()
+        latency = finished - dirty_since
+        self.stats['flushes'] += 1
+        self.stats['records'] += records
+        self.stats['last_latency'] = latency
+        self.stats['max_latency'] = max(self.stats['max_latency'], latency)
+        self.stats['total_latency'] += latency
+        self.stats['last_duration'] = finished - started
+        return True
+    
+    def run(self):
+        while True:
+            self.event.wait()
+            # Копим изменения не дольше self.delay и пишем их одним блоком
+            time.sleep(self.delay)
+            self.flush()
+    
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+    
+    def average_latency(self):
+        if not self.stats['flushes']:
+            return 0.0
+        return self.stats['total_latency'] / self.stats['flushes']
+
+if STORAGE_BACKEND == 'sqlite':
+    storage = SqliteStorage(SQLITE_FILE)
+else:
+    storage = JsonStorage()
+writer = BackgroundWriter(WRITE_DELAY)
+
 # =============================
 # КЛАВИАТУРЫ
 # =============================
@@ -265,6 +2246,7 @@ def system_menu():
     auto_greet = "✅" if system_settings['auto_greet'] else "❌"
     notify = "✅" if system_settings['notify_operators'] else "❌"
     captcha = "✅" if system_settings['captcha_enabled'] else "❌"
+    queue_mode = "По кругу" if system_settings.get('queue_mode') == 'round_robin' else "FIFO"
     
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -273,6 +2255,9 @@ def system_menu():
         types.InlineKeyboardButton(f"{captcha} Капча", callback_data="toggle_captcha"),
         types.InlineKeyboardButton("📏 Лимит очереди", callback_data="set_queue_limit"),
         types.InlineKeyboardButton("⏱️ Таймаут", callback_data="set_timeout"),
+        types.InlineKeyboardButton("🗂 Хранение истории", callback_data="set_history_limit"),
+        types.InlineKeyboardButton(f"🔀 Очередь: {queue_mode}", callback_data="toggle_queue_mode"),
+        types.InlineKeyboardButton("⌛ Срок ответа", callback_data="set_claim_lease"),
         types.InlineKeyboardButton("🔙 Назад", callback_data="back_to_settings")
     )
     return kb
@@ -326,7 +2311,7 @@ def start_command(message):
     
     if user_id in operators:
         # Оператор
-        bot.send_message(
+        tg.send_message(
             user_id,
             "👮 *Панель оператора*\n\n"
             "📊 В очереди: *{} сообщений*\n"
@@ -338,17 +2323,10 @@ def start_command(message):
     else:
         # Обычный пользователь
         if user_id not in users:
-            users[user_id] = {
-                'captcha': False, 
-                'last_msg': 0,
-                'username': message.from_user.username or "",
-                'first_name': message.from_user.first_name or "",
-                'messages_sent': 0,
-                'joined': time.time()
-            }
+            register_user(message.from_user)
             send_welcome(message)
         else:
-            bot.send_message(
+            tg.send_message(
                 user_id,
                 "👋 С возвращением!\n\n"
                 "📊 Ваша статистика:\n"
@@ -376,19 +2354,22 @@ def send_welcome(message):
             "🔐 Для начала решите простой пример:"
         )
         
-        bot.send_message(user_id, welcome_text, parse_mode="Markdown")
+        tg.send_message(user_id, welcome_text, parse_mode="Markdown")
     
     if system_settings['captcha_enabled']:
         send_captcha(user_id)
     else:
-        users[user_id]['captcha'] = True
-        bot.send_message(
+        with state_lock:
+            users[user_id]['captcha'] = True
+        tg.send_message(
             user_id,
             "✅ *Регистрация успешна!*\n\n"
             "Теперь вы можете пользоваться всеми функциями бота.",
             reply_markup=main_menu(),
             parse_mode="Markdown"
         )
+    
+    storage.save_user(user_id)
 
 @bot.message_handler(func=lambda m: True)
 def handle_message(message):
@@ -403,14 +2384,7 @@ def handle_message(message):
     
     # Проверка на нового пользователя
     if user_id not in users:
-        users[user_id] = {
-            'captcha': False, 
-            'last_msg': 0,
-            'username': message.from_user.username or "",
-            'first_name': message.from_user.first_name or "",
-            'messages_sent': 0,
-            'joined': time.time()
-        }
+        register_user(message.from_user)
         send_welcome(message)
         return
     
@@ -421,7 +2395,7 @@ def handle_message(message):
     
     # Проверка рабочего времени
     if not is_work_time():
-        bot.send_message(
+        tg.send_message(
             user_id,
             "⏰ *Бот временно не работает*\n\n"
             "Рабочее время: с {}:00 до {}:00 (МСК)\n"
@@ -436,7 +2410,7 @@ def handle_message(message):
     
     # Обработка кнопок меню
     if text == "✉️ Написать оператору":
-        bot.send_message(
+        tg.send_message(
             user_id,
             "📝 *Напишите ваше сообщение оператору:*\n\n"
             "💡 *Советы:*\n"
@@ -448,7 +2422,8 @@ def handle_message(message):
             reply_markup=back_button(),
             parse_mode="Markdown"
         )
-        users[user_id]['writing'] = True
+        with state_lock:
+            users[user_id]['writing'] = True
         
     elif text == "📋 Инструкция":
         show_instruction(user_id)
@@ -460,8 +2435,9 @@ def handle_message(message):
         show_contacts(user_id)
         
     elif text == "🔙 Назад":
-        users[user_id].pop('writing', None)
-        bot.send_message(
+        with state_lock:
+            users[user_id].pop('writing', None)
+        tg.send_message(
             user_id,
             "🏠 *Главное меню*",
             reply_markup=main_menu(),
@@ -473,7 +2449,7 @@ def handle_message(message):
         process_user_message(message)
         
     else:
-        bot.send_message(
+        tg.send_message(
             user_id,
             "Выберите действие в меню 👆",
             reply_markup=main_menu()
@@ -492,7 +2468,7 @@ def process_user_message(message):
     current_time = time.time()
     if current_time - users[user_id]['last_msg'] < WAIT_TIME:
         remaining = int(WAIT_TIME - (current_time - users[user_id]['last_msg']))
-        bot.send_message(
+        tg.send_message(
             user_id,
             f"⏳ Подождите {remaining} секунд перед следующим сообщением",
             reply_markup=back_button()
@@ -501,7 +2477,7 @@ def process_user_message(message):
     
     # Проверка длины текста
     if text and len(text) < 5:
-        bot.send_message(
+        tg.send_message(
             user_id,
             "📏 Сообщение слишком короткое (минимум 5 символов)",
             reply_markup=back_button()
@@ -515,46 +2491,44 @@ def process_user_message(message):
     
     # Сохраняем в очередь
     save_message_to_queue(user_id, text)
-    users[user_id]['messages_sent'] += 1
-    users[user_id]['last_msg'] = current_time
+    touch_user(user_id, current_time)
     
-    # Уведомляем операторов если включено
-    if system_settings['notify_operators']:
+    # Уведомляем операторов если включено (в режиме sharded - координатор, когда заберет сообщение)
+    if system_settings['notify_operators'] and shard_index is None:
         notify_operators(user_id, text, user_info)
     
     # Подтверждение пользователю
-    bot.send_message(
+    tg.send_message(
         user_id,
         "✅ *Сообщение отправлено в очередь!*\n\n"
         "📊 Ваша позиция в очереди: *№{}*\n"
         "⏳ Ожидайте ответа оператора\n"
-        "💡 Вы можете отправить еще информацию, пока ждете".format(len(messages_queue)),
+        "💡 Вы можете отправить еще информацию, пока ждете".format(queue_length()),
         reply_markup=back_button(),
         parse_mode="Markdown"
     )
     
     # Автосохранение данных
-    save_data()
+    storage.save_user(user_id)
 
 def notify_operators(user_id, text, user_info):
     """Уведомить операторов о новом сообщении"""
-    for operator_id in operators:
-        try:
-            # Создаем кнопки для быстрого ответа
-            kb = answer_buttons(user_id)
-            
-            # Отправляем сообщение оператору
-            bot.send_message(
-                operator_id,
-                f"📩 *НОВОЕ СООБЩЕНИЕ #{len(messages_queue)}*\n\n"
-                f"{user_info}\n\n"
-                f"💬 *Сообщение:*\n{text}\n\n"
-                f"⏳ В очереди: *{len(messages_queue)}* сообщений",
-                parse_mode="Markdown",
-                reply_markup=kb
-            )
-        except Exception as e:
-            print(f"Ошибка отправки оператору {operator_id}: {e}")
+    # Создаем кнопки для быстрого ответа
+    kb = answer_buttons(user_id)
+    queued = queue_length()
+    notification = (
+        f"📩 *НОВОЕ СООБЩЕНИЕ #{queued}*\n\n"
+        f"{user_info}\n\n"
+        f"💬 *Сообщение:*\n{text}\n\n"
+        f"⏳ В очереди: *{queued}* сообщений"
+    )
+    
+    # Отправляем сообщение всем операторам в фоне - пользователь не ждет рассылки
+    send_detached(
+        [('send_message', (operator_id, notification), {'parse_mode': "Markdown", 'reply_markup': kb})
+         for operator_id in operators],
+        "Ошибка отправки оператору"
+    )
 
 def show_instruction(user_id):
     """Показать инструкцию"""
@@ -576,7 +2550,7 @@ def show_instruction(user_id):
             system_settings.get('work_hours_end', 21)
         )
     )
-    bot.send_message(user_id, instruction, parse_mode="Markdown", reply_markup=main_menu())
+    tg.send_message(user_id, instruction, parse_mode="Markdown", reply_markup=main_menu())
 
 def show_user_stats(user_id):
     """Показать статистику пользователя"""
@@ -588,6 +2562,9 @@ def show_user_stats(user_id):
     else:
         days = 0
     
+    with state_lock:
+        most_active = max((u.get('messages_sent', 0) for u in users.values()), default=0)
+    
     stats = (
         f"📊 *ВАША СТАТИСТИКА*\n\n"
         f"👤 Аккаунт создан: *{days} дней назад*\n"
@@ -595,12 +2572,12 @@ def show_user_stats(user_id):
         f"⏱️ Неотвеченных: *{get_user_unanswered_count(user_id)}*\n"
         f"🏆 Рейтинг активности: *{user.get('messages_sent', 0) // 10} уровень*\n\n"
         f"💡 *Рекорды системы:*\n"
-        f"• Самый активный: {max(users.values(), key=lambda x: x.get('messages_sent', 0)).get('messages_sent', 0) if users else 0} сообщений\n"
+        f"• Самый активный: {most_active} сообщений\n"
         f"• Всего пользователей: {len(users)}\n"
-        f"• Всего ответов: {sum(1 for msgs in user_messages.values() for msg in msgs if msg.get('answered')) if user_messages else 0}"
+        f"• Всего ответов: {storage.message_totals()[1]}"
     )
     
-    bot.send_message(user_id, stats, parse_mode="Markdown", reply_markup=main_menu())
+    tg.send_message(user_id, stats, parse_mode="Markdown", reply_markup=main_menu())
 
 def show_contacts(user_id):
     """Показать контакты"""
@@ -623,7 +2600,7 @@ def show_contacts(user_id):
             min(18, system_settings.get('work_hours_end', 21))
         )
     )
-    bot.send_message(user_id, contacts, parse_mode="Markdown", reply_markup=main_menu())
+    tg.send_message(user_id, contacts, parse_mode="Markdown", reply_markup=main_menu())
 
 # =============================
 # СИСТЕМА КАПЧИ
@@ -648,10 +2625,11 @@ def send_captcha(user_id):
         num2 = random.randint(2, 9)
         answer = num1 * num2
     
-    users[user_id]['captcha_answer'] = answer
-    users[user_id]['captcha_question'] = f"{num1} {op} {num2}"
+    with state_lock:
+        users[user_id]['captcha_answer'] = answer
+        users[user_id]['captcha_question'] = f"{num1} {op} {num2}"
     
-    bot.send_message(
+    tg.send_message(
         user_id,
         f"🔐 *Проверка безопасности*\n\nРешите пример:\n`{num1} {op} {num2} = ?`\n\n"
         "💡 *Подсказка:* Это нужно для защиты от ботов",
@@ -668,21 +2646,23 @@ def check_captcha(message):
         correct_answer = users[user_id].get('captcha_answer', 0)
         
         if user_answer == correct_answer:
-            users[user_id]['captcha'] = True
+            with state_lock:
+                users[user_id]['captcha'] = True
+            storage.save_user(user_id)
             
             success_msg = (
                 "✅ *Проверка пройдена!*\n\n"
                 "Теперь вы можете пользоваться всеми функциями бота."
             )
             
-            bot.send_message(
+            tg.send_message(
                 user_id,
                 success_msg,
                 reply_markup=main_menu(),
                 parse_mode="Markdown"
             )
         else:
-            bot.send_message(
+            tg.send_message(
                 user_id,
                 "❌ *Неверный ответ*\n\n"
                 f"Попробуйте еще раз: `{users[user_id].get('captcha_question', '?')} = ?`",
@@ -690,7 +2670,7 @@ def check_captcha(message):
             )
             
     except ValueError:
-        bot.send_message(
+        tg.send_message(
             user_id,
             "❌ *Введите число*\n\n"
             "Пожалуйста, введите только число (без пробелов и других символов):",
@@ -713,65 +2693,159 @@ def handle_media(message):
     
     # Проверка на нового пользователя
     if user_id not in users or not users[user_id]['captcha']:
-        bot.send_message(user_id, "Сначала пройдите проверку безопасности")
+        tg.send_message(user_id, "Сначала пройдите проверку безопасности")
         return
     
     # Проверка режима написания
     if not users[user_id].get('writing'):
-        bot.send_message(user_id, "Нажмите '✉️ Написать оператору' для отправки файлов")
+        tg.send_message(user_id, "Нажмите '✉️ Написать оператору' для отправки файлов")
         return
     
     # Проверка антифлуда
     current_time = time.time()
     if current_time - users[user_id]['last_msg'] < WAIT_TIME:
         remaining = int(WAIT_TIME - (current_time - users[user_id]['last_msg']))
-        bot.send_message(user_id, f"⏳ Подождите {remaining} секунд")
+        tg.send_message(user_id, f"⏳ Подождите {remaining} секунд")
         return
     
-    # Формируем информацию
+    if message.media_group_id:
+        collect_album(message, lambda messages: relay_user_media(user_id, messages))
+    else:
+        relay_user_media(user_id, [message])
+
+# =============================
+# ПЕРЕСЫЛКА МЕДИА
+# =============================
+
+# Тип вложения: (подпись для операторов, название в очереди, подпись для пользователя)
+MEDIA_KINDS = {
+    'photo': ("📷 Фото", "фото", "📸 *Фото от оператора*"),
+    'video': ("🎬 Видео", "видео", "🎬 *Видео от оператора*"),
+    'document': ("📎 Документ", "документ", "📎 *Документ от оператора*"),
+    'voice': ("🎤 Голосовое сообщение", "голосовое", "🎤 *Голосовое от оператора*")
+}
+MEDIA_GROUP_TYPES = {
+    'photo': types.InputMediaPhoto,
+    'video': types.InputMediaVideo,
+    'document': types.InputMediaDocument
+}
+
+album_lock = threading.Lock()
+album_buffer = {}  # media_group_id: {'chat_id': int, 'messages': [...], 'timer': Timer, 'on_complete': функция}
+
+def media_kind(message):
+    """Тип вложения сообщения и сам файл"""
+    if message.photo:
+        return 'photo', message.photo[-1]
+    for kind in ('video', 'document', 'voice'):
+        if getattr(message, kind):
+            return kind, getattr(message, kind)
+    return None, None
+
+def remember_media(message):
+    """Запомнить file_id вложения по его file_unique_id и вернуть file_unique_id"""
+    kind, media = media_kind(message)
+    with state_lock:
+        if media.file_unique_id not in media_files:
+            media_files[media.file_unique_id] = [kind, media.file_id]
+            storage.save_media(media.file_unique_id)
+            if len(media_files) > MEDIA_CACHE_SIZE:
+                oldest = next(iter(media_files))
+                del media_files[oldest]
+                storage.delete_media(oldest)
+    return media.file_unique_id
+
+def media_group(unique_ids, caption, parse_mode=None):
+    """Альбом для send_media_group из известных файлов, подпись - у первого"""
+    group = []
+    for unique_id in unique_ids:
+        kind, file_id = media_files[unique_id]
+        if group:
+            group.append(MEDIA_GROUP_TYPES[kind](file_id))
+        else:
+            group.append(MEDIA_GROUP_TYPES[kind](file_id, caption=caption, parse_mode=parse_mode))
+    return group
+
+def send_media(chat_id, unique_ids, caption=None):
+    """Показать сохраненные вложения по file_id, без повторной загрузки"""
+    known = [unique_id for unique_id in unique_ids if unique_id in media_files]
+    if len(known) == 1:
+        kind, file_id = media_files[known[0]]
+        getattr(tg, f"send_{kind}")(chat_id, file_id, caption=caption)
+    elif known:
+        tg.send_media_group(chat_id, media_group(known, caption))
+    return len(known)
+
+def collect_album(message, on_complete):
+    """Копить части альбома, пока они приходят, и отдать их одним списком
+    
+    Альбом обрабатывается в потоке диспетчера своего чата: таймер только ставит задачу в очередь чата,
+    а следующее обновление чата отдает недособранный альбом раньше себя.
+    """
+    group_id = message.media_group_id
+    chat_id = message.chat.id
+    with album_lock:
+        album = album_buffer.setdefault(
+            group_id, {'chat_id': chat_id, 'messages': [], 'timer': None, 'on_complete': on_complete})
+        album['messages'].append(message)
+        if album['timer']:
+            album['timer'].cancel()
+        album['timer'] = threading.Timer(
+            MEDIA_ALBUM_DELAY, dispatcher.submit_task, args=(chat_id, lambda: flush_album(group_id)))
+        album['timer'].daemon = True
+        album['timer'].start()
+
+def flush_album(group_id):
+    """Отдать собранный альбом обработчику (вызывается в очереди чата альбома)"""
+    with album_lock:
+        album = album_buffer.pop(group_id, None)
+        if album:
+            album['timer'].cancel()
+    if album:
+        album['on_complete'](sorted(album['messages'], key=lambda m: m.message_id))
+
+def flush_chat_albums(chat_id, keep=None):
+    """Отдать недособранные альбомы чата, кроме альбома keep, который еще продолжается"""
+    with album_lock:
+        pending = [group_id for group_id, album in album_buffer.items()
+                   if album['chat_id'] == chat_id and group_id != keep]
+    for group_id in pending:
+        flush_album(group_id)
+
+def flush_albums():
+    """Поставить все недособранные альбомы в очереди их чатов, не дожидаясь таймеров; вернуть их число"""
+    with album_lock:
+        pending = [(group_id, album['chat_id']) for group_id, album in album_buffer.items()]
+    for group_id, chat_id in pending:
+        dispatcher.submit_task(chat_id, lambda group_id=group_id: flush_album(group_id))
+    return len(pending)
+
+def relay_user_media(user_id, messages):
+    """Передать вложения пользователя операторам и поставить их в очередь"""
     user_info = format_user_info(user_id, 
                                users[user_id]['username'],
                                users[user_id]['first_name'])
-    
-    caption = message.caption or ""
+    caption = next((m.caption for m in messages if m.caption), "")
     if caption:
         user_info += f"\n📝 Подпись: {caption}"
     
-    # Отправляем операторам если включены уведомления
-    if system_settings['notify_operators']:
-        for operator_id in operators:
-            try:
-                if message.photo:
-                    file_id = message.photo[-1].file_id
-                    text = f"📷 Фото\n\n{user_info}"
-                    bot.send_photo(operator_id, file_id, caption=text)
-                
-                elif message.video:
-                    file_id = message.video.file_id
-                    text = f"🎬 Видео\n\n{user_info}"
-                    bot.send_video(operator_id, file_id, caption=text)
-                
-                elif message.document:
-                    file_id = message.document.file_id
-                    text = f"📎 Документ\n\n{user_info}"
-                    bot.send_document(operator_id, file_id, caption=text)
-                
-                elif message.voice:
-                    file_id = message.voice.file_id
-                    text = f"🎤 Голосовое сообщение\n\n{user_info}"
-                    bot.send_voice(operator_id, file_id, caption=text)
-                    
-            except Exception as e:
-                print(f"Ошибка отправки медиа оператору {operator_id}: {e}")
+    kind, _ = media_kind(messages[0])
+    unique_ids = [remember_media(m) for m in messages]
+    if len(messages) == 1:
+        media_type = MEDIA_KINDS[kind][1]
+    else:
+        media_type = f"альбом из {len(messages)}"
+    
+    # Отправляем операторам если включены уведомления (в режиме sharded - координатор)
+    if system_settings['notify_operators'] and shard_index is None:
+        notify_operators_media(user_id, unique_ids, user_info, messages[0].message_id)
     
     # Сохраняем в историю
-    media_type = "фото" if message.photo else "видео" if message.video else "документ" if message.document else "голосовое"
-    save_message_to_queue(user_id, f"[{media_type.upper()}] {caption}", media_type)
-    users[user_id]['messages_sent'] += 1
-    users[user_id]['last_msg'] = current_time
+    save_message_to_queue(user_id, f"[{media_type.upper()}] {caption}", MEDIA_KINDS[kind][1], unique_ids)
+    touch_user(user_id, time.time())
     
     # Подтверждение пользователю
-    bot.send_message(
+    tg.send_message(
         user_id,
         f"✅ *{media_type.capitalize()} отправлено операторам!*",
         reply_markup=back_button(),
@@ -779,7 +2853,48 @@ def handle_media(message):
     )
     
     # Автосохранение
-    save_data()
+    storage.save_user(user_id)
+
+def notify_operators_media(user_id, unique_ids, user_info, message_id=None):
+    """Уведомить операторов о новом вложении или альбоме"""
+    kind = media_files[unique_ids[0]][0]
+    if len(unique_ids) == 1:
+        text = f"{MEDIA_KINDS[kind][0]}\n\n{user_info}"
+        if message_id:
+            # Копия на стороне Telegram: без загрузки файла и без пометки «переслано»
+            calls = [('copy_message', (operator_id, user_id, message_id), {'caption': text})
+                     for operator_id in operators]
+        else:
+            # Исходное сообщение в другом процессе - шлем файл по file_id
+            calls = [(f"send_{kind}", (operator_id, media_files[unique_ids[0]][1]), {'caption': text})
+                     for operator_id in operators]
+    else:
+        text = f"🖼 Альбом ({len(unique_ids)})\n\n{user_info}"
+        calls = [('send_media_group', (operator_id, media_group(unique_ids, text)), {})
+                 for operator_id in operators]
+    send_detached(calls, "Ошибка отправки медиа оператору")
+
+def relay_operator_media(operator_id, target_user_id, messages):
+    """Передать вложения оператора пользователю"""
+    try:
+        if len(messages) == 1:
+            kind, _ = media_kind(messages[0])
+            caption = f"{MEDIA_KINDS[kind][2]}\n\n🕒 {get_moscow_time()}"
+            tg.copy_message(target_user_id, operator_id, messages[0].message_id,
+                            caption=caption, parse_mode="Markdown", priority=PRIORITY_HIGH)
+        else:
+            caption = f"🖼 *Альбом от оператора*\n\n🕒 {get_moscow_time()}"
+            unique_ids = [remember_media(m) for m in messages]
+            tg.send_media_group(target_user_id, media_group(unique_ids, caption, "Markdown"), priority=PRIORITY_HIGH)
+        
+        tg.send_message(
+            operator_id,
+            "✅ Медиа отправлено пользователю",
+            reply_markup=operator_menu()
+        )
+        
+    except Exception as e:
+        tg.send_message(operator_id, f"❌ Ошибка отправки: {str(e)}")
 
 # =============================
 # ФУНКЦИИ ОПЕРАТОРА
@@ -803,7 +2918,7 @@ def handle_operator_message(message):
         if user_id in waiting_answers and waiting_answers[user_id]['waiting']:
             reply_to_user(message)
         else:
-            bot.send_message(user_id, "Сначала возьмите сообщение из очереди")
+            tg.send_message(user_id, "Сначала возьмите сообщение из очереди")
             
     elif text == "📊 Статистика":
         show_operator_stats(user_id)
@@ -813,27 +2928,26 @@ def handle_operator_message(message):
         
     elif text == "⚙️ Управление":
         if is_admin(user_id):
-            bot.send_message(
+            tg.send_message(
                 user_id,
                 "⚙️ *Панель управления системой*",
                 parse_mode="Markdown",
                 reply_markup=settings_menu()
             )
         else:
-            bot.send_message(user_id, "❌ Недостаточно прав")
+            tg.send_message(user_id, "❌ Недостаточно прав")
             
     elif text == "🔄 Сбросить ответ":
-        if user_id in waiting_answers:
-            waiting_answers.pop(user_id)
-            bot.send_message(user_id, "✅ Контекст ответа сброшен")
+        if release_claim(user_id):
+            tg.send_message(user_id, "✅ Контекст ответа сброшен")
         else:
-            bot.send_message(user_id, "Нет активного контекста для сброса")
+            tg.send_message(user_id, "Нет активного контекста для сброса")
             
     elif text == "💾 Сохранить данные":
-        if save_data():
-            bot.send_message(user_id, "✅ Данные сохранены")
+        if storage.flush():
+            tg.send_message(user_id, "✅ Данные сохранены")
         else:
-            bot.send_message(user_id, "❌ Ошибка сохранения")
+            tg.send_message(user_id, "❌ Ошибка сохранения")
             
     elif text.startswith("/template"):
         use_template(message)
@@ -850,7 +2964,7 @@ def handle_admin_command(message):
     
     if text == "/admin":
         if is_admin(user_id):
-            bot.send_message(
+            tg.send_message(
                 user_id,
                 "👑 *Панель администратора*\n\n"
                 f"🤖 Бот работает: *{datetime.now().strftime('%d.%m.%Y %H:%M')}*\n"
@@ -862,7 +2976,7 @@ def handle_admin_command(message):
                 reply_markup=operator_menu()
             )
         else:
-            bot.send_message(user_id, "❌ Недостаточно прав")
+            tg.send_message(user_id, "❌ Недостаточно прав")
     
     elif text.startswith("/addop"):
         if is_admin(user_id):
@@ -871,26 +2985,41 @@ def handle_admin_command(message):
                 if new_op not in operators:
                     operators.append(new_op)
                     save_config()
-                    bot.send_message(user_id, f"✅ Оператор {new_op} добавлен")
+                    tg.send_message(user_id, f"✅ Оператор {new_op} добавлен")
                 else:
-                    bot.send_message(user_id, "❌ Оператор уже существует")
+                    tg.send_message(user_id, "❌ Оператор уже существует")
             except:
-                bot.send_message(user_id, "❌ Использование: /addop <user_id>")
+                tg.send_message(user_id, "❌ Использование: /addop <user_id>")
     
     elif text.startswith("/delop"):
         if is_admin(user_id):
             try:
                 del_op = int(text.split()[1])
                 if del_op == ADMIN_ID:
-                    bot.send_message(user_id, "❌ Нельзя удалить администратора")
+                    tg.send_message(user_id, "❌ Нельзя удалить администратора")
                 elif del_op not in operators:
-                    bot.send_message(user_id, "❌ Оператор не найден")
+                    tg.send_message(user_id, "❌ Оператор не найден")
                 else:
                     operators.remove(del_op)
                     save_config()
-                    bot.send_message(user_id, f"✅ Оператор {del_op} удален")
+                    tg.send_message(user_id, f"✅ Оператор {del_op} удален")
             except:
-                bot.send_message(user_id, "❌ Использование: /delop <user_id>")
+                tg.send_message(user_id, "❌ Использование: /delop <user_id>")
+    
+    elif text.split()[0] in ("/bc_pause", "/bc_resume", "/bc_cancel"):
+        if is_admin(user_id):
+            try:
+                set_broadcast_status(user_id, int(text.split()[1]), text.split()[0][len("/bc_"):])
+            except (IndexError, ValueError):
+                tg.send_message(user_id, f"❌ Использование: {text.split()[0]} <номер рассылки>")
+    
+    elif text == "/bc_list":
+        if is_admin(user_id):
+            list_broadcasts(user_id)
+    
+    elif text.split()[0] == "/load":
+        if is_admin(user_id):
+            show_load(user_id, text.split()[1] if len(text.split()) > 1 else 'h')
     
     elif text.startswith("/broadcast"):
         broadcast_message(message)
@@ -900,7 +3029,7 @@ def get_next_message(operator_id):
     msg = get_next_message_for_operator(operator_id)
     
     if not msg:
-        bot.send_message(
+        tg.send_message(
             operator_id,
             "📭 *Очередь пуста*\n\nНет новых сообщений для обработки.",
             parse_mode="Markdown",
@@ -924,8 +3053,15 @@ def get_next_message(operator_id):
         f"• Напишите ответ прямо здесь\n"
         f"• Или нажмите '💬 Ответить' для шаблона"
     )
+    lease = system_settings.get('claim_lease_minutes', 0)
+    if lease:
+        response += f"\n\n⌛ Ответьте в течение {lease} мин, иначе сообщение вернется в очередь"
+    
+    tg.send_message(operator_id, response, parse_mode="Markdown", reply_markup=operator_menu())
     
-    bot.send_message(operator_id, response, parse_mode="Markdown", reply_markup=operator_menu())
+    # Вложения показываем по сохраненным file_id
+    if msg.get('media') and not send_media(operator_id, msg['media']):
+        tg.send_message(operator_id, "⚠️ Вложения больше недоступны")
 
 def reply_to_user(message):
     """Ответить пользователю"""
@@ -933,11 +3069,20 @@ def reply_to_user(message):
     text = message.text
     
     if operator_id not in waiting_answers or not waiting_answers[operator_id]['waiting']:
-        bot.send_message(operator_id, "Сначала возьмите сообщение из очереди")
+        tg.send_message(operator_id, "Сначала возьмите сообщение из очереди")
         return
     
-    user_data = waiting_answers[operator_id]
-    target_user_id = user_data['user_id']
+    with state_lock:
+        claim = waiting_answers.get(operator_id)
+    if not claim:
+        tg.send_message(operator_id, "Сначала возьмите сообщение из очереди")
+        return
+    if claim_expired(claim):
+        # Опоздавший ответ не отправляем: сообщение возвращается в очередь
+        reap_expired_claims()
+        tg.send_message(operator_id, "❌ Ответ не отправлен: время на него истекло")
+        return
+    target_user_id = claim['user_id']
     
     try:
         # Отправляем ответ пользователю
@@ -948,109 +3093,78 @@ def reply_to_user(message):
             
         )
         
-        bot.send_message(target_user_id, response_text, parse_mode="Markdown")
-        
-        # Обновляем статистику
-        if target_user_id in user_messages:
-            for msg in user_messages[target_user_id]:
-                if not msg['answered']:
-                    msg['answered'] = True
-                    break
+        tg.send_message(target_user_id, response_text, parse_mode="Markdown", priority=PRIORITY_HIGH)
         
-        # Обновляем статистику оператора
-        if operator_id not in operator_stats:
-            operator_stats[operator_id] = {'answered': 0, 'response_time': []}
-        operator_stats[operator_id]['answered'] += 1
+        total_answered = finish_answer(operator_id, target_user_id)
+        if total_answered is None:
+            notify_late_answer(operator_id, target_user_id)
+            return
         
         # Уведомляем оператора
-        bot.send_message(
+        tg.send_message(
             operator_id,
             f"✅ *Ответ отправлен!*\n\n"
             f"👤 Пользователь: {target_user_id}\n"
             f"📝 Длина ответа: {len(text)} символов\n"
-            f"🏆 Всего ответов: {operator_stats[operator_id]['answered']}",
+            f"🏆 Всего ответов: {total_answered}",
             parse_mode="Markdown",
             reply_markup=operator_menu()
         )
         
-        # Удаляем из очереди если есть
-        if messages_queue and messages_queue[0]['user_id'] == target_user_id:
-            messages_queue.pop(0)
-        
-        # Сбрасываем контекст
-        waiting_answers.pop(operator_id, None)
-        
-        # Автосохранение
-        save_data()
-        
     except Exception as e:
-        bot.send_message(operator_id, f"❌ Ошибка отправки: {str(e)}")
+        tg.send_message(operator_id, f"❌ Ошибка отправки: {str(e)}")
 
 def handle_operator_media(message):
     """Обработка медиа от оператора"""
     operator_id = message.from_user.id
     
     if operator_id not in waiting_answers or not waiting_answers[operator_id]['waiting']:
-        bot.send_message(operator_id, "Сначала возьмите сообщение из очереди")
+        tg.send_message(operator_id, "Сначала возьмите сообщение из очереди")
         return
     
-    user_data = waiting_answers[operator_id]
-    target_user_id = user_data['user_id']
-    
-    try:
-        if message.photo:
-            file_id = message.photo[-1].file_id
-            caption = f"📸 *Фото от оператора*\n\n🕒 {get_moscow_time()}"
-            bot.send_photo(target_user_id, file_id, caption=caption, parse_mode="Markdown")
-            
-        elif message.video:
-            file_id = message.video.file_id
-            caption = f"🎬 *Видео от оператора*\n\n🕒 {get_moscow_time()}"
-            bot.send_video(target_user_id, file_id, caption=caption, parse_mode="Markdown")
-            
-        elif message.document:
-            file_id = message.document.file_id
-            caption = f"📎 *Документ от оператора*\n\n🕒 {get_moscow_time()}"
-            bot.send_document(target_user_id, file_id, caption=caption, parse_mode="Markdown")
-        
-        bot.send_message(
-            operator_id,
-            "✅ Медиа отправлено пользователю",
-            reply_markup=operator_menu()
-        )
-        
-    except Exception as e:
-        bot.send_message(operator_id, f"❌ Ошибка отправки: {str(e)}")
+    target_user_id = waiting_answers[operator_id]['user_id']
+    if message.media_group_id:
+        collect_album(message, lambda messages: relay_operator_media(operator_id, target_user_id, messages))
+    else:
+        relay_operator_media(operator_id, target_user_id, [message])
 
 def show_operator_stats(operator_id):
     """Показать статистику оператора"""
-    stats = operator_stats.get(operator_id, {'answered': 0, 'response_time': []})
-    
-    total_answered = sum(op.get('answered', 0) for op in operator_stats.values())
+    stats = operator_stats.get(operator_id, {'answered': 0})
     
     response = (
         f"📊 *ВАША СТАТИСТИКА*\n\n"
         f"🎯 Ответов отправлено: *{stats['answered']}*\n"
-        f"🏆 Место в рейтинге: *{get_operator_rank(operator_id)}*\n"
-        f"👥 Всего ответов всеми: *{total_answered}*\n\n"
+        f"🏆 Место в рейтинге: *{get_operator_rank(operator_id)}* "
+        f"(сегодня {get_operator_rank(operator_id, 'day')}, за неделю {get_operator_rank(operator_id, 'week')})\n"
+        f"🥇 Лидеры недели: {format_top(leaderboard_top('week', 3))}\n"
+        f"👥 Всего ответов всеми: *{answers_total}*\n"
+        f"⏳ Ожидание до взятия: {format_percentiles(stats.get('wait', new_histogram()))}\n"
+        f"💬 Время ответа: {format_percentiles(stats.get('reply', new_histogram()))}\n\n"
         f"📈 *ОЧЕРЕДЬ:*\n"
         f"• Сообщений в очереди: *{len(messages_queue)}*\n"
-        f"• Пользователей онлайн: *{len([u for u in users if time.time() - users[u].get('last_msg', 0) < 3600])}*\n"
-        f"• Новых за сутки: *{len([u for u in users if time.time() - users[u].get('joined', 0) < 86400])}*"
+        f"• Пользователей онлайн: *{online_index.count()}*\n"
+        f"• Новых за сутки: *{joined_index.count()}*"
     )
     
-    bot.send_message(operator_id, response, parse_mode="Markdown", reply_markup=operator_menu())
+    tg.send_message(operator_id, response, parse_mode="Markdown", reply_markup=operator_menu())
 
-def get_operator_rank(operator_id):
-    """Получить место оператора в рейтинге"""
-    sorted_ops = sorted(operator_stats.items(), 
-                       key=lambda x: x[1].get('answered', 0), 
-                       reverse=True)
-    
-    for i, (op_id, _) in enumerate(sorted_ops, 1):
-        if op_id == operator_id:
-            return i
-    return len(sorted_ops) + 1
+def get_operator_rank(operator_id, window='all'):
+    """Получить место оператора в рейтинге: 'all', 'day' или 'week'"""
+    refresh_window_boards()
+    with state_lock:
+        return leaderboards[window].rank(operator_id)
+
+def leaderboard_top(window, count):
+    """Первые count операторов рейтинга: [(operator_id, ответов)]"""
+    refresh_window_boards()
+    with state_lock:
+        return leaderboards[window].top(count)
+
+def format_top(top):
+    if not top:
+        return "нет ответов"
+    return ", ".join(f"{operator_id} ({answered})" for operator_id, answered in top)
 
 def show_info_panel(operator_id):
     """Показать информационную панель"""
@@ -1061,77 +3175,308 @@ def show_info_panel(operator_id):
         f"📅 Запущен: {datetime.now().strftime('%d.%m.%Y')}\n\n"
         f"📊 *СИСТЕМНЫЕ ПОКАЗАТЕЛИ:*\n"
         f"• Операторов онлайн: {len([op for op in operators if time.time() - operator_stats.get(op, {}).get('last_active', 0) < 300])}\n"
-        f"• Среднее время ответа: {calculate_average_response_time()} мин\n"
+        f"• Среднее время ответа: {calculate_average_response_time()} мин "
+        f"({format_percentiles(latency_totals['reply'])})\n"
+        f"• Ожидание в очереди: {format_percentiles(latency_totals['wait'])}, "
+        f"дольше всех ждет {oldest_waiting_minutes()} мин\n"
         f"• Эффективность: {calculate_efficiency()}%\n"
+        f"• Запись на диск: {writer.stats['flushes']} сбросов, "
+        f"задержка {writer.average_latency() * 1000:.0f} мс (макс. {writer.stats['max_latency'] * 1000:.0f} мс)\n"
+        f"• Исходящие: {tg.stats['sent']} отправлено, {tg.stats['throttled']} раз 429, "
+        f"ждут {tg.waiting()} (макс. ожидание {tg.stats['max_wait']:.1f} сек)\n"
+        f"• Задержка API: {', '.join(f'{name} {avg * 1000:.0f} мс ({calls})' for name, avg, calls in transport.slowest()) or 'нет данных'}\n"
         f"• Автоприветствие: {'ВКЛ' if system_settings['auto_greet'] else 'ВЫКЛ'}\n"
         f"• Капча: {'ВКЛ' if system_settings['captcha_enabled'] else 'ВЫКЛ'}\n\n"
         f"💡 *ПОЛЕЗНЫЕ КОМАНДЫ:*\n"
         f"• /admin - панель администратора\n"
         f"• /addop <id> - добавить оператора\n"
         f"• /delop <id> - удалить оператора\n"
+        f"• /load [m|h|d] - график нагрузки\n"
         f"• /template <номер> - использовать шаблон"
     )
     
-    bot.send_message(operator_id, panel, parse_mode="Markdown", reply_markup=operator_menu())
+    tg.send_message(operator_id, panel, parse_mode="Markdown", reply_markup=operator_menu())
 
 def calculate_average_response_time():
-    """Рассчитать среднее время ответа"""
-    if not messages_queue:
+    """Среднее время от взятия сообщения до ответа, мин"""
+    hist = latency_totals['reply']
+    answered = sum(hist['counts'])
+    if not answered:
+        return 0
+    return round(hist['sum'] / answered / 60, 1)
+
+def oldest_waiting_minutes():
+    """Сколько ждет самое старое сообщение в очереди, мин"""
+    with state_lock:
+        oldest = messages_queue.oldest()
+    if not oldest:
         return 0
-    oldest = min(messages_queue, key=lambda x: x['time'])
     return round((time.time() - oldest['time']) / 60, 1)
 
 def calculate_efficiency():
     """Рассчитать эффективность системы"""
-    total_messages = sum(len(msgs) for msgs in user_messages.values())
-    answered = sum(1 for msgs in user_messages.values() for msg in msgs if msg.get('answered', False))
+    total_messages, answered = storage.message_totals()
     
     if total_messages == 0:
         return 0
     return round((answered / total_messages) * 100, 1)
 
-def broadcast_message(message):
-    """Рассылка сообщения всем пользователям"""
-    operator_id = message.from_user.id
-    
-    # Проверка прав (только админ)
-    if not is_admin(operator_id):
-        bot.send_message(operator_id, "❌ Недостаточно прав")
-        return
+# Вид графика /load: (интервалов, заголовок, подпись интервала)
+LOAD_VIEWS = {
+    'm': (60, "за час по минутам", '%H:%M'),
+    'h': (24, "за сутки по часам", '%H:%M'),
+    'd': (30, "за 30 дней", '%d.%m')
+}
+
+def load_bar(value, peak, width=10):
+    """Полоса длиной value / peak от width символов с точностью до 1/8 символа"""
+    eighths = round(value / peak * width * 8) if peak else 0
+    return ('█' * (eighths // 8) + ('', '▏', '▎', '▍', '▌', '▋', '▊', '▉')[eighths % 8]).ljust(width)
+
+def show_load(admin_id, resolution='h'):
+    """График нагрузки: поступления полосой, взято, отвечено, отклонено и очередь (средняя/наибольшая)"""
+    if resolution not in LOAD_VIEWS:
+        tg.send_message(admin_id, "❌ Использование: /load [m|h|d] - минуты, часы или дни")
+        return
+    
+    count, title, label = LOAD_VIEWS[resolution]
+    window = load_window(resolution, count)
+    tz = pytz.timezone('Europe/Moscow')
+    peak = max(bucket[0] for _, bucket in window)
+    
+    lines = [f"{'':5} {'':10} {'пост':>4} {'взят':>4} {'отв':>4} {'откл':>4} очередь"]
+    for start, bucket in window:
+        average = bucket[5] / bucket[6] if bucket[6] else 0
+        lines.append(
+            f"{datetime.fromtimestamp(start, tz).strftime(label)} {load_bar(bucket[0], peak)} "
+            f"{bucket[0]:>4} {bucket[1]:>4} {bucket[2]:>4} {bucket[3]:>4} {average:.1f}/{bucket[4]}"
+        )
+    totals = [sum(bucket[index] for _, bucket in window) for index in range(len(LOAD_FIELDS))]
+    
+    tg.send_message(
+        admin_id,
+        f"📈 *Нагрузка {title}*\n\n"
+        "```\n" + "\n".join(lines) + "\n```\n"
+        f"📥 Поступило: *{totals[0]}* · 📬 Взято: *{totals[1]}*\n"
+        f"💬 Отвечено: *{totals[2]}* · ❌ Отклонено: *{totals[3]}*\n"
+        f"⏳ Очередь сейчас: *{queue_length()}*, наибольшая: *{max(bucket[4] for _, bucket in window)}*",
+        parse_mode="Markdown"
+    )
+
+def broadcast_message(message):
+    """Запустить рассылку всем пользователям фоновой задачей"""
+    operator_id = message.from_user.id
+    
+    # Проверка прав (только админ)
+    if not is_admin(operator_id):
+        tg.send_message(operator_id, "❌ Недостаточно прав")
+        return
+    
+    text = message.text.replace('/broadcast', '', 1).strip()
+    if not text:
+        tg.send_message(operator_id, "❌ Использование: /broadcast <текст>")
+        return
+    
+    job_id = create_broadcast(operator_id, text)
+    if job_id is None:
+        tg.send_message(operator_id, "❌ Не удалось начать рассылку, попробуйте еще раз")
+        return
+    start_broadcast(job_id)
+
+# =============================
+# РАССЫЛКИ
+# =============================
+
+broadcast_threads = {}  # job_id: поток, который сейчас отправляет рассылку
+BROADCAST_STATUSES = {
+    'running': "🚀 Идет",
+    'paused': "⏸ Приостановлена",
+    'cancelled': "❌ Отменена",
+    'done': "✅ Завершена"
+}
+
+def broadcast_targets(job):
+    """Получатели рассылки по возрастанию ID: все, кто пришел до ее создания"""
+    with state_lock:
+        return sorted(user_id for user_id, user in users.items() if user.get('joined', 0) <= job['created'])
+
+def broadcast_text(job_id):
+    """Текст сообщения о ходе рассылки"""
+    job = broadcast_jobs[job_id]
+    status = BROADCAST_STATUSES[job['status']]
+    done = job['sent'] + job['failed']
+    percent = done * 100 // job['total'] if job['total'] else 100
+    return (
+        f"📢 *Рассылка #{job_id}*\n\n"
+        f"Статус: {status}\n"
+        f"📊 Прогресс: {done} из {job['total']} ({percent}%)\n"
+        f"📤 Отправлено: {job['sent']}\n"
+        f"❌ Не отправлено: {job['failed']}"
+    )
+
+def broadcast_buttons(job_id):
+    """Кнопки управления рассылкой"""
+    status = broadcast_jobs[job_id]['status']
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    if status == 'running':
+        kb.add(types.InlineKeyboardButton("⏸ Пауза", callback_data=f"bc_pause_{job_id}"),
+               types.InlineKeyboardButton("❌ Отменить", callback_data=f"bc_cancel_{job_id}"))
+    elif status == 'paused':
+        kb.add(types.InlineKeyboardButton("▶️ Продолжить", callback_data=f"bc_resume_{job_id}"),
+               types.InlineKeyboardButton("❌ Отменить", callback_data=f"bc_cancel_{job_id}"))
+    return kb
+
+def show_broadcast_progress(job_id):
+    """Обновить сообщение о ходе рассылки у администратора"""
+    job = broadcast_jobs[job_id]
+    try:
+        tg.edit_message_text(
+            chat_id=job['admin_id'],
+            message_id=job['message_id'],
+            text=broadcast_text(job_id),
+            parse_mode="Markdown",
+            reply_markup=broadcast_buttons(job_id)
+        )
+    except Exception as e:
+        # Telegram не дает редактировать сообщение без изменений
+        if 'message is not modified' not in str(e):
+            print(f"Ошибка обновления прогресса рассылки #{job_id}: {e}")
+
+def create_broadcast(admin_id, text):
+    """Создать задачу рассылки и сообщение с ее прогрессом"""
+    if shard_index is not None:
+        # Пользователей регистрируют все процессы - получателей берем из общей базы
+        storage.load_users()
+    with state_lock:
+        job_id = max(broadcast_jobs, default=0) + 1
+        job = {
+            'text': text,
+            'admin_id': admin_id,
+            'message_id': None,
+            'status': 'running',
+            'created': time.time(),
+            'cursor': 0,  # ID последнего обработанного получателя
+            'sent': 0,
+            'failed': 0,
+            'total': 0
+        }
+        job['total'] = len(broadcast_targets(job))
+        broadcast_jobs[job_id] = job
     
+    # Без сообщения с прогрессом рассылку не начинаем: задача не сохранена, поток не запущен
     try:
-        text = message.text.replace('/broadcast ', '', 1)
+        msg = tg.send_message(admin_id, broadcast_text(job_id), parse_mode="Markdown",
+                              reply_markup=broadcast_buttons(job_id))
+    except Exception as e:
+        with state_lock:
+            broadcast_jobs.pop(job_id, None)
+        print(f"❌ Не удалось создать рассылку: {e}")
+        return None
+    
+    with state_lock:
+        job['message_id'] = msg.message_id
+        storage.save_broadcast(job_id)
         
-        if not text:
-            bot.send_message(operator_id, "❌ Использование: /broadcast <текст>")
+        # Старые завершенные рассылки больше не нужны
+        finished = [jid for jid, j in broadcast_jobs.items() if j['status'] in ('done', 'cancelled')]
+        for old_id in finished[:-BROADCAST_KEEP_FINISHED]:
+            del broadcast_jobs[old_id]
+            storage.delete_broadcast(old_id)
+    return job_id
+
+def start_broadcast(job_id):
+    """Запустить поток рассылки, если он еще не работает"""
+    with state_lock:
+        # Поток еще не вышел - решение о выходе он принимает под этим же замком и увидит новый статус
+        if job_id in broadcast_threads:
             return
+        thread = threading.Thread(target=run_broadcast, args=(job_id,), name=f"broadcast-{job_id}", daemon=True)
+        broadcast_threads[job_id] = thread
+        thread.start()
+
+def run_broadcast(job_id):
+    """Отправлять рассылку порциями с продолжения курсора, пока она не остановлена"""
+    job = broadcast_jobs[job_id]
+    text = f"📢 *Важное сообщение от администратора:*\n\n{job['text']}"
+    with state_lock:
+        targets = broadcast_targets(job)
+    position = bisect.bisect_right(targets, job['cursor'])
+    last_progress = 0
+    
+    # При остановке бота - после текущей порции, курсор уже сохранен
+    while True:
+        with state_lock:
+            if job['status'] != 'running' or position >= len(targets) or stopping.is_set():
+                if job['status'] == 'running' and position >= len(targets):
+                    job['status'] = 'done'
+                    storage.save_broadcast(job_id)
+                broadcast_threads.pop(job_id, None)
+                break
+        chunk = targets[position:position + BROADCAST_BATCH]
+        results = send_concurrently([
+            ('send_message', (user_id, text), {'parse_mode': "Markdown", 'priority': PRIORITY_BULK})
+            for user_id in chunk
+        ])
+        failed = sum(1 for result in results if isinstance(result, Exception))
+        position += len(chunk)
         
-        # Подсчет пользователей
-        sent = 0
-        failed = 0
-        
-        for user_id in list(users.keys()):
-            try:
-                bot.send_message(
-                    user_id,
-                    f"📢 *Важное сообщение от администратора:*\n\n{text}",
-                    parse_mode="Markdown"
-                )
-                sent += 1
-            except:
-                failed += 1
-            time.sleep(0.1)  # Защита от флуда
-        
-        bot.send_message(
-            operator_id,
-            f"✅ *Рассылка завершена!*\n\n"
-            f"📤 Отправлено: {sent}\n"
-            f"❌ Не отправлено: {failed}",
-            parse_mode="Markdown"
-        )
+        # Контрольная точка: после перезапуска продолжим со следующего получателя
+        with state_lock:
+            job['sent'] += len(chunk) - failed
+            job['failed'] += failed
+            job['cursor'] = chunk[-1]
+            storage.save_broadcast(job_id)
         
-    except Exception as e:
-        bot.send_message(operator_id, f"❌ Ошибка: {str(e)}")
+        if time.time() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+            show_broadcast_progress(job_id)
+            last_progress = time.time()
+    
+    show_broadcast_progress(job_id)
+
+def set_broadcast_status(operator_id, job_id, action):
+    """Пауза, продолжение или отмена рассылки"""
+    job = broadcast_jobs.get(job_id)
+    if not job:
+        tg.send_message(operator_id, f"❌ Рассылка #{job_id} не найдена")
+        return
+    
+    allowed = {
+        'pause': ('running',),
+        'resume': ('paused',),
+        'cancel': ('running', 'paused')
+    }[action]
+    with state_lock:
+        status = job['status']
+        if status in allowed:
+            job['status'] = {'pause': 'paused', 'resume': 'running', 'cancel': 'cancelled'}[action]
+            storage.save_broadcast(job_id)
+    if status not in allowed:
+        tg.send_message(operator_id, f"❌ Рассылка #{job_id} сейчас: {BROADCAST_STATUSES[status]}")
+        return
+    
+    if action == 'resume':
+        start_broadcast(job_id)
+    show_broadcast_progress(job_id)
+
+def list_broadcasts(operator_id):
+    """Список рассылок с их состоянием"""
+    if not broadcast_jobs:
+        tg.send_message(operator_id, "📢 Рассылок еще не было")
+        return
+    
+    text = "📢 *Рассылки:*\n\n"
+    for job_id, job in broadcast_jobs.items():
+        done = job['sent'] + job['failed']
+        text += f"• #{job_id}: {BROADCAST_STATUSES[job['status']]}, {done} из {job['total']}\n"
+    text += "\n/bc\\_pause, /bc\\_resume, /bc\\_cancel <номер> - управление рассылкой"
+    tg.send_message(operator_id, text, parse_mode="Markdown")
+
+def resume_broadcasts():
+    """Продолжить рассылки, прерванные перезапуском бота"""
+    for job_id, job in broadcast_jobs.items():
+        if job['status'] == 'running':
+            start_broadcast(job_id)
+            print(f"📢 Продолжена рассылка #{job_id}: {job['sent'] + job['failed']} из {job['total']}")
 
 def use_template(message):
     """Использовать шаблон ответа"""
@@ -1142,27 +3487,35 @@ def use_template(message):
         if len(parts) < 2:
             # Показать список шаблонов
             if not answer_templates:
-                bot.send_message(operator_id, "❌ Шаблоны не настроены")
+                tg.send_message(operator_id, "❌ Шаблоны не настроены")
                 return
             
             templates_list = "📝 *Доступные шаблоны:*\n\n"
             for key, template in answer_templates.items():
                 templates_list += f"• /template {key}: {template['name']}\n"
             
-            bot.send_message(operator_id, templates_list, parse_mode="Markdown")
+            tg.send_message(operator_id, templates_list, parse_mode="Markdown")
             return
         
         template_key = parts[1]
         
         if template_key not in answer_templates:
-            bot.send_message(operator_id, f"❌ Шаблон {template_key} не найден")
+            tg.send_message(operator_id, f"❌ Шаблон {template_key} не найден")
             return
         
         if operator_id not in waiting_answers or not waiting_answers[operator_id]['waiting']:
-            bot.send_message(operator_id, "❌ Сначала возьмите сообщение из очереди")
+            tg.send_message(operator_id, "❌ Сначала возьмите сообщение из очереди")
             return
         
-        user_data = waiting_answers[operator_id]
+        with state_lock:
+            user_data = waiting_answers.get(operator_id)
+        if not user_data:
+            tg.send_message(operator_id, "❌ Сначала возьмите сообщение из очереди")
+            return
+        if claim_expired(user_data):
+            reap_expired_claims()
+            tg.send_message(operator_id, "❌ Шаблон не отправлен: время на ответ истекло")
+            return
         template = answer_templates[template_key]
         
         # Отправляем шаблон
@@ -1173,19 +3526,16 @@ def use_template(message):
         
         )
         
-        bot.send_message(user_data['user_id'], response_text, parse_mode="Markdown")
-        bot.send_message(operator_id, f"✅ Шаблон '{template['name']}' отправлен")
+        tg.send_message(user_data['user_id'], response_text, parse_mode="Markdown", priority=PRIORITY_HIGH)
         
-        # Обновляем статистику
-        if operator_id not in operator_stats:
-            operator_stats[operator_id] = {'answered': 0}
-        operator_stats[operator_id]['answered'] += 1
-        
-        # Сбрасываем контекст
-        waiting_answers.pop(operator_id, None)
+        # Обновляем статистику и сбрасываем контекст
+        if finish_answer(operator_id, user_data['user_id']) is None:
+            notify_late_answer(operator_id, user_data['user_id'])
+            return
+        tg.send_message(operator_id, f"✅ Шаблон '{template['name']}' отправлен")
         
     except Exception as e:
-        bot.send_message(operator_id, f"❌ Ошибка: {str(e)}")
+        tg.send_message(operator_id, f"❌ Ошибка: {str(e)}")
 
 # =============================
 # ИНЛАЙН КНОПКИ (УПРАВЛЕНИЕ)
@@ -1198,7 +3548,7 @@ def handle_callback(call):
     
     # Проверка прав администратора
     if not is_admin(operator_id):
-        bot.answer_callback_query(call.id, "❌ Недостаточно прав", show_alert=True)
+        tg.answer_callback_query(call.id, "❌ Недостаточно прав", show_alert=True)
         return
     
     if call.data.startswith("reply_"):
@@ -1217,9 +3567,13 @@ def handle_callback(call):
         user_id = int(call.data.split("_")[1])
         show_user_history(operator_id, user_id)
         
+    elif call.data.startswith("bc_"):
+        _, action, job_id = call.data.split("_")
+        set_broadcast_status(operator_id, int(job_id), action)
+        
     # Меню управления
     elif call.data == "menu_operators":
-        bot.edit_message_text(
+        tg.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="👥 *Управление операторами*",
@@ -1228,7 +3582,7 @@ def handle_callback(call):
         )
         
     elif call.data == "menu_system":
-        bot.edit_message_text(
+        tg.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="⚙️ *Настройки системы*",
@@ -1237,7 +3591,7 @@ def handle_callback(call):
         )
         
     elif call.data == "menu_templates":
-        bot.edit_message_text(
+        tg.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="📝 *Управление шаблонами*",
@@ -1246,7 +3600,7 @@ def handle_callback(call):
         )
         
     elif call.data == "menu_worktime":
-        bot.edit_message_text(
+        tg.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="🕒 *Настройка времени работы*",
@@ -1255,7 +3609,7 @@ def handle_callback(call):
         )
         
     elif call.data == "menu_cleanup":
-        bot.edit_message_text(
+        tg.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="🧹 *Очистка данных*",
@@ -1264,7 +3618,7 @@ def handle_callback(call):
         )
         
     elif call.data == "back_to_settings":
-        bot.edit_message_text(
+        tg.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="⚙️ *Панель управления системой*",
@@ -1297,6 +3651,15 @@ def handle_callback(call):
         
     elif call.data == "set_timeout":
         set_timeout_dialog(operator_id, call.message.message_id)
+        
+    elif call.data == "set_history_limit":
+        set_history_limit_dialog(operator_id, call.message.message_id)
+        
+    elif call.data == "toggle_queue_mode":
+        toggle_queue_mode(operator_id, call.message.message_id)
+        
+    elif call.data == "set_claim_lease":
+        set_claim_lease_dialog(operator_id, call.message.message_id)
     
     # Шаблоны
     elif call.data == "list_templates":
@@ -1331,16 +3694,15 @@ def handle_callback(call):
     elif call.data == "reset_stats":
         reset_stats_dialog(operator_id, call.message.message_id)
     
-    bot.answer_callback_query(call.id)
+    tg.answer_callback_query(call.id)
 
 def start_operator_reply(operator_id, user_id):
     """Начать ответ пользователю"""
-    waiting_answers[operator_id] = {
-        'user_id': user_id,
-        'waiting': True
-    }
+    if not set_claim(operator_id, user_id):
+        tg.send_message(operator_id, f"⛔ Пользователю {user_id} уже отвечает другой оператор")
+        return
     
-    bot.send_message(
+    tg.send_message(
         operator_id,
         f"💬 *Режим ответа пользователю {user_id}*\n\n"
         f"Напишите ответ в этом чате.\n"
@@ -1351,15 +3713,13 @@ def start_operator_reply(operator_id, user_id):
 
 def mark_as_solved(operator_id, user_id):
     """Пометить как решенное"""
-    if user_id in user_messages:
-        for msg in user_messages[user_id]:
-            msg['answered'] = True
+    storage.mark_answered(user_id, all_messages=True)
     
-    bot.send_message(operator_id, f"✅ Вопрос пользователя {user_id} помечен как решенный")
+    tg.send_message(operator_id, f"✅ Вопрос пользователя {user_id} помечен как решенный")
     
     # Уведомляем пользователя
     try:
-        bot.send_message(
+        tg.send_message(
             user_id,
             "✅ *Ваш вопрос решен*\n\n"
             "Оператор поместил ваш вопрос как решенный. "
@@ -1368,20 +3728,21 @@ def mark_as_solved(operator_id, user_id):
         )
     except:
         pass
-    
-    save_data()
 
 def reject_message(operator_id, user_id):
     """Отклонить сообщение"""
     # Удаляем из очереди
-    global messages_queue
-    messages_queue = [msg for msg in messages_queue if msg['user_id'] != user_id]
+    with state_lock:
+        removed = messages_queue.remove_user(user_id)
+        if removed:
+            storage.queue_remove(removed)
+            load_event('rejects', len(removed))
     
-    bot.send_message(operator_id, f"❌ Сообщение пользователя {user_id} отклонено")
+    tg.send_message(operator_id, f"❌ Сообщение пользователя {user_id} отклонено")
     
     # Уведомляем пользователя
     try:
-        bot.send_message(
+        tg.send_message(
             user_id,
             "❌ *Ваше сообщение отклонено*\n\n"
             "Оператор отклонил ваше сообщение. "
@@ -1390,24 +3751,23 @@ def reject_message(operator_id, user_id):
         )
     except:
         pass
-    
-    save_data()
 
 def show_user_history(operator_id, user_id):
     """Показать историю пользователя"""
-    if user_id not in user_messages:
-        bot.send_message(operator_id, "История пуста")
+    messages = storage.get_history(user_id, 10)  # Последние 10 сообщений
+    if not messages:
+        tg.send_message(operator_id, "История пуста")
         return
     
     history = f"📋 *История пользователя {user_id}:*\n\n"
     
-    for i, msg in enumerate(user_messages[user_id][-10:], 1):  # Последние 10 сообщений
+    for i, msg in enumerate(messages, 1):
         time_str = datetime.fromtimestamp(msg['time']).strftime('%H:%M %d.%m')
         status = "✅" if msg.get('answered', False) else "⏳"
         preview = msg['text'][:50] + "..." if len(msg['text']) > 50 else msg['text']
         history += f"{i}. {time_str} {status}: {preview}\n"
     
-    bot.send_message(operator_id, history, parse_mode="Markdown")
+    tg.send_message(operator_id, history, parse_mode="Markdown")
 
 # =============================
 # ФУНКЦИИ УПРАВЛЕНИЯ
@@ -1415,7 +3775,7 @@ def show_user_history(operator_id, user_id):
 
 def add_operator_dialog(operator_id, message_id):
     """Диалог добавления оператора"""
-    msg = bot.send_message(
+    msg = tg.send_message(
         operator_id,
         "👥 *Добавление оператора*\n\n"
         "Введите ID пользователя, которого хотите добавить:",
@@ -1430,15 +3790,15 @@ def process_add_operator(message, original_message_id):
         new_op = int(message.text)
         
         if new_op in operators:
-            bot.send_message(message.chat.id, "❌ Этот пользователь уже оператор")
+            tg.send_message(message.chat.id, "❌ Этот пользователь уже оператор")
         else:
             operators.append(new_op)
             save_config()
             
-            bot.send_message(message.chat.id, f"✅ Оператор {new_op} добавлен")
+            tg.send_message(message.chat.id, f"✅ Оператор {new_op} добавлен")
             
             # Возвращаемся к меню
-            bot.edit_message_text(
+            tg.edit_message_text(
                 chat_id=message.chat.id,
                 message_id=original_message_id,
                 text="👥 *Управление операторами*",
@@ -1446,17 +3806,17 @@ def process_add_operator(message, original_message_id):
                 reply_markup=operators_menu()
             )
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Введите числовой ID")
+        tg.send_message(message.chat.id, "❌ Введите числовой ID")
 
 def remove_operator_dialog(operator_id, message_id):
     """Диалог удаления оператора"""
     if len(operators) <= 1:
-        bot.send_message(operator_id, "❌ Нельзя удалить последнего оператора")
+        tg.send_message(operator_id, "❌ Нельзя удалить последнего оператора")
         return
     
     ops_list = "\n".join([f"• {op_id}" for op_id in operators if op_id != ADMIN_ID])
     
-    msg = bot.send_message(
+    msg = tg.send_message(
         operator_id,
         f"👥 *Удаление оператора*\n\n"
         f"Текущие операторы:\n{ops_list}\n\n"
@@ -1472,17 +3832,17 @@ def process_remove_operator(message, original_message_id):
         del_op = int(message.text)
         
         if del_op == ADMIN_ID:
-            bot.send_message(message.chat.id, "❌ Нельзя удалить администратора")
+            tg.send_message(message.chat.id, "❌ Нельзя удалить администратора")
         elif del_op not in operators:
-            bot.send_message(message.chat.id, "❌ Оператор не найден")
+            tg.send_message(message.chat.id, "❌ Оператор не найден")
         else:
             operators.remove(del_op)
             save_config()
             
-            bot.send_message(message.chat.id, f"✅ Оператор {del_op} удален")
+            tg.send_message(message.chat.id, f"✅ Оператор {del_op} удален")
             
             # Возвращаемся к меню
-            bot.edit_message_text(
+            tg.edit_message_text(
                 chat_id=message.chat.id,
                 message_id=original_message_id,
                 text="👥 *Управление операторов*",
@@ -1490,13 +3850,13 @@ def process_remove_operator(message, original_message_id):
                 reply_markup=operators_menu()
             )
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Введите числовой ID")
+        tg.send_message(message.chat.id, "❌ Введите числовой ID")
 
 def list_operators(operator_id, message_id):
     """Список операторов"""
     ops_list = "\n".join([f"• {op_id} {'👑' if op_id == ADMIN_ID else '👤'}" for op_id in operators])
     
-    bot.edit_message_text(
+    tg.edit_message_text(
         chat_id=operator_id,
         message_id=message_id,
         text=f"📋 *Список операторов*\n\n{ops_list}\n\nВсего: {len(operators)}",
@@ -1509,7 +3869,7 @@ def toggle_setting(setting_name, operator_id, message_id):
     current_value = system_settings.get(setting_name, False)
     system_settings[setting_name] = not current_value
     
-    save_data()
+    storage.save_setting(setting_name)
     
     # Обновляем меню
     setting_names = {
@@ -1520,7 +3880,7 @@ def toggle_setting(setting_name, operator_id, message_id):
     
     status = "✅ ВКЛ" if system_settings[setting_name] else "❌ ВЫКЛ"
     
-    bot.edit_message_text(
+    tg.edit_message_text(
         chat_id=operator_id,
         message_id=message_id,
         text=f"⚙️ *Настройки системы*\n\n{setting_names[setting_name]}: {status}",
@@ -1528,9 +3888,66 @@ def toggle_setting(setting_name, operator_id, message_id):
         reply_markup=system_menu()
     )
 
+def toggle_queue_mode(operator_id, message_id):
+    """Переключение режима выдачи сообщений операторам"""
+    with state_lock:
+        if system_settings.get('queue_mode') == 'round_robin':
+            system_settings['queue_mode'] = 'fifo'
+        else:
+            system_settings['queue_mode'] = 'round_robin'
+        messages_queue.mode = system_settings['queue_mode']
+    
+    storage.save_setting('queue_mode')
+    
+    status = "по кругу между пользователями" if messages_queue.mode == 'round_robin' else "по старшинству (FIFO)"
+    
+    tg.edit_message_text(
+        chat_id=operator_id,
+        message_id=message_id,
+        text=f"⚙️ *Настройки системы*\n\nВыдача сообщений: {status}",
+        parse_mode="Markdown",
+        reply_markup=system_menu()
+    )
+
+def set_claim_lease_dialog(operator_id, message_id):
+    """Диалог установки срока ответа"""
+    msg = tg.send_message(
+        operator_id,
+        f"⌛ *Срок ответа оператора*\n\n"
+        f"Текущий срок: {system_settings.get('claim_lease_minutes', 0) or 'без ограничения'} мин\n\n"
+        f"Через сколько минут неотвеченное сообщение возвращается в очередь (0-1440, 0 - никогда):",
+        parse_mode="Markdown"
+    )
+    
+    bot.register_next_step_handler(msg, process_claim_lease, message_id)
+
+def process_claim_lease(message, original_message_id):
+    """Обработка установки срока ответа"""
+    try:
+        minutes = int(message.text)
+        
+        if 0 <= minutes <= 1440:
+            system_settings['claim_lease_minutes'] = minutes
+            storage.save_setting('claim_lease_minutes')
+            
+            tg.send_message(message.chat.id, f"✅ Срок ответа установлен: {minutes} мин")
+            
+            # Возвращаемся к меню
+            tg.edit_message_text(
+                chat_id=message.chat.id,
+                message_id=original_message_id,
+                text="⚙️ *Настройки системы*",
+                parse_mode="Markdown",
+                reply_markup=system_menu()
+            )
+        else:
+            tg.send_message(message.chat.id, "❌ Срок должен быть от 0 до 1440 минут")
+    except ValueError:
+        tg.send_message(message.chat.id, "❌ Введите число")
+
 def set_queue_limit_dialog(operator_id, message_id):
     """Диалог установки лимита очереди"""
-    msg = bot.send_message(
+    msg = tg.send_message(
         operator_id,
         f"📏 *Установка лимита очереди*\n\n"
         f"Текущий лимит: {system_settings.get('max_queue_size', 100)} сообщений\n\n"
@@ -1547,12 +3964,12 @@ def process_queue_limit(message, original_message_id):
         
         if 10 <= limit <= 1000:
             system_settings['max_queue_size'] = limit
-            save_data()
+            storage.save_setting('max_queue_size')
             
-            bot.send_message(message.chat.id, f"✅ Лимит очереди установлен: {limit}")
+            tg.send_message(message.chat.id, f"✅ Лимит очереди установлен: {limit}")
             
             # Возвращаемся к меню
-            bot.edit_message_text(
+            tg.edit_message_text(
                 chat_id=message.chat.id,
                 message_id=original_message_id,
                 text="⚙️ *Настройки системы*",
@@ -1560,13 +3977,13 @@ def process_queue_limit(message, original_message_id):
                 reply_markup=system_menu()
             )
         else:
-            bot.send_message(message.chat.id, "❌ Лимит должен быть от 10 до 1000")
+            tg.send_message(message.chat.id, "❌ Лимит должен быть от 10 до 1000")
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Введите число")
+        tg.send_message(message.chat.id, "❌ Введите число")
 
 def set_timeout_dialog(operator_id, message_id):
     """Диалог установки таймаута"""
-    msg = bot.send_message(
+    msg = tg.send_message(
         operator_id,
         f"⏱️ *Установка таймаута*\n\n"
         f"Текущий таймаут: {WAIT_TIME} секунд\n\n"
@@ -1586,10 +4003,49 @@ def process_timeout(message, original_message_id):
             WAIT_TIME = timeout
             save_config()
             
-            bot.send_message(message.chat.id, f"✅ Таймаут установлен: {timeout} сек")
+            tg.send_message(message.chat.id, f"✅ Таймаут установлен: {timeout} сек")
+            
+            # Возвращаемся к меню
+            tg.edit_message_text(
+                chat_id=message.chat.id,
+                message_id=original_message_id,
+                text="⚙️ *Настройки системы*",
+                parse_mode="Markdown",
+                reply_markup=system_menu()
+            )
+        else:
+            tg.send_message(message.chat.id, "❌ Таймаут должен быть от 10 до 3600 секунд")
+    except ValueError:
+        tg.send_message(message.chat.id, "❌ Введите число")
+
+def set_history_limit_dialog(operator_id, message_id):
+    """Диалог установки хранения истории"""
+    msg = tg.send_message(
+        operator_id,
+        f"🗂 *Хранение истории*\n\n"
+        f"Сообщений на пользователя: {system_settings.get('history_max_messages', 0) or 'без лимита'}\n"
+        f"Срок хранения: {system_settings.get('history_max_days', 0) or 'без лимита'} дней\n\n"
+        f"Введите лимит сообщений и срок в днях через пробел, например `200 30` (0 - без лимита):",
+        parse_mode="Markdown"
+    )
+    
+    bot.register_next_step_handler(msg, process_history_limit, message_id)
+
+def process_history_limit(message, original_message_id):
+    """Обработка установки хранения истории"""
+    try:
+        max_messages, max_days = map(int, message.text.split())
+        
+        if 0 <= max_messages <= 100000 and 0 <= max_days <= 3650:
+            system_settings['history_max_messages'] = max_messages
+            system_settings['history_max_days'] = max_days
+            storage.save_setting('history_max_messages')
+            storage.save_setting('history_max_days')
+            
+            tg.send_message(message.chat.id, f"✅ Хранение истории: {max_messages} сообщений, {max_days} дней")
             
             # Возвращаемся к меню
-            bot.edit_message_text(
+            tg.edit_message_text(
                 chat_id=message.chat.id,
                 message_id=original_message_id,
                 text="⚙️ *Настройки системы*",
@@ -1597,9 +4053,9 @@ def process_timeout(message, original_message_id):
                 reply_markup=system_menu()
             )
         else:
-            bot.send_message(message.chat.id, "❌ Таймаут должен быть от 10 до 3600 секунд")
+            tg.send_message(message.chat.id, "❌ Лимит от 0 до 100000 сообщений, срок от 0 до 3650 дней")
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Введите число")
+        tg.send_message(message.chat.id, "❌ Введите два числа через пробел")
 
 def list_templates(operator_id, message_id):
     """Список шаблонов"""
@@ -1611,7 +4067,7 @@ def list_templates(operator_id, message_id):
             text += f"• {key}: {template['name']}\n"
             text += f"  {template['text'][:50]}...\n\n"
     
-    bot.edit_message_text(
+    tg.edit_message_text(
         chat_id=operator_id,
         message_id=message_id,
         text=text,
@@ -1621,7 +4077,7 @@ def list_templates(operator_id, message_id):
 
 def add_template_dialog(operator_id, message_id):
     """Диалог добавления шаблона"""
-    msg = bot.send_message(
+    msg = tg.send_message(
         operator_id,
         "➕ *Добавление шаблона*\n\n"
         "Введите название шаблона:",
@@ -1634,7 +4090,7 @@ def process_add_template_name(message, original_message_id):
     """Обработка названия шаблона"""
     template_name = message.text
     
-    msg = bot.send_message(
+    msg = tg.send_message(
         message.chat.id,
         f"📝 *Название: {template_name}*\n\n"
         f"Теперь введите текст шаблона:",
@@ -1654,12 +4110,12 @@ def process_add_template_text(message, original_message_id, template_name):
         'text': template_text
     }
     
-    save_data()
+    storage.save_template(key)
     
-    bot.send_message(message.chat.id, f"✅ Шаблон '{template_name}' добавлен")
+    tg.send_message(message.chat.id, f"✅ Шаблон '{template_name}' добавлен")
     
     # Возвращаемся к меню
-    bot.edit_message_text(
+    tg.edit_message_text(
         chat_id=message.chat.id,
         message_id=original_message_id,
         text="📝 *Управление шаблонами*",
@@ -1670,14 +4126,14 @@ def process_add_template_text(message, original_message_id, template_name):
 def edit_template_dialog(operator_id, message_id):
     """Диалог редактирования шаблона"""
     if not answer_templates:
-        bot.send_message(operator_id, "❌ Шаблоны не настроены")
+        tg.send_message(operator_id, "❌ Шаблоны не настроены")
         return
     
     templates_list = "📝 *Редактирование шаблона*\n\n"
     for key, template in answer_templates.items():
         templates_list += f"{key}: {template['name']}\n"
     
-    msg = bot.send_message(
+    msg = tg.send_message(
         operator_id,
         templates_list + "\nВведите номер шаблона для редактирования:",
         parse_mode="Markdown"
@@ -1690,12 +4146,12 @@ def process_edit_template_select(message, original_message_id):
     key = message.text
     
     if key not in answer_templates:
-        bot.send_message(message.chat.id, "❌ Шаблон не найден")
+        tg.send_message(message.chat.id, "❌ Шаблон не найден")
         return
     
     template = answer_templates[key]
     
-    msg = bot.send_message(
+    msg = tg.send_message(
         message.chat.id,
         f"✏️ *Редактирование шаблона {key}: {template['name']}*\n\n"
         f"Текущий текст:\n{template['text']}\n\n"
@@ -1710,12 +4166,12 @@ def process_edit_template_text(message, original_message_id, key):
     new_text = message.text
     answer_templates[key]['text'] = new_text
     
-    save_data()
+    storage.save_template(key)
     
-    bot.send_message(message.chat.id, f"✅ Шаблон {key} обновлен")
+    tg.send_message(message.chat.id, f"✅ Шаблон {key} обновлен")
     
     # Возвращаемся к меню
-    bot.edit_message_text(
+    tg.edit_message_text(
         chat_id=message.chat.id,
         message_id=original_message_id,
         text="📝 *Управление шаблонами*",
@@ -1726,14 +4182,14 @@ def process_edit_template_text(message, original_message_id, key):
 def delete_template_dialog(operator_id, message_id):
     """Диалог удаления шаблона"""
     if not answer_templates:
-        bot.send_message(operator_id, "❌ Шаблоны не настроены")
+        tg.send_message(operator_id, "❌ Шаблоны не настроены")
         return
     
     templates_list = "🗑️ *Удаление шаблона*\n\n"
     for key, template in answer_templates.items():
         templates_list += f"{key}: {template['name']}\n"
     
-    msg = bot.send_message(
+    msg = tg.send_message(
         operator_id,
         templates_list + "\nВведите номер шаблона для удаления:",
         parse_mode="Markdown"
@@ -1746,18 +4202,18 @@ def process_delete_template(message, original_message_id):
     key = message.text
     
     if key not in answer_templates:
-        bot.send_message(message.chat.id, "❌ Шаблон не найден")
+        tg.send_message(message.chat.id, "❌ Шаблон не найден")
         return
     
     template_name = answer_templates[key]['name']
     del answer_templates[key]
     
-    save_data()
+    storage.delete_template(key)
     
-    bot.send_message(message.chat.id, f"✅ Шаблон '{template_name}' удален")
+    tg.send_message(message.chat.id, f"✅ Шаблон '{template_name}' удален")
     
     # Возвращаемся к меню
-    bot.edit_message_text(
+    tg.edit_message_text(
         chat_id=message.chat.id,
         message_id=original_message_id,
         text="📝 *Управление шаблонами*",
@@ -1770,11 +4226,11 @@ def toggle_worktime(operator_id, message_id):
     current_value = system_settings.get('work_hours_enabled', False)
     system_settings['work_hours_enabled'] = not current_value
     
-    save_data()
+    storage.save_setting('work_hours_enabled')
     
     status = "✅ ВКЛ" if system_settings['work_hours_enabled'] else "❌ ВЫКЛ"
     
-    bot.edit_message_text(
+    tg.edit_message_text(
         chat_id=operator_id,
         message_id=message_id,
         text=f"🕒 *Настройка времени работы*\n\nРежим работы: {status}",
@@ -1784,7 +4240,7 @@ def toggle_worktime(operator_id, message_id):
 
 def set_work_start_dialog(operator_id, message_id):
     """Диалог установки времени начала работы"""
-    msg = bot.send_message(
+    msg = tg.send_message(
         operator_id,
         f"🕘 *Установка времени начала работы*\n\n"
         f"Текущее время: {system_settings.get('work_hours_start', 9)}:00\n\n"
@@ -1801,12 +4257,12 @@ def process_work_start(message, original_message_id):
         
         if 0 <= hour <= 23:
             system_settings['work_hours_start'] = hour
-            save_data()
+            storage.save_setting('work_hours_start')
             
-            bot.send_message(message.chat.id, f"✅ Время начала работы установлено: {hour}:00")
+            tg.send_message(message.chat.id, f"✅ Время начала работы установлено: {hour}:00")
             
             # Возвращаемся к меню
-            bot.edit_message_text(
+            tg.edit_message_text(
                 chat_id=message.chat.id,
                 message_id=original_message_id,
                 text="🕒 *Настройка времени работы*",
@@ -1814,13 +4270,13 @@ def process_work_start(message, original_message_id):
                 reply_markup=worktime_menu()
             )
         else:
-            bot.send_message(message.chat.id, "❌ Час должен быть от 0 до 23")
+            tg.send_message(message.chat.id, "❌ Час должен быть от 0 до 23")
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Введите число")
+        tg.send_message(message.chat.id, "❌ Введите число")
 
 def set_work_end_dialog(operator_id, message_id):
     """Диалог установки времени окончания работы"""
-    msg = bot.send_message(
+    msg = tg.send_message(
         operator_id,
         f"🕘 *Установка времени окончания работы*\n\n"
         f"Текущее время: {system_settings.get('work_hours_end', 21)}:00\n\n"
@@ -1837,12 +4293,12 @@ def process_work_end(message, original_message_id):
         
         if 0 <= hour <= 23:
             system_settings['work_hours_end'] = hour
-            save_data()
+            storage.save_setting('work_hours_end')
             
-            bot.send_message(message.chat.id, f"✅ Время окончания работы установлено: {hour}:00")
+            tg.send_message(message.chat.id, f"✅ Время окончания работы установлено: {hour}:00")
             
             # Возвращаемся к меню
-            bot.edit_message_text(
+            tg.edit_message_text(
                 chat_id=message.chat.id,
                 message_id=original_message_id,
                 text="🕒 *Настройка времени работы*",
@@ -1850,17 +4306,18 @@ def process_work_end(message, original_message_id):
                 reply_markup=worktime_menu()
             )
         else:
-            bot.send_message(message.chat.id, "❌ Час должен быть от 0 до 23")
+            tg.send_message(message.chat.id, "❌ Час должен быть от 0 до 23")
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Введите число")
+        tg.send_message(message.chat.id, "❌ Введите число")
 
 def clean_queue(operator_id, message_id):
     """Очистка очереди"""
-    global messages_queue
-    count = len(messages_queue)
-    messages_queue.clear()
+    with state_lock:
+        count = len(messages_queue)
+        messages_queue.clear()
+        storage.queue_clear()
     
-    bot.edit_message_text(
+    tg.edit_message_text(
         chat_id=operator_id,
         message_id=message_id,
         text=f"🧹 *Очистка данных*\n\n✅ Очередь очищена: удалено {count} сообщений",
@@ -1872,14 +4329,13 @@ def clean_queue(operator_id, message_id):
     for op_id in operators:
         if op_id != operator_id:
             try:
-                bot.send_message(op_id, f"⚠️ Очередь очищена администратором. Удалено {count} сообщений")
+                tg.send_message(op_id, f"⚠️ Очередь очищена администратором. Удалено {count} сообщений")
             except:
                 pass
 
 def clean_history_dialog(operator_id, message_id):
     """Диалог очистки истории"""
-    user_count = len(user_messages)
-    total_messages = sum(len(msgs) for msgs in user_messages.values())
+    user_count, total_messages = storage.history_size()
     
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -1887,7 +4343,7 @@ def clean_history_dialog(operator_id, message_id):
         types.InlineKeyboardButton("❌ Нет, отмена", callback_data="menu_cleanup")
     )
     
-    bot.edit_message_text(
+    tg.edit_message_text(
         chat_id=operator_id,
         message_id=message_id,
         text=f"🧹 *Очистка истории*\n\n"
@@ -1902,14 +4358,11 @@ def clean_history_dialog(operator_id, message_id):
 @bot.callback_query_handler(func=lambda call: call.data == "confirm_clean_history")
 def confirm_clean_history(call):
     """Подтверждение очистки истории"""
-    global user_messages
-    user_count = len(user_messages)
-    total_messages = sum(len(msgs) for msgs in user_messages.values())
+    with state_lock:
+        user_count, total_messages = storage.history_size()
+        storage.clear_history()
     
-    user_messages.clear()
-    save_data()
-    
-    bot.edit_message_text(
+    tg.edit_message_text(
         chat_id=call.message.chat.id,
         message_id=call.message.message_id,
         text=f"🧹 *Очистка данных*\n\n✅ История очищена:\n• Пользователей: {user_count}\n• Сообщений: {total_messages}",
@@ -1920,7 +4373,7 @@ def confirm_clean_history(call):
 def reset_stats_dialog(operator_id, message_id):
     """Диалог сброса статистики"""
     ops_count = len(operator_stats)
-    total_answered = sum(op.get('answered', 0) for op in operator_stats.values())
+    total_answered = answers_total
     
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -1928,7 +4381,7 @@ def reset_stats_dialog(operator_id, message_id):
         types.InlineKeyboardButton("❌ Нет, отмена", callback_data="menu_cleanup")
     )
     
-    bot.edit_message_text(
+    tg.edit_message_text(
         chat_id=operator_id,
         message_id=message_id,
         text=f"📊 *Сброс статистики*\n\n"
@@ -1943,14 +4396,19 @@ def reset_stats_dialog(operator_id, message_id):
 @bot.callback_query_handler(func=lambda call: call.data == "confirm_reset_stats")
 def confirm_reset_stats(call):
     """Подтверждение сброса статистики"""
-    global operator_stats
-    ops_count = len(operator_stats)
-    total_answered = sum(op.get('answered', 0) for op in operator_stats.values())
-    
-    operator_stats.clear()
-    save_data()
-    
-    bot.edit_message_text(
+    global answers_total
+    
+    with state_lock:
+        ops_count = len(operator_stats)
+        total_answered = answers_total
+        storage.clear_operator_stats()
+        answers_total = 0
+        for kind in latency_totals:
+            latency_totals[kind] = new_histogram()
+        for board in leaderboards.values():
+            board.clear()
+    
+    tg.edit_message_text(
         chat_id=call.message.chat.id,
         message_id=call.message.message_id,
         text=f"🧹 *Очистка данных*\n\n✅ Статистика сброшена:\n• Операторов: {ops_count}\n• Ответов: {total_answered}",
@@ -1958,12 +4416,617 @@ def confirm_reset_stats(call):
         reply_markup=cleanup_menu()
     )
 
+# =============================
+# ДИСПЕТЧЕР ОБНОВЛЕНИЙ
+# =============================
+
+class ChatDispatcher:
+    """Обработка обновлений в пуле потоков: разные чаты параллельно, один чат строго по порядку"""
+    
+    def __init__(self, workers):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.chats = {}  # chat_id: deque обновлений, первое сейчас в обработке
+        self.ready = Queue()  # Чаты, у которых есть необработанные обновления
+        self.size = 0  # Принятых, но еще не обработанных обновлений
+        self.processed = 0
+        self.errors = 0
+        self.started = False
+    
+    @staticmethod
+    def chat_of(update):
+        """Чат, к которому относится обновление"""
+        message = update.message or update.edited_message
+        if message:
+            return message.chat.id
+        if update.callback_query:
+            return update.callback_query.from_user.id
+        return 0
+    
+    @staticmethod
+    def media_group_of(update):
+        message = update.message or update.edited_message
+        return message.media_group_id if message else None
+    
+    def submit(self, update, limit=0):
+        """Поставить обновление в очередь его чата; False, если уже ждут limit обновлений"""
+        return self.enqueue(self.chat_of(update), update, limit)
+    
+    def submit_task(self, chat_id, task):
+        """Выполнить task() в очереди чата после уже принятых обновлений этого чата"""
+        self.enqueue(chat_id, task)
+    
+    def enqueue(self, chat_id, update, limit=0):
+        with self.lock:
+            if limit and self.size >= limit:
+                return False
+            self.size += 1
+            pending = self.chats.get(chat_id)
+            if pending is None:
+                self.chats[chat_id] = deque([update])
+                self.ready.put(chat_id)
+            else:
+                pending.append(update)
+        return True
+    
+    def worker(self):
+        while True:
+            chat_id = self.ready.get()
+            with self.lock:
+                update = self.chats[chat_id][0]
+            failed = False
+            try:
+                if callable(update):
+                    update()
+                else:
+                    # Недособранный альбом чата пришел раньше этого обновления - обрабатываем его первым
+                    flush_chat_albums(chat_id, self.media_group_of(update))
+                    bot.process_new_updates([update])
+            except Exception as e:
+                failed = True
+                print(f"❌ Ошибка обработки обновления {getattr(update, 'update_id', 'альбома')}: {e}")
+            finally:
+                with self.lock:
+                    self.size -= 1
+                    self.processed += 1
+                    self.errors += failed
+                    pending = self.chats[chat_id]
+                    pending.popleft()
+                    if pending:
+                        self.ready.put(chat_id)
+                    else:
+                        del self.chats[chat_id]
+                self.ready.task_done()
+    
+    def start(self):
+        """Запустить рабочие потоки"""
+        if self.started:
+            return
+        self.started = True
+        # Обработчики выполняются прямо в потоках диспетчера
+        bot.threaded = False
+        for i in range(self.workers):
+            threading.Thread(target=self.worker, name=f"dispatcher-{i}", daemon=True).start()
+    
+    def join(self):
+        """Дождаться обработки всех принятых обновлений"""
+        self.ready.join()
+    
+    def drain(self, timeout):
+        """Ждать обработки принятых обновлений не дольше timeout сек; вернуть, сколько осталось"""
+        deadline = time.time() + timeout
+        while self.pending() and time.time() < deadline:
+            time.sleep(0.05)
+        return self.pending()
+    
+    def pending(self):
+        with self.lock:
+            return self.size
+    
+    def confirmable(self, offset):
+        """Докуда можно подтвердить Telegram обновления до offset: все, что раньше, обработано
+        
+        Если не успели дообработать, подтверждаем только до первого незавершенного - остальное придет снова
+        (уже обработанные после него обновления других чатов тоже). Недособранный альбом не знает своих
+        обновлений - тогда не подтверждаем ничего. None - подтверждать нечего.
+        """
+        with self.lock:
+            unfinished = [update for updates in self.chats.values() for update in updates]
+        if not unfinished:
+            return offset
+        if any(callable(update) for update in unfinished):
+            return None
+        return min(update.update_id for update in unfinished)
+
+dispatcher = ChatDispatcher(WORKERS)
+
+# =============================
+# ВЕБХУК
+# =============================
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Прием обновлений, которые Telegram присылает POST-запросами"""
+    
+    protocol_version = 'HTTP/1.1'  # Keep-alive: Telegram шлет обновления по одному соединению
+    stats = {'accepted': 0, 'rejected': 0, 'overloaded': 0}
+    stats_lock = threading.Lock()
+    
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+    
+    def reply(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.reply(404)
+            return
+        
+        # Telegram передает secret_token из setWebhook в заголовке каждого запроса
+        # Без секрета любой, кто достучался до порта, мог бы прислать обновление от имени админа
+        token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not WEBHOOK_SECRET or not hmac.compare_digest(token.encode('utf-8'), WEBHOOK_SECRET.encode('utf-8')):
+            self.count('rejected')
+            self.close_connection = True
+            self.reply(403)
+            return
+        
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if not 0 < length <= WEBHOOK_MAX_BODY:
+            # Тело не прочитано - соединение дальше не разобрать
+            self.close_connection = True
+            self.reply(413 if length > 0 else 400)
+            return
+        
+        try:
+            update = types.Update.de_json(self.rfile.read(length).decode('utf-8'))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            # Не JSON, не объект или объект без обязательных полей обновления
+            self.reply(400)
+            return
+        if update is None:
+            self.reply(400)
+            return
+        
+        # Бот останавливается или очередь переполнена - Telegram повторит доставку позже
+        if stopping.is_set() or not dispatcher.submit(update, limit=WEBHOOK_QUEUE_SIZE):
+            self.count('overloaded')
+            self.reply(503)
+            return
+        self.count('accepted')
+        self.reply(200)
+    
+    def log_message(self, format, *args):
+        pass
+
+def make_webhook_server(host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+    """HTTP-сервер вебхука (port=0 - любой свободный порт)"""
+    server = ThreadingHTTPServer((host, port), WebhookHandler)
+    server.daemon_threads = True
+    return server
+
+# =============================
+# МЕТРИКИ
+# =============================
+
+# Тип и описание метрик для /metrics
+METRICS_HELP = {
+    'bot_handler_duration_seconds': ('histogram', "Обработка обновлений по обработчикам"),
+    'bot_handler_errors_total': ('counter', "Ошибки обработчиков обновлений"),
+    'bot_updates_processed_total': ('counter', "Обновлений обработано диспетчером"),
+    'bot_updates_failed_total': ('counter', "Обновлений, обработка которых завершилась ошибкой"),
+    'bot_updates_pending': ('gauge', "Обновлений принято, но еще не обработано"),
+    'bot_api_request_duration_seconds': ('histogram', "Вызовы Bot API по методам, с повторами"),
+    'bot_api_errors_total': ('counter', "Ошибки Bot API по методам и кодам ответа"),
+    'bot_save_data_duration_seconds': ('histogram', "Сохранение данных: снимок или коммит SQLite"),
+    'bot_save_data_bytes': ('gauge', "Размер последнего снимка или файла базы, байт"),
+    'bot_queue_depth': ('gauge', "Сообщений в очереди"),
+    'bot_active_claims': ('gauge', "Сообщений в работе у операторов"),
+    'bot_broadcasts_running': ('gauge', "Идущих рассылок"),
+    'bot_broadcast_recipients': ('gauge', "Получателей рассылки"),
+    'bot_broadcast_sent': ('gauge', "Отправлено сообщений рассылки"),
+    'bot_broadcast_failed': ('gauge', "Не доставлено сообщений рассылки")
+}
+
+class Metrics:
+    """Счетчики, значения и гистограммы процесса; при выключенных метриках вызовы ничего не делают"""
+    
+    def __init__(self, bounds, enabled):
+        self.bounds = bounds
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.values = {}  # (имя, метки): значение счетчика или показателя
+        self.histograms = {}  # (имя, метки): [счетчики по интервалам bounds и +Inf, сумма]
+    
+    def inc(self, name, labels=(), value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.values[name, labels] = self.values.get((name, labels), 0) + value
+    
+    def set(self, name, value, labels=()):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.values[name, labels] = value
+    
+    def observe(self, name, seconds, labels=()):
+        if not self.enabled:
+            return
+        with self.lock:
+            hist = self.histograms.get((name, labels))
+            if hist is None:
+                hist = self.histograms[name, labels] = [[0] * (len(self.bounds) + 1), 0.0]
+            hist[0][bisect.bisect_left(self.bounds, seconds)] += 1
+            hist[1] += seconds
+    
+    def families(self):
+        """Накопленные метрики: {имя: [(имя строки, метки, значение)]}"""
+        with self.lock:
+            values = list(self.values.items())
+            histograms = [(key, list(counts), total) for key, (counts, total) in self.histograms.items()]
+        families = {}
+        for (name, labels), value in values:
+            families.setdefault(name, []).append((name, labels, value))
+        for (name, labels), counts, total in histograms:
+            rows = families.setdefault(name, [])
+            seen = 0
+            # Интервалы Prometheus накопительные: le - все наблюдения не больше границы
+            for bound, count in zip([f"{bound:g}" for bound in self.bounds] + ['+Inf'], counts):
+                seen += count
+                rows.append((name + '_bucket', labels + (('le', bound),), seen))
+            rows.append((name + '_sum', labels, total))
+            rows.append((name + '_count', labels, seen))
+        return families
+
+metrics = Metrics(METRICS_BOUNDS, METRICS_ENABLED)
+
+def format_labels(labels):
+    """Метки в виде {имя="значение",...}"""
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+def render_metrics():
+    """Текст для /metrics: накопленные метрики и текущие показатели бота"""
+    families = metrics.families()
+    families['bot_updates_processed_total'] = [('bot_updates_processed_total', (), dispatcher.processed)]
+    families['bot_updates_failed_total'] = [('bot_updates_failed_total', (), dispatcher.errors)]
+    families['bot_updates_pending'] = [('bot_updates_pending', (), dispatcher.pending())]
+    if shard_index in (None, 0):
+        # Очередь, закрепления и рассылки ведет координатор - у остальных процессов их нет
+        with state_lock:
+            claims = len(waiting_answers)
+            jobs = [(str(job_id), job['status'], job['total'], job['sent'], job['failed'])
+                    for job_id, job in broadcast_jobs.items()]
+        families['bot_queue_depth'] = [('bot_queue_depth', (), queue_length())]
+        families['bot_active_claims'] = [('bot_active_claims', (), claims)]
+        families['bot_broadcasts_running'] = [
+            ('bot_broadcasts_running', (), sum(1 for job in jobs if job[1] == 'running'))]
+        for index, name in enumerate(('bot_broadcast_recipients', 'bot_broadcast_sent', 'bot_broadcast_failed')):
+            families[name] = [(name, (('broadcast', job[0]),), job[2 + index]) for job in jobs]
+    
+    lines = []
+    for name in sorted(families):
+        kind, text = METRICS_HELP[name]
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(f"{row}{format_labels(labels)} {value}" for row, labels, value in families[name])
+    return "\n".join(lines) + "\n"
+
+def count_handler(function):
+    """Обертка обработчика telebot: длительность и ошибки каждого вызова"""
+    labels = (('handler', function.__name__),)
+    
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        started = time.time()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', labels)
+            raise
+        finally:
+            metrics.observe('bot_handler_duration_seconds', time.time() - started, labels)
+    return wrapper
+
+def instrument_handlers():
+    """Обернуть зарегистрированные обработчики для метрик (один раз)"""
+    for handler in bot.message_handlers + bot.callback_query_handlers:
+        if not hasattr(handler['function'], '__wrapped__'):
+            handler['function'] = count_handler(handler['function'])
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """GET /metrics в текстовом формате Prometheus"""
+    
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Включить метрики и отдавать их в фоновом потоке (port=0 - любой свободный порт)"""
+    metrics.enabled = True
+    instrument_handlers()
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+# =============================
+# ШАРДИРОВАНИЕ ПО ПРОЦЕССАМ
+# =============================
+# Родительский процесс получает обновления и раздает их процессам по ID чата:
+# операторы и админ - всегда в процесс 0 (координатор очереди), пользователи - по user_id.
+# Общее состояние живет в SQLite (WAL): процессы пользователей пишут в таблицу очереди,
+# координатор забирает новые строки в свою MessageQueue и ведет закрепления и статистику.
+
+def update_chat(raw):
+    """Чат обновления по его JSON (как ChatDispatcher.chat_of)"""
+    for key in ('message', 'edited_message'):
+        if key in raw:
+            return raw[key]['chat']['id']
+    if 'callback_query' in raw:
+        return raw['callback_query']['from']['id']
+    return 0
+
+def shard_of(chat_id, shards):
+    """Процесс, который обрабатывает чат"""
+    if chat_id in operators or chat_id == ADMIN_ID:
+        return 0
+    return chat_id % shards
+
+def pull_shared_queue():
+    """Координатор: забрать из базы сообщения, поставленные другими процессами"""
+    global queue_seq
+    
+    fresh = storage.queue_since(queue_seq)
+    if not fresh:
+        return 0
+    # Карточки авторов и файлы вложений записали другие процессы
+    storage.load_users({msg['user_id'] for msg in fresh})
+    missing = {unique_id for msg in fresh for unique_id in msg.get('media', ()) if unique_id not in media_files}
+    if missing:
+        storage.load_media(missing)
+    
+    with state_lock:
+        for msg in fresh:
+            if len(messages_queue) >= system_settings['max_queue_size']:
+                evicted = messages_queue.pop_oldest()
+                if evicted:
+                    storage.queue_remove([evicted['id']])
+            messages_queue.push(msg)
+            queue_seq = msg['id']
+        load_event('arrivals', len(fresh))
+    
+    # Операторов уведомляет только координатор: один процесс держит темп отправок в их чаты
+    if system_settings['notify_operators']:
+        for msg in fresh:
+            notify_queued(msg)
+    return len(fresh)
+
+def notify_queued(msg):
+    """Координатор: уведомить операторов о сообщении, которое принял другой процесс"""
+    user = users.get(msg['user_id'], {})
+    user_info = format_user_info(msg['user_id'], user.get('username'), user.get('first_name'))
+    media = [unique_id for unique_id in msg.get('media', ()) if unique_id in media_files]
+    if not media:
+        notify_operators(msg['user_id'], msg['text'], user_info)
+        return
+    # Текст вложения в очереди: "[ТИП] подпись"
+    caption = msg['text'].partition('] ')[2]
+    if caption:
+        user_info += f"\n📝 Подпись: {caption}"
+    notify_operators_media(msg['user_id'], media, user_info)
+
+def shard_sync():
+    """Фоновая синхронизация процесса с общей базой"""
+    refreshed = users_refreshed = time.time()
+    while True:
+        time.sleep(SHARD_SYNC_INTERVAL)
+        try:
+            if shard_index == 0:
+                pull_shared_queue()
+            now = time.time()
+            if now - refreshed >= SHARD_REFRESH_INTERVAL:
+                storage.load_settings()
+                refreshed = now
+            if shard_index == 0 and now - users_refreshed >= SHARD_USERS_REFRESH:
+                storage.load_users()
+                users_refreshed = now
+        except Exception as e:
+            print(f"❌ Ошибка синхронизации процесса {shard_index}: {e}")
+
+def run_shard(index, shards, inbox):
+    """Процесс-обработчик: берет обновления своих чатов из inbox"""
+    global shard_index, storage, tg
+    
+    shard_index = index
+    # Останавливает процессы родитель: сначала отдаст им все принятые обновления
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    storage = SqliteStorage(SQLITE_FILE, autocommit=True)
+    # Общий лимит Telegram делят все процессы
+    tg = Outbox(OUTBOX_GLOBAL_RATE / shards, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, OUTBOX_RETRIES)
+    if not prepare_bot():
+        return
+    if index:
+        # Очередь ведет координатор, здесь она только занимала бы память
+        messages_queue.clear()
+    
+    while True:
+        raw = inbox.get()
+        if raw is None:
+            break
+        dispatcher.submit(types.Update.de_json(raw))
+    shutdown()
+    if dispatcher.pending():
+        # Родитель не подтвердит обновления Telegram - недообработанные придут снова
+        sys.exit(1)
+
+def start_shards(shards, target=run_shard, args=()):
+    """Запустить процессы-обработчики; вернуть их и очереди обновлений"""
+    # spawn: каждый процесс заново импортирует бота и создает свои потоки и соединения
+    context = multiprocessing.get_context('spawn')
+    inboxes = [context.Queue() for _ in range(shards)]
+    processes = [context.Process(target=target, args=(index, shards, inboxes[index], *args), name=f"shard-{index}")
+                 for index in range(shards)]
+    for process in processes:
+        process.start()
+    return processes, inboxes
+
+def stop_shards(processes, inboxes, timeout=None):
+    """Дождаться, пока процессы обработают принятое, и завершить их; True - все обработали все"""
+    for inbox in inboxes:
+        inbox.put(None)
+    deadline = time.time() + timeout if timeout else None
+    for process in processes:
+        process.join(max(0, deadline - time.time()) if deadline else None)
+        if process.is_alive():
+            print(f"⚠️ Процесс {process.name} не завершился вовремя")
+            process.terminate()
+            process.join()
+    return all(process.exitcode == 0 for process in processes)
+
+def run_bot_sharded():
+    """Запуск бота в нескольких процессах с общим состоянием в SQLite"""
+    global storage
+    
+    if STORAGE_BACKEND != 'sqlite':
+        # Общее состояние процессов живет только в SQLite - молча менять хранилище нельзя
+        print(f"❌ Режим sharded работает только с backend = sqlite. Укажите его в [Storage]: "
+              f"при первом запуске данные из {SNAPSHOT_FILE} и {JOURNAL_FILE} перенесутся в {SQLITE_FILE}")
+        return
+    # Перенос данных из JSON и схема базы - один раз, до запуска процессов
+    storage = SqliteStorage(SQLITE_FILE)
+    storage.load()
+    storage.write_pending()
+    storage.conn.close()
+    if not BOT_TOKEN:
+        print("❌ Ошибка: Добавьте BOT_TOKEN в config.ini")
+        return
+    
+    processes, inboxes = start_shards(SHARDS)
+    print(f"🧩 Процессов-обработчиков: {SHARDS}")
+    install_signal_handlers()
+    
+    offset = None
+    try:
+        while not stopping.is_set():
+            try:
+                interruptible.set()
+                updates = apihelper.get_updates(BOT_TOKEN, offset, None, 60, None, 20)
+            except Exception as e:
+                print(f"⚠️ Ошибка: {e}")
+                time.sleep(5)
+                continue
+            finally:
+                interruptible.clear()
+            for raw in updates:
+                offset = raw['update_id'] + 1
+                inboxes[shard_of(update_chat(raw), SHARDS)].put(raw)
+    except ShutdownRequested:
+        pass
+    
+    # Процессы дообрабатывают свои очереди и сохраняются сами
+    if stop_shards(processes, inboxes, SHUTDOWN_TIMEOUT + 10):
+        confirm_updates(offset)
+    else:
+        # Какие обновления не дообработаны, неизвестно - Telegram пришлет снова все неподтвержденные
+        print("⚠️ Обновления не подтверждены: после перезапуска Telegram пришлет их снова")
+    print("👋 Бот остановлен")
+
+# =============================
+# ОСТАНОВКА
+# =============================
+
+def request_shutdown(signum, frame):
+    """Обработчик SIGTERM/SIGINT: перестать принимать обновления"""
+    if stopping.is_set():
+        return
+    print(f"🛑 Получен сигнал {signal.Signals(signum).name}, останавливаемся...")
+    stopping.set()
+    if interruptible.is_set():
+        raise ShutdownRequested
+
+def install_signal_handlers():
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+
+def confirm_updates(offset):
+    """Подтвердить Telegram обработанные обновления, чтобы после перезапуска они не пришли снова"""
+    if offset is None:
+        return
+    try:
+        bot.get_updates(offset=offset, limit=1, timeout=0, long_polling_timeout=0)
+    except Exception as e:
+        print(f"⚠️ Не удалось подтвердить обновления: {e}")
+
+def shutdown(timeout=SHUTDOWN_TIMEOUT):
+    """Дообработать принятое, дождаться отправок и сохранить все состояние"""
+    stopping.set()
+    deadline = time.time() + timeout
+    left = lambda: max(0, deadline - time.time())
+    accepted = dispatcher.pending()
+    
+    # Обновления, уже принятые диспетчером, и альбомы, которые еще собирались
+    updates_left = dispatcher.drain(left())
+    albums = flush_albums()
+    if albums:
+        updates_left = dispatcher.drain(left())
+    
+    # Рассылки останавливаются после текущей порции и продолжатся после запуска
+    with state_lock:
+        broadcasts = list(broadcast_threads.values())
+    for thread in broadcasts:
+        thread.join(left())
+    
+    # Уведомления операторам и прочие фоновые отправки
+    with detached_lock:
+        sends = list(detached_sends)
+    sends_left = len(wait_futures(sends, timeout=left()).not_done) if sends else 0
+    
+    # Итоговая запись: журнал и снимок (или транзакция SQLite), с неполной текущей минутой нагрузки
+    close_load_minute()
+    saved = writer.flush() and storage.flush()
+    
+    print(f"🛑 Остановка{f' процесса {shard_index}' if shard_index is not None else ''}: "
+          f"обновлений {accepted - updates_left}/{accepted}, "
+          f"фоновых отправок {len(sends) - sends_left}/{len(sends)}, альбомов {albums}, "
+          f"рассылок приостановлено {len(broadcasts)}, "
+          f"данные {'сохранены' if saved else 'НЕ СОХРАНЕНЫ'}")
+    if updates_left or sends_left or tg.waiting():
+        print(f"⚠️ Не успели за {timeout:.0f} сек: обновлений {updates_left}, "
+              f"отправок {sends_left}, в очереди исходящих {tg.waiting()}")
+    return not (updates_left or sends_left) and saved
+
 # =============================
 # ЗАПУСК БОТА
 # =============================
 
-def run_bot():
-    """Запуск бота"""
+def prepare_bot():
+    """Загрузка данных и фоновые задачи, общие для всех режимов запуска"""
     print("=" * 50)
     print("🤖 АНОНИМНЫЙ ЧАТ-БОТ v2.0")
     print("=" * 50)
@@ -1974,45 +5037,204 @@ def run_bot():
     print("=" * 50)
     
     # Загрузка данных
-    load_data()
+    storage.load()
     print(f"Загружено пользователей: {len(users)}")
-    print(f"Загружено сообщений: {sum(len(msgs) for msgs in user_messages.values())}")
+    print(f"Загружено сообщений: {storage.history_size()[1]}")
     print(f"Загружено шаблонов: {len(answer_templates)}")
     
     if not BOT_TOKEN:
         print("❌ Ошибка: Добавьте BOT_TOKEN в config.ini")
-        return
+        return False
     
     print("🚀 Бот запущен...")
     print("💡 Система готова к работе!")
     
+    if METRICS_ENABLED:
+        try:
+            server = start_metrics_server(port=METRICS_PORT + (shard_index or 0))
+            print(f"📈 Метрики: http://{METRICS_HOST}:{server.server_port}/metrics")
+        except OSError as e:
+            print(f"❌ Не удалось запустить сервер метрик: {e}")
+    
     # Автозапуск для операторов
-    for op_id in operators:
+    for op_id in operators if shard_index in (None, 0) else ():
         try:
-            bot.send_message(op_id, "🔄 Бот перезапущен и готов к работе!")
+            tg.send_message(op_id, "🔄 Бот перезапущен и готов к работе!")
         except:
             pass
     
     # Планировщик автосохранения
-    import threading
-    
     def auto_save():
-        """Автосохранение данных"""
+        """Свернуть журнал в снимок, если были изменения"""
         while True:
             time.sleep(300)  # 5 минут
-            if save_data():
+            if storage.pending() and storage.flush():
                 print(f"💾 Автосохранение: {datetime.now().strftime('%H:%M:%S')}")
     
-    # Запуск автосохранения в отдельном потоке
+    def history_cleaner():
+        """Понемногу удалять историю сверх лимитов хранения"""
+        while True:
+            time.sleep(HISTORY_SWEEP_INTERVAL)
+            try:
+                storage.sweep_history(HISTORY_SWEEP_BATCH)
+            except Exception as e:
+                print(f"❌ Ошибка очистки истории: {e}")
+    
+    def claim_reaper():
+        """Возвращать в очередь сообщения с истекшим сроком ответа"""
+        while True:
+            time.sleep(CLAIM_REAPER_INTERVAL)
+            try:
+                expired = reap_expired_claims()
+                if expired:
+                    print(f"⌛ Возвращено в очередь: {len(expired)}")
+            except Exception as e:
+                print(f"❌ Ошибка проверки закреплений: {e}")
+    
+    def load_ticker():
+        """Закрывать минуты рядов нагрузки и без событий - чтобы записать замер очереди"""
+        while True:
+            time.sleep(60 - time.time() % 60 + 1)
+            try:
+                roll_load(time.time())
+            except Exception as e:
+                print(f"❌ Ошибка записи рядов нагрузки: {e}")
+    
+    # Запуск автосохранения, очистки истории, сроков ответа, рядов нагрузки и фоновой записи в отдельных потоках
     save_thread = threading.Thread(target=auto_save, daemon=True)
     save_thread.start()
+    writer.start()
+    dispatcher.start()
+    if shard_index is not None:
+        threading.Thread(target=shard_sync, daemon=True).start()
+    if shard_index in (None, 0):
+        # Очередь, закрепления и рассылки ведет только координатор
+        threading.Thread(target=history_cleaner, daemon=True).start()
+        threading.Thread(target=claim_reaper, daemon=True).start()
+        threading.Thread(target=load_ticker, daemon=True).start()
+        roll_load(time.time())
+        resume_broadcasts()
+    return True
+
+def run_bot():
+    """Запуск бота"""
+    if not prepare_bot():
+        return
+    install_signal_handlers()
     
-    while True:
-        try:
-            bot.polling(none_stop=True, timeout=60)
-        except Exception as e:
-            print(f"⚠️ Ошибка: {e}")
-            time.sleep(5)
+    offset = None
+    try:
+        while not stopping.is_set():
+            try:
+                interruptible.set()
+                updates = bot.get_updates(offset=offset, timeout=60, long_polling_timeout=20)
+            except Exception as e:
+                print(f"⚠️ Ошибка: {e}")
+                time.sleep(5)
+                continue
+            finally:
+                interruptible.clear()
+            for update in updates:
+                offset = update.update_id + 1
+                dispatcher.submit(update)
+    except ShutdownRequested:
+        pass
+    
+    shutdown()
+    confirm_updates(dispatcher.confirmable(offset))
+    print("👋 Бот остановлен")
+
+async def async_polling():
+    """Получение обновлений через AsyncTeleBot; обработчики выполняет тот же диспетчер в потоках"""
+    global async_bot, async_loop
+    from telebot.async_telebot import AsyncTeleBot
+    
+    async_bot = AsyncTeleBot(BOT_TOKEN)
+    async_loop = asyncio.get_running_loop()
+    
+    # Сигнал прерывает ожидание getUpdates; цикл событий продолжает работать для дообработки
+    poller = asyncio.current_task()
+    def on_signal(signum):
+        if not stopping.is_set():
+            print(f"🛑 Получен сигнал {signum.name}, останавливаемся...")
+            stopping.set()
+            poller.cancel()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        async_loop.add_signal_handler(signum, on_signal, signum)
+    
+    offset = None
+    try:
+        while not stopping.is_set():
+            try:
+                updates = await async_bot.get_updates(offset=offset, timeout=60)
+            except Exception as e:
+                print(f"⚠️ Ошибка: {e}")
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                dispatcher.submit(update)
+    except asyncio.CancelledError:
+        pass
+    
+    await async_loop.run_in_executor(None, shutdown)
+    await async_loop.run_in_executor(None, confirm_updates, dispatcher.confirmable(offset))
+    print("👋 Бот остановлен")
+
+def run_bot_async():
+    """Запуск бота с опросом и рассылкой уведомлений на asyncio
+    
+    Обработчики остаются синхронными и выполняются в потоках диспетчера, как в режиме polling;
+    на цикле событий работают только getUpdates и параллельные отправки (send_concurrently, send_detached).
+    Отправки идут с теми же повторами и учетом, что и через ApiTransport, и не больше pool_size сразу;
+    при равном числе одновременных отправок пропускная способность та же, что у polling, - выигрыш
+    только в том, что ожидание ответов не занимает потоки.
+    """
+    if not prepare_bot():
+        return
+    
+    asyncio.run(async_polling())
+
+def run_bot_webhook():
+    """Запуск бота с приемом обновлений через вебхук"""
+    global WEBHOOK_SECRET
+    
+    if not WEBHOOK_SECRET:
+        if not WEBHOOK_URL:
+            # Вебхук зарегистрирован кем-то другим - с каким секретом, мы не знаем
+            print("❌ Ошибка: для режима webhook задайте secret_token (или url, чтобы бот сам зарегистрировал вебхук)")
+            return
+        WEBHOOK_SECRET = secrets.token_urlsafe(32)
+    if not prepare_bot():
+        return
+    
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+        print(f"🌐 Вебхук зарегистрирован: {WEBHOOK_URL}")
+    
+    server = make_webhook_server()
+    print(f"🌐 Прием обновлений на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    install_signal_handlers()
+    try:
+        interruptible.set()
+        server.serve_forever()
+    except ShutdownRequested:
+        pass
+    finally:
+        interruptible.clear()
+    
+    # Запросы, которые уже читаются, получат 503 - Telegram доставит их после перезапуска
+    server.server_close()
+    shutdown()
+    print("👋 Бот остановлен")
 
 if __name__ == "__main__":
-    run_bot()
\ No newline at end of file
+    if RUNTIME_MODE == 'async':
+        run_bot_async()
+    elif RUNTIME_MODE == 'webhook':
+        run_bot_webhook()
+    elif RUNTIME_MODE == 'sharded':
+        run_bot_sharded()
+    else:
+        run_bot()
\ No newline at end of file